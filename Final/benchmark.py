@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Benchmark script for Email Forwarding Rules Audit API.
+
+This script seeds a separate benchmark database with generated rules and
+filters, measures the API endpoints and report tasks at each size, and
+writes the results as JSON. Given the results of an earlier run, it fails
+when a measurement got slower than the allowed threshold.
+
+Usage:
+    python benchmark.py                              # 1k, 10k, 100k and 1M rules
+    python benchmark.py --sizes 1000,10000 --output after.json --baseline before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import django
+
+# Set up Django environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'forwarding_audit.settings')
+django.setup()
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment
+
+from forwarding_rules.models import AutoForwarding
+from forwarding_rules.repository import create_repositories
+from forwarding_rules.tasks import generate_rules_report, generate_stats_report, generate_rules_only_report
+from sample_data_import import store_autoforwarding_data, DEFAULT_BATCH_SIZE
+
+# Rule counts benchmarked by default
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# Requests sent to each endpoint at each size
+DEFAULT_REQUESTS = 200
+
+# Allowed slowdown against the baseline before a measurement counts as a regression
+DEFAULT_THRESHOLD = 0.20
+
+# Report tasks, run eagerly in this process
+REPORT_TASKS = {
+    "generate_rules_report": generate_rules_report,
+    "generate_stats_report": generate_stats_report,
+    "generate_rules_only_report": generate_rules_only_report,
+}
+
+DISPOSITIONS = ["keep", "archive", "trash", "markRead", None]
+
+
+def generate_users(start, count):
+    """
+    Generate user records in the import format
+
+    Roughly two thirds of the users get a filter, and a few have an error.
+
+    Args:
+        start: Number of the first user
+        count: Number of users to generate
+
+    Returns:
+        Iterator of user data dictionaries
+    """
+    rng = random.Random(start)
+    for number in range(start, start + count):
+        has_filter = rng.random() < 0.66
+        yield {
+            "email": f"user{number}@example.com",
+            "name": f"User {number}",
+            "forwarding_email": f"forward{number}@{rng.choice(['example.com', 'partner.org', 'gmail.com'])}",
+            "disposition": rng.choice(DISPOSITIONS),
+            "error": "Permission denied" if rng.random() < 0.02 else None,
+            "investigation_note": None,
+            "filter": {
+                "criteria": {"from": f"sender{rng.randrange(1000)}@example.com", "subject": "invoice"},
+                "action": {"forward": f"archive{number}@example.com", "addLabels": ["AUDIT"]},
+                "created_at": "2024-01-15",
+            } if has_filter else None,
+        }
+
+
+def seed_rules(rule_repo, filter_repo, size):
+    """Add generated rules until the database holds `size` of them"""
+    existing = AutoForwarding.objects.count()
+    if existing >= size:
+        return
+    started = time.perf_counter()
+    store_autoforwarding_data(rule_repo, filter_repo, generate_users(existing + 1, size - existing),
+                              DEFAULT_BATCH_SIZE)
+    print(f"  seeded {size - existing} rules in {time.perf_counter() - started:.1f}s")
+
+
+def summarize(durations):
+    """
+    Summarize request durations
+
+    Args:
+        durations: Durations in seconds
+
+    Returns:
+        dict: Request count, throughput and p50/p95/p99 latency in milliseconds
+    """
+    cuts = statistics.quantiles(durations, n=100, method="inclusive")
+    return {
+        "requests": len(durations),
+        "throughput_rps": round(len(durations) / sum(durations), 1),
+        "p50_ms": round(cuts[49] * 1000, 2),
+        "p95_ms": round(cuts[94] * 1000, 2),
+        "p99_ms": round(cuts[98] * 1000, 2),
+    }
+
+
+def benchmark_endpoint(client, make_url, requests):
+    """
+    Send `requests` GET requests and summarize their latency
+
+    Args:
+        client: Django test client
+        make_url: Function returning the URL of the next request
+        requests: Number of requests to send
+
+    Returns:
+        dict: Summary from summarize()
+    """
+    durations = []
+    for _ in range(requests):
+        url = make_url()
+        started = time.perf_counter()
+        response = client.get(url)
+        durations.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {response.status_code}")
+    return summarize(durations)
+
+
+def benchmark_size(client, size, requests, run_reports):
+    """Measure every endpoint, and optionally the report tasks, at the current database size"""
+    rng = random.Random(size)
+    ids = list(AutoForwarding.objects.order_by("id").values_list("id", flat=True)[:size])
+    results = {
+        "GET /api/rules/": benchmark_endpoint(
+            client, lambda: "/api/rules/?limit=100", requests),
+        "GET /api/rules/search/": benchmark_endpoint(
+            client, lambda: f"/api/rules/search/?email=user{rng.randrange(1, size)}@&limit=100", requests),
+        "GET /api/stats/": benchmark_endpoint(
+            client, lambda: "/api/stats/", requests),
+        "GET /api/rules/{rule_id}": benchmark_endpoint(
+            client, lambda: f"/api/rules/{rng.choice(ids)}", requests),
+    }
+    for label, summary in results.items():
+        print(f"  {label:<34} {summary['throughput_rps']:>9.1f} req/s  "
+              f"p50 {summary['p50_ms']:>8.2f} ms  p95 {summary['p95_ms']:>8.2f} ms  p99 {summary['p99_ms']:>8.2f} ms")
+
+    if run_reports:
+        for name, task in REPORT_TASKS.items():
+            started = time.perf_counter()
+            # A fresh report name each run, so a cached report is never reused
+            task.apply(args=(f"benchmark_{name}_{size}_{time.time_ns()}.pdf",)).get()
+            seconds = round(time.perf_counter() - started, 2)
+            results[f"task {name}"] = {"seconds": seconds}
+            print(f"  {'task ' + name:<34} {seconds:>9.2f} s")
+    return results
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compare results with a baseline run
+
+    Endpoints are compared on p95 latency, report tasks on their duration.
+
+    Args:
+        results: Results of this run, by size and measurement name
+        baseline: Results of the earlier run in the same format
+        threshold: Allowed slowdown as a fraction (0.2 means 20% slower)
+
+    Returns:
+        list: Descriptions of the measurements slower than allowed
+    """
+    regressions = []
+    for size, measurements in results.items():
+        for name, current in measurements.items():
+            previous = baseline.get(size, {}).get(name)
+            if not previous:
+                continue
+            metric = "p95_ms" if "p95_ms" in current else "seconds"
+            if current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(f"{size} rules, {name}: {metric} {previous[metric]} -> {current[metric]}")
+    return regressions
+
+
+def run_benchmark(sizes, requests, run_reports, database):
+    """
+    Seed a separate benchmark database at each size and measure it
+
+    Args:
+        sizes: Rule counts to benchmark, measured in increasing order
+        requests: Requests sent to each endpoint at each size
+        run_reports: Whether to also run the report tasks
+        database: SQLite file for the benchmark database; it is deleted afterwards
+
+    Returns:
+        dict: Results by size (as a string) and measurement name
+    """
+    setup_test_environment()
+    # Over-budget warnings from the timing middleware would drown the output
+    logging.getLogger("forwarding_rules.middleware").setLevel(logging.ERROR)
+    # Reports rendered by the benchmark go to a directory deleted afterwards
+    settings.REPORTS_DIR = tempfile.mkdtemp(prefix="benchmark_reports_")
+    connection.settings_dict.setdefault("TEST", {})["NAME"] = database
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        rule_repo, filter_repo = create_repositories()
+        client = Client()
+        results = {}
+        for size in sorted(sizes):
+            print(f"\n{size} rules:")
+            seed_rules(rule_repo, filter_repo, size)
+            results[str(size)] = benchmark_size(client, size, requests, run_reports)
+        return results
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(settings.REPORTS_DIR, ignore_errors=True)
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints and report tasks")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma-separated rule counts (default: 1000,10000,100000,1000000)")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS,
+                        help=f"Requests per endpoint and size (default: {DEFAULT_REQUESTS})")
+    parser.add_argument("--skip-reports", action="store_true", help="Do not run the report tasks")
+    parser.add_argument("--database", default=os.path.join(tempfile.gettempdir(), "benchmark.sqlite3"),
+                        help="SQLite file used for the benchmark database (deleted afterwards)")
+    parser.add_argument("--output", default="benchmark_results.json", help="File the JSON results are written to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Allowed slowdown against the baseline (default: {DEFAULT_THRESHOLD})")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run_benchmark(sizes, args.requests, not args.skip_reports, args.database)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "meta": {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "requests": args.requests,
+            },
+            "results": results,
+        }, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nSlower than {args.baseline} by more than {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'forwarding_rules.middleware.query_timing_middleware',
+    'forwarding_rules.middleware.replica_pin_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -60,17 +62,52 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'forwarding_audit.wsgi.application'
+ASGI_APPLICATION = 'forwarding_audit.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# SQLite concurrency mode: WAL journaling and tuned pragmas on every connection,
+# so report tasks can read while analysts write (see forwarding_rules/sqlite.py)
+SQLITE_CONCURRENT_MODE = os.environ.get('SQLITE_CONCURRENT_MODE', 'True').lower() == 'true'
+# Seconds a connection waits for a lock before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', '20'))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', str(64 * 1024)))
+# Times a write that still hits a lock is retried
+SQLITE_LOCK_RETRIES = int(os.environ.get('SQLITE_LOCK_RETRIES', '5'))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'email_forwarding.db',
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT,
+        },
     }
 }
 
+# Read replica: a second SQLite file kept in sync with the primary (e.g. with
+# litestream or sqlite3 .backup). Reports, statistics and rule listings in the
+# repository read from it; writes, and reads right after a write, use the primary.
+DATABASE_REPLICA_NAME = os.environ.get('DATABASE_REPLICA_NAME')
+if DATABASE_REPLICA_NAME:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_REPLICA_NAME,
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT,
+        },
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+
+DATABASE_ROUTERS = ['forwarding_rules.routers.PrimaryReplicaRouter']
+
+# Seconds reads stay on the primary after a write in the same request or task
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', '5'))
+
 # Repository Type Setting is no longer needed as we only use Django repository
 
 # Password validation
@@ -123,6 +160,71 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+# Mailbox replays start their own process pool, which prefork worker processes
+# cannot do, so they go to a queue served by a --pool=solo worker (celery-replay
+# in docker-compose.yml)
+CELERY_TASK_ROUTES = {
+    'forwarding_rules.tasks.simulate_mailbox_replay': {'queue': 'replay'},
+}
+
+# Cache Settings
+# Local memory by default; point CACHE_BACKEND/CACHE_LOCATION at Redis so the
+# web and Celery processes share cached statistics and the data version counter
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Whether every web and Celery process uses the same cache. The data version that
+# ETags and version-keyed results (statistics, reports, filter matcher, forwarding
+# graph) depend on lives in the cache, so a per-process cache would miss writes
+# made by other processes; without a shared cache these are recomputed every time.
+# Local memory is only shared when a single process serves everything.
+CACHE_SHARED = os.environ.get(
+    'CACHE_SHARED',
+    str(CACHES['default']['BACKEND'] not in (
+        'django.core.cache.backends.locmem.LocMemCache',
+        'django.core.cache.backends.dummy.DummyCache',
+    ))
+).lower() == 'true'
+
+# Seconds to keep cached statistics (they are also invalidated on every write)
+STATISTICS_CACHE_TIMEOUT = int(os.environ.get('STATISTICS_CACHE_TIMEOUT', '300'))
+
+# Seconds to remember a rendered report so identical requests reuse it while data is unchanged
+REPORT_CACHE_TIMEOUT = int(os.environ.get('REPORT_CACHE_TIMEOUT', '86400'))
+
+# Requests running more queries or taking longer than this are logged as warnings
+REQUEST_QUERY_BUDGET = int(os.environ.get('REQUEST_QUERY_BUDGET', '10'))
+REQUEST_TIME_BUDGET_MS = float(os.environ.get('REQUEST_TIME_BUDGET_MS', '500'))
+
+# Logging
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'forwarding_rules': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+# Our own mail domains (comma-separated); subdomains count as internal too.
+# Forwarding to any other domain is external.
+INTERNAL_DOMAINS = frozenset(
+    domain.strip().lower() for domain in os.environ.get('INTERNAL_DOMAINS', 'example.com').split(',') if domain.strip()
+)
+
+# Directory holding mbox files and .eml directories that can be replayed against the filters
+MAILBOX_DIR = os.environ.get('MAILBOX_DIR', os.path.join(BASE_DIR, 'mailboxes'))
 
 # PDF Reports directory
 REPORTS_DIR = os.path.join(BASE_DIR, 'reports')
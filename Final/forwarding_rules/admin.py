@@ -9,7 +9,7 @@ class ForwardingFilterInline(admin.TabularInline):
 class AutoForwardingAdmin(admin.ModelAdmin):
     list_display = ('email', 'name', 'forwarding_email', 'disposition', 'has_forwarding_filters')
     search_fields = ('email', 'name', 'forwarding_email')
-    list_filter = ('has_forwarding_filters', 'disposition')
+    list_filter = ('has_forwarding_filters', 'disposition', 'destination_domain')
     inlines = [ForwardingFilterInline]
 
 @admin.register(ForwardingFilter)
@@ -1,4 +1,11 @@
+import os
+from datetime import datetime, timezone as dt_timezone
 from typing import List, Optional, Dict, Any
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
 from ninja import NinjaAPI, Path
 from ninja.responses import Response
 
@@ -9,22 +16,55 @@ from .schemas import (
     ForwardingFilter,
     ForwardingFilterCreate,
     Error,
-    Message
+    Message,
+    BulkDeleteRequest,
+    BulkDeleteResult,
+    MessageHeaders,
+    FilterMatchResult,
+    ForwardingChain,
+    ForwardingLoop,
+    ExternalReach,
+    InboundForwards,
+    DestinationMatch,
+    InvestigationEvent,
+    DestinationStatistics
 )
-from .repository import create_repositories
+from .repository import create_repositories, get_joined_filter
+from .pagination import NEXT_CURSOR_HEADER, check_page, encode_cursor, decode_id_cursor, decode_risk_cursor
+from .export import EXPORT_CONTENT_TYPES, aiter_chunks, iter_ndjson, iter_csv
+from .serialization import FastJSONRenderer, rule_rows_to_dicts
+from .etags import data_etag, not_modified
+from .cache import shared_cache
+from .matching import get_filter_matcher
+from .graph import get_forwarding_graph
+from .domains import is_internal_domain
+from .routers import PRIMARY_DATABASE, read_database
 from .models import AutoForwarding as DjangoAutoForwarding
 from .models import ForwardingFilter as DjangoForwardingFilter
-from .tasks import generate_rules_report, generate_stats_report, generate_rules_only_report
+from .models import FilterTerm as DjangoFilterTerm
+from .tasks import (
+    generate_rules_report,
+    generate_rules_report_sharded,
+    generate_stats_report,
+    generate_rules_only_report,
+    simulate_mailbox_replay,
+    find_cached_report
+)
 
 # Create API instance
-api = NinjaAPI(title="Email Forwarding Rules Audit API")
+api = NinjaAPI(title="Email Forwarding Rules Audit API", renderer=FastJSONRenderer())
 
 # Create repositories
 rule_repo, filter_repo = create_repositories()
 
 # Helper function to convert database model to API schema
-def db_to_api_rule(db_rule, filter_obj=None) -> ForwardingRule:
-    """Convert database model to API schema"""
+def db_to_api_rule(db_rule) -> ForwardingRule:
+    """
+    Convert database model to API schema
+    
+    The rule must come from a repository method that joins its filter
+    (select_related), so reading it here never issues another query.
+    """
     data = {
         "id": db_rule.id,
         "email": db_rule.email,
@@ -34,18 +74,12 @@ def db_to_api_rule(db_rule, filter_obj=None) -> ForwardingRule:
         "has_forwarding_filters": db_rule.has_forwarding_filters,
         "error": db_rule.error,
         "investigation_note": db_rule.investigation_note,
+        "destination_domain": db_rule.destination_domain,
+        "risk_score": db_rule.risk_score,
     }
     
-    if filter_obj is None:
-        # Get filter for the rule
-        filters_list = filter_repo.get_filters_for_rule(data["id"])
-        if filters_list:
-            # Should be only one filter per rule
-            filter_obj = db_to_api_filter(filters_list[0])
-        else:
-            filter_obj = None
-    
-    data["filter"] = filter_obj
+    filter_obj = get_joined_filter(db_rule)
+    data["filter"] = db_to_api_filter(filter_obj) if filter_obj else None
     return ForwardingRule.model_validate(data)
 
 
@@ -63,73 +97,236 @@ def db_to_api_filter(db_filter) -> ForwardingFilter:
     return ForwardingFilter.model_validate(data)
 
 
+# Helper function to trim a page fetched with one extra row and set the next cursor
+def paginate_rules(rows: List[Dict[str, Any]], limit: int, response: HttpResponse,
+                   key: tuple = ("id",)) -> List[Dict[str, Any]]:
+    """
+    Trim a page of rule rows fetched with `limit + 1` rows
+    
+    If the extra row is present there is another page, and the cursor for it
+    (the `key` fields of the last row) is returned in the X-Next-Cursor
+    response header.
+    """
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response[NEXT_CURSOR_HEADER] = encode_cursor(*(rows[-1][field] for field in key))
+    return rows
+
+
+# Helper function to send rule rows without validating them again
+def rule_rows_response(request, rows: List[Dict[str, Any]], response: HttpResponse) -> HttpResponse:
+    """
+    Render rule rows from the repository straight to JSON
+    
+    The rows come from the database in the ForwardingRule shape, so the
+    response schema is only used for the API documentation and the rows
+    skip pydantic validation.
+    """
+    return api.create_response(request, rule_rows_to_dicts(rows), temporal_response=response)
+
+
+# Helper function for conditional GETs on data that only changes with rule or filter writes
+async def check_etag(request, response: HttpResponse, *parts, replica: bool = False) -> Optional[HttpResponse]:
+    """
+    Answer a matching If-None-Match with 304, or set the ETag on `response`
+    
+    Returns the 304 response, or None when the full response must be sent.
+    Call this before reading the data, so the ETag never claims newer data
+    than the body holds. No ETag is used without a shared cache, whose
+    data version would miss writes made by other processes. Endpoints
+    reading from read_database() pass `replica=True`: while their reads go
+    to the replica no ETag is used either, as the data version counts
+    writes the replica may not hold yet.
+    """
+    if not shared_cache() or (replica and read_database() != PRIMARY_DATABASE):
+        return None
+    etag = await sync_to_async(data_etag)(*parts)
+    cached = not_modified(request, etag)
+    if cached is None:
+        response["ETag"] = etag
+    return cached
+
+
 @api.get("/rules/", response=List[ForwardingRule], tags=["rules"])
-def get_all_rules(request, skip: int = 0, limit: int = 100):
-    """Get all forwarding rules with pagination"""
-    # Get rules from repository
-    rules = rule_repo.get_all_rules(skip, limit)
+async def get_all_rules(request, response: HttpResponse, skip: int = 0, limit: int = 100, after: Optional[str] = None,
+                        order: str = "id"):
+    """
+    Get all forwarding rules with pagination
+    
+    Rules are ordered by ID, or with `order=-risk` by risk score, highest
+    first. Pass the X-Next-Cursor header of a response as `after` to fetch
+    the next page; this keyset pagination stays fast on deep pages, unlike
+    `skip`.
+    """
+    if order not in ("id", "-risk"):
+        return Response({"detail": "order must be id or -risk"}, status=400)
+    try:
+        check_page(limit, skip)
+        after_key = decode_risk_cursor(after) if order == "-risk" else decode_id_cursor(after)
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=400)
+    
+    cached = await check_etag(request, response, "rules", order, replica=True)
+    if cached:
+        return cached
+    
+    # Get rule rows from repository (one extra row tells us if there is a next page)
+    if order == "-risk":
+        rows = await rule_repo.aget_rule_rows_by_risk(skip, limit + 1, after=after_key)
+        rows = paginate_rules(rows, limit, response, key=("risk_score", "id"))
+    else:
+        rows = await rule_repo.aget_rule_rows(skip, limit + 1, after=after_key)
+        rows = paginate_rules(rows, limit, response)
     
-    # Convert to API schemas
-    return [db_to_api_rule(rule) for rule in rules]
+    return rule_rows_response(request, rows, response)
+
+
+# Registered before /rules/{rule_id} so "bulk-delete" is not taken for a rule ID
+@api.post("/rules/bulk-delete", response={200: BulkDeleteResult, 400: Error}, tags=["rules"])
+async def bulk_delete_rules(request, payload: BulkDeleteRequest):
+    """
+    Delete many forwarding rules and their filters in a single transaction
+    
+    Rules are selected by `ids`, by the `email`/`has_filters` search
+    predicate, or by both. Every requested ID is reported as "deleted" or
+    "not_found"; without `ids`, every deleted rule is reported.
+    """
+    if payload.ids is None and not payload.email and payload.has_filters is None:
+        return 400, {"detail": "Provide ids or a search predicate (email, has_filters)"}
+    
+    deleted_ids = await rule_repo.abulk_delete_rules(payload.ids, payload.email, payload.has_filters)
+    
+    if payload.ids is None:
+        results = [{"id": rule_id, "status": "deleted"} for rule_id in deleted_ids]
+    else:
+        deleted = set(deleted_ids)
+        results = [
+            {"id": rule_id, "status": "deleted" if rule_id in deleted else "not_found"}
+            for rule_id in dict.fromkeys(payload.ids)
+        ]
+    
+    return {"deleted": len(deleted_ids), "results": results}
 
 
 @api.get("/rules/{rule_id}", response=ForwardingRule, tags=["rules"])
-def get_rule(request, rule_id: int = Path(...)):
-    """Get a specific forwarding rule by ID"""
+async def get_rule(request, response: HttpResponse, rule_id: int = Path(...)):
+    """
+    Get a specific forwarding rule by ID
+    
+    Responses carry an ETag; send it back in If-None-Match to get a 304
+    while no rule or filter has changed.
+    """
+    cached = await check_etag(request, response, "rule", rule_id)
+    if cached:
+        return cached
+    
     # Get rule from repository
-    rule = rule_repo.get_rule_by_id(rule_id)
+    rule = await rule_repo.aget_rule_by_id(rule_id)
     if not rule:
         return Response({"detail": "Rule not found"}, status=404)
     
-    # Get filter for the rule
-    filters = filter_repo.get_filters_for_rule(rule_id)
-    filter_obj = filters[0] if filters else None
-    
-    # Convert to API schema
-    return db_to_api_rule(rule, db_to_api_filter(filter_obj) if filter_obj else None)
+    # Convert to API schema (the filter is joined by the repository)
+    return db_to_api_rule(rule)
 
 
 @api.put("/rules/{rule_id}/investigation", response=ForwardingRule, tags=["rules"])
-def update_investigation_note(request, rule_id: int, update: ForwardingRuleUpdate):
-    """Update the investigation note for a forwarding rule"""
+async def update_investigation_note(request, rule_id: int, update: ForwardingRuleUpdate):
+    """
+    Update the investigation note and/or disposition for a forwarding rule
+    
+    Every change is appended to the rule's investigation history
+    (GET /rules/{rule_id}/history) in the same transaction.
+    """
     try:
-        # Check if rule exists
-        rule = rule_repo.get_rule_by_id(rule_id)
-        if not rule:
-            return Response({"detail": "Rule not found"}, status=404)
-        
         # Prepare update data
         updates = {}
         if update.investigation_note is not None:
             updates["investigation_note"] = update.investigation_note
+        if update.disposition is not None:
+            updates["disposition"] = update.disposition
         
-        # Update rule in repository
+        # Update rule in repository (None if the rule does not exist)
         if updates:
-            updated_rule = rule_repo.update_rule(rule_id, updates)
-            if not updated_rule:
-                return Response({"detail": "Failed to update rule"}, status=500)
+            rule = await rule_repo.aupdate_rule(rule_id, updates)
+        else:
+            rule = await rule_repo.aget_rule_by_id(rule_id)
+        if not rule:
+            return Response({"detail": "Rule not found"}, status=404)
         
         # Return updated rule
-        return db_to_api_rule(rule if not updates else updated_rule)
+        return db_to_api_rule(rule)
     
     except Exception as e:
         # Handle errors
         return Response({"detail": f"Error updating rule: {str(e)}"}, status=500)
 
 
+@api.get("/rules/{rule_id}/history", response={200: List[InvestigationEvent], 400: Error}, tags=["history"])
+async def get_rule_history(request, response: HttpResponse, rule_id: int, limit: int = 100, after: Optional[str] = None):
+    """
+    Get the investigation timeline of a rule, oldest first
+    
+    Lists every recorded change to the rule's investigation note and
+    disposition, also after the rule is deleted. Paged with the
+    X-Next-Cursor cursor, as GET /rules/.
+    """
+    try:
+        check_page(limit)
+        after_key = decode_id_cursor(after)
+    except ValueError as e:
+        return 400, {"detail": str(e)}
+    
+    cached = await check_etag(request, response, "history", rule_id)
+    if cached:
+        return cached
+    
+    rows = await rule_repo.aget_rule_history(rule_id, after=after_key, limit=limit + 1)
+    return paginate_rules(rows, limit, response)
+
+
+@api.get("/history/", response={200: List[InvestigationEvent], 400: Error}, tags=["history"])
+async def get_history_since(request, response: HttpResponse, since: datetime, until: Optional[datetime] = None,
+                            limit: int = 100, after: Optional[str] = None):
+    """
+    Get the investigation changes of all rules since a time, oldest first
+    
+    `since` (inclusive) and `until` (exclusive) are ISO 8601 times; times
+    without a zone are UTC. Paged with the X-Next-Cursor cursor, as
+    GET /rules/, so a quarter of changes can be replayed page by page;
+    pages follow the order the changes were committed in, so a change
+    committed after its page was read still comes on a later page.
+    """
+    try:
+        check_page(limit)
+        after_key = decode_id_cursor(after)
+    except ValueError as e:
+        return 400, {"detail": str(e)}
+    
+    cached = await check_etag(request, response, "history")
+    if cached:
+        return cached
+    
+    since, until = (
+        moment if moment is None or timezone.is_aware(moment) else timezone.make_aware(moment, dt_timezone.utc)
+        for moment in (since, until)
+    )
+    rows = await rule_repo.aget_history_since(since, until, after=after_key, limit=limit + 1)
+    return paginate_rules(rows, limit, response)
+
+
 @api.delete("/rules/{rule_id}", response={204: None}, tags=["rules"])
-def delete_rule(request, rule_id: int):
+async def delete_rule(request, rule_id: int):
     """Delete a forwarding rule"""
     # Check if rule exists
-    rule = rule_repo.get_rule_by_id(rule_id)
+    rule = await rule_repo.aget_rule_by_id(rule_id)
     if not rule:
         return Response({"detail": "Rule not found"}, status=404)
     
     # Delete filter for the rule
-    filter_repo.delete_filters_for_rule(rule_id)
+    await filter_repo.adelete_filters_for_rule(rule_id)
     
     # Delete the rule
-    success = rule_repo.delete_rule(rule_id)
+    success = await rule_repo.adelete_rule(rule_id)
     if not success:
         return Response({"detail": "Failed to delete rule"}, status=500)
     
@@ -137,70 +334,348 @@ def delete_rule(request, rule_id: int):
 
 
 @api.get("/rules/search/", response=List[ForwardingRule], tags=["rules"])
-def search_rules(request, email: Optional[str] = None, has_filters: Optional[bool] = None):
-    """Search rules with filters"""
-    # Search rules in repository
-    rules = rule_repo.search_rules(email, has_filters)
+async def search_rules(request, response: HttpResponse, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                       limit: Optional[int] = None, after: Optional[str] = None,
+                       destination_domain: Optional[str] = None, external: Optional[bool] = None):
+    """
+    Search rules with filters
+    
+    All matches are returned unless `limit` is given, in which case results
+    are paged by ID with the same cursor scheme as GET /rules/.
+    `destination_domain` selects rules forwarding to that exact domain;
+    `external=true` selects rules forwarding outside INTERNAL_DOMAINS and
+    `external=false` rules forwarding inside them.
+    """
+    try:
+        check_page(limit)
+        after_id = decode_id_cursor(after)
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=400)
+    
+    # Search rule rows in repository
+    destination = {"destination_domain": destination_domain, "external": external}
+    if limit is None:
+        rows = await rule_repo.asearch_rule_rows(email, has_filters, after=after_id, **destination)
+    else:
+        rows = await rule_repo.asearch_rule_rows(email, has_filters, after=after_id, limit=limit + 1, **destination)
+        rows = paginate_rules(rows, limit, response)
     
-    # Convert to API schemas
-    return [db_to_api_rule(rule) for rule in rules]
+    return rule_rows_response(request, rows, response)
 
 
 @api.get("/stats/", response=Dict[str, int], tags=["statistics"])
-def get_statistics(request):
+async def get_statistics(request, response: HttpResponse):
     """Get statistics about forwarding rules"""
+    cached = await check_etag(request, response, "stats", replica=True)
+    if cached:
+        return cached
+    
     # Get statistics from repository
-    return rule_repo.get_statistics()
+    return await rule_repo.aget_statistics()
+
+
+@api.get("/stats/destinations", response=DestinationStatistics, tags=["statistics"])
+async def get_destination_statistics(request, response: HttpResponse, limit: int = 50):
+    """
+    Count rules forwarding inside and outside our domains
+    
+    Counts come from one GROUP BY over the indexed destination domain and
+    are cached until rules change. `domains` lists the `limit` domains
+    with the most rules forwarding to them.
+    """
+    cached = await check_etag(request, response, "stats", "destinations", replica=True)
+    if cached:
+        return cached
+    
+    counts = await rule_repo.aget_destination_domain_counts()
+    domains = [
+        {"domain": domain, "rules": rules, "internal": is_internal_domain(domain)}
+        for domain, rules in counts if domain is not None
+    ]
+    return {
+        "internal": sum(item["rules"] for item in domains if item["internal"]),
+        "external": sum(item["rules"] for item in domains if not item["internal"]),
+        "no_forwarding": sum(rules for domain, rules in counts if domain is None),
+        "domains": domains[:limit],
+    }
+
+
+@api.get("/destinations/", response={200: List[DestinationMatch], 400: Error}, tags=["rules"])
+async def get_rules_forwarding_to(request, response: HttpResponse, address: Optional[str] = None,
+                                  domain: Optional[str] = None, limit: int = 100, after: Optional[str] = None):
+    """
+    Find the rules forwarding to an address, or to any address of a domain
+    
+    Matches both forwarding_email and the forward action of the rule's
+    filter (`source` is "rule" or "filter"), from an indexed lookup table.
+    Results are paged by match ID with the same cursor scheme as GET /rules/.
+    """
+    if (address is None) == (domain is None):
+        return 400, {"detail": "Provide either address or domain"}
+    try:
+        check_page(limit)
+        after_id = decode_id_cursor(after)
+    except ValueError as e:
+        return 400, {"detail": str(e)}
+    
+    cached = await check_etag(request, response, "destinations")
+    if cached:
+        return cached
+    
+    rows = await rule_repo.aget_rules_forwarding_to(address, domain, after=after_id, limit=limit + 1)
+    return paginate_rules(rows, limit, response)
 
 
 @api.get("/rules/{rule_id}/filter", response=ForwardingFilter, tags=["filters"])
-def get_rule_filter(request, rule_id: int):
+async def get_rule_filter(request, response: HttpResponse, rule_id: int):
     """Get the filter for a specific forwarding rule"""
+    cached = await check_etag(request, response, "filter", rule_id)
+    if cached:
+        return cached
+    
     # Check if rule exists
-    rule = rule_repo.get_rule_by_id(rule_id)
+    rule = await rule_repo.aget_rule_by_id(rule_id)
     if not rule:
         return Response({"detail": "Rule not found"}, status=404)
     
-    # Get filter for the rule
-    filters = filter_repo.get_filters_for_rule(rule_id)
-    if not filters:
+    # Get filter for the rule (joined by the repository)
+    filter_obj = get_joined_filter(rule)
+    if not filter_obj:
         return Response({"detail": "Filter not found"}, status=404)
     
     # Convert to API schema
-    return db_to_api_filter(filters[0])
+    return db_to_api_filter(filter_obj)
+
+
+@api.post("/filters/match", response=FilterMatchResult, tags=["filters"])
+async def match_filters(request, message: MessageHeaders):
+    """
+    Find the forwarding filters that would fire for a message
+    
+    Every filter's criteria are compiled into an index once per data
+    change, so checking a message takes well under a millisecond however
+    many filters exist. Returns the matching filters, their rules and the
+    addresses the message would be forwarded to.
+    """
+    matcher = await sync_to_async(get_filter_matcher)(filter_repo)
+    matches = matcher.match(message.sender, message.to, message.subject, message.has_attachment, message.size)
+    
+    return {
+        "matched": len(matches),
+        "forward_targets": list(dict.fromkeys(target for match in matches for target in match.forward_targets)),
+        "matches": [
+            {
+                "filter_id": match.filter_id,
+                "rule_id": match.rule_id,
+                "email": match.email,
+                "criteria": match.criteria,
+                "action": match.action,
+                "forward_targets": match.forward_targets,
+            }
+            for match in matches
+        ],
+    }
+
+
+@api.get("/filters/search", response={200: List[ForwardingFilter], 400: Error}, tags=["filters"])
+async def search_filters(request, response: HttpResponse, limit: int = 100, after: Optional[str] = None):
+    """
+    Find filters by criteria and action values
+    
+    Pass `criteria.<key>=<value>` and `action.<key>=<value>` query
+    parameters, e.g. `?criteria.from=ceo@example.com&action.addLabels=TRASH`;
+    a filter must have all of them. Values match exactly, ignoring case, and
+    match any item of a list. Served by an index of every criteria and action
+    value; results are paged by filter ID with the same cursor scheme as
+    GET /rules/.
+    """
+    terms = [
+        (kind, key, value)
+        for name, values in request.GET.lists()
+        for kind, _, key in [name.partition(".")]
+        if kind in (DjangoFilterTerm.CRITERIA, DjangoFilterTerm.ACTION) and key
+        for value in values
+    ]
+    if not terms:
+        return 400, {"detail": "Provide at least one criteria.<key> or action.<key> parameter"}
+    try:
+        check_page(limit)
+        after_id = decode_id_cursor(after)
+    except ValueError as e:
+        return 400, {"detail": str(e)}
+    
+    cached = await check_etag(request, response, "filters")
+    if cached:
+        return cached
+    
+    rows = await filter_repo.asearch_filters(terms, after=after_id, limit=limit + 1)
+    return paginate_rules(rows, limit, response)
+
+
+# Graph analyses run in a worker thread: building or refreshing the graph reads the
+# database, and the first analysis after a change walks the whole graph
+@api.get("/graph/chains", response=List[ForwardingChain], tags=["graph"])
+async def get_forwarding_chains(request, response: HttpResponse, min_hops: int = 2, limit: int = 100):
+    """
+    Find chains of forwards through several mailboxes
+    
+    Each chain starts at a mailbox nothing forwards to and follows the
+    forwards of rules and filters until they end. `external` is true when
+    the chain ends outside our domains.
+    """
+    cached = await check_etag(request, response, "graph", "chains")
+    if cached:
+        return cached
+    
+    return await sync_to_async(lambda: get_forwarding_graph(rule_repo).chains(min_hops, limit))()
+
+
+@api.get("/graph/loops", response=List[ForwardingLoop], tags=["graph"])
+async def get_forwarding_loops(request, response: HttpResponse, limit: int = 100):
+    """Find groups of mailboxes that forward to each other, largest first"""
+    cached = await check_etag(request, response, "graph", "loops")
+    if cached:
+        return cached
+    
+    return await sync_to_async(lambda: get_forwarding_graph(rule_repo).loops(limit))()
+
+
+@api.get("/graph/external-reach", response=List[ExternalReach], tags=["graph"])
+async def get_external_reach(request, response: HttpResponse, min_hops: int = 1, limit: int = 100):
+    """
+    Find internal mailboxes whose mail reaches external domains
+    
+    Follows forwards transitively, so a mailbox forwarding to a colleague
+    who forwards outside is listed with `hops` 2. Pass `min_hops=2` to list
+    only mailboxes that reach outside through another mailbox.
+    """
+    cached = await check_etag(request, response, "graph", "external-reach")
+    if cached:
+        return cached
+    
+    return await sync_to_async(lambda: get_forwarding_graph(rule_repo).external_reach(min_hops, limit))()
+
+
+@api.get("/graph/top-inbound", response=List[InboundForwards], tags=["graph"])
+async def get_top_inbound(request, response: HttpResponse, limit: int = 20):
+    """Find the addresses the most mailboxes forward to"""
+    cached = await check_etag(request, response, "graph", "top-inbound")
+    if cached:
+        return cached
+    
+    return await sync_to_async(lambda: get_forwarding_graph(rule_repo).top_inbound(limit))()
+
+
+@api.get("/export/rules", tags=["export"])
+async def export_rules(request, format: str = "ndjson"):
+    """
+    Stream every forwarding rule with its filter as NDJSON or CSV
+    
+    Rules are read from the database in chunks while the response is being
+    sent, so memory use stays flat regardless of how many rules exist.
+    Under ASGI the chunks are served from an async iterator, as Django
+    would otherwise read a synchronous one to the end before sending it.
+    """
+    if format not in EXPORT_CONTENT_TYPES:
+        return Response({"detail": f"Unsupported export format: {format}"}, status=400)
+    
+    rules = rule_repo.iter_rules_with_filters()
+    chunks = iter_ndjson(rules) if format == "ndjson" else iter_csv(rules)
+    if isinstance(request, ASGIRequest):
+        chunks = aiter_chunks(chunks)
+    
+    response = StreamingHttpResponse(chunks, content_type=EXPORT_CONTENT_TYPES[format])
+    response["Content-Disposition"] = f'attachment; filename="forwarding_rules.{format}"'
+    return response
+
+
+# Helper function to skip dispatching a report that was already rendered from the same data
+async def cached_report_message(report_type: str, report_name: Optional[str]) -> Optional[Dict[str, str]]:
+    """Return a response message for an up-to-date existing report, or None"""
+    fingerprint = await rule_repo.aget_data_fingerprint()
+    report_path = await sync_to_async(find_cached_report)(report_type, report_name, fingerprint)
+    if report_path:
+        return {"message": f"Report is up to date, data unchanged since it was generated: {report_path}"}
+    return None
 
 
 @api.post("/reports/generate", response={200: Message}, tags=["reports"])
-def generate_full_report_api(request, report_name: str = None):
+async def generate_full_report_api(request, report_name: str = None, shards: int = None):
     """
     Generate a PDF report of all forwarding rules
     
     This operation is asynchronous and will return immediately.
-    The report will be generated in the background.
+    The report will be generated in the background. With `shards` greater
+    than 1, the rules are split into that many ID ranges rendered by parallel
+    Celery tasks and merged into one PDF.
+    
+    If the same report was already generated and no rule or filter changed
+    since, its path is returned instead of generating it again.
     """
-    task = generate_rules_report.delay(report_name)
+    cached = await cached_report_message("full", report_name)
+    if cached:
+        return cached
+    
+    if shards and shards > 1:
+        task = await sync_to_async(generate_rules_report_sharded.delay)(report_name, shards)
+        return {"message": f"Sharded report generation started (task id: {task.id})"}
+    
+    task = await sync_to_async(generate_rules_report.delay)(report_name)
     return {"message": f"Report generation started (task id: {task.id})"}
 
 
 @api.post("/reports/stats", response={200: Message}, tags=["reports"])
-def generate_stats_report_api(request, report_name: str = None):
+async def generate_stats_report_api(request, report_name: str = None):
     """
     Generate a PDF report containing only statistics about forwarding rules
     
     This operation is asynchronous and will return immediately.
-    The report will be generated in the background.
+    The report will be generated in the background, unless an identical
+    report generated from unchanged data already exists.
     """
-    task = generate_stats_report.delay(report_name)
+    cached = await cached_report_message("stats", report_name)
+    if cached:
+        return cached
+    
+    task = await sync_to_async(generate_stats_report.delay)(report_name)
     return {"message": f"Statistics report generation started (task id: {task.id})"}
 
 
 @api.post("/reports/rules-only", response={200: Message}, tags=["reports"])
-def generate_rules_only_report_api(request, report_name: str = None):
+async def generate_rules_only_report_api(request, report_name: str = None):
     """
     Generate a PDF report of all forwarding rules without filter details
     
     This operation is asynchronous and will return immediately.
-    The report will be generated in the background.
+    The report will be generated in the background, unless an identical
+    report generated from unchanged data already exists.
+    """
+    cached = await cached_report_message("rules_only", report_name)
+    if cached:
+        return cached
+    
+    task = await sync_to_async(generate_rules_only_report.delay)(report_name)
+    return {"message": f"Rules-only report generation started (task id: {task.id})"} 
+
+
+@api.post("/simulations/replay", response={200: Message, 400: Error}, tags=["simulations"])
+async def replay_mailbox_api(request, mailbox: str, processes: int = None):
+    """
+    Replay a mailbox against every forwarding filter
+    
+    `mailbox` is an mbox file or a directory of .eml files inside the
+    MAILBOX_DIR directory; `processes` is at least 1, and the worker uses
+    at most one per CPU. This operation is asynchronous and will return
+    immediately; the counts of messages that would have been forwarded, by
+    rule and destination, are written as JSON to the reports directory.
     """
-    task = generate_rules_only_report.delay(report_name)
-    return {"message": f"Rules-only report generation started (task id: {task.id})"} 
\ No newline at end of file
+    mailbox_dir = os.path.realpath(settings.MAILBOX_DIR)
+    mailbox_path = os.path.realpath(os.path.join(mailbox_dir, mailbox))
+    if os.path.commonpath([mailbox_dir, mailbox_path]) != mailbox_dir or not os.path.exists(mailbox_path):
+        return 400, {"detail": f"Mailbox not found in {settings.MAILBOX_DIR}: {mailbox}"}
+    # The worker holds the pool to its own CPU count
+    if processes is not None and processes < 1:
+        return 400, {"detail": "processes must be at least 1"}
+    
+    task = await sync_to_async(simulate_mailbox_replay.delay)(mailbox_path, processes)
+    return {"message": f"Mailbox replay started (task id: {task.id})"}
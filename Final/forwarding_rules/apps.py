@@ -3,4 +3,8 @@ from django.apps import AppConfig
 
 class ForwardingRulesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'forwarding_rules' 
\ No newline at end of file
+    name = 'forwarding_rules'
+
+    def ready(self):
+        # Connect signal handlers that keep cached data in sync
+        from . import signals  # noqa: F401
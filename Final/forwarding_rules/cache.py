@@ -0,0 +1,129 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Optional, Set
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .routers import pin_to_primary
+
+
+# Cache key holding the change counter for AutoForwarding and ForwardingFilter rows
+DATA_VERSION_KEY = "forwarding_rules:data_version"
+
+# Cache key prefix of the IDs of the rules changed by each data version
+CHANGED_RULES_KEY = "forwarding_rules:changed_rules"
+
+# Seconds a data version remembers its changed rules, and the most versions
+# get_changed_rules() looks back; consumers further behind start over
+CHANGE_LOG_TIMEOUT = 3600
+CHANGE_LOG_MAX_VERSIONS = 1000
+
+# Set while bulk writes are running, so per-row signals do not bump the version
+_invalidation_deferred = ContextVar("invalidation_deferred", default=False)
+
+
+def shared_cache() -> bool:
+    """
+    Check whether every web and Celery process uses the same cache (CACHE_SHARED)
+
+    The data version lives in the cache. With a per-process cache a write
+    handled by one process does not change the version the others see, so
+    ETags and results kept under the data version must not be used.
+    """
+    return settings.CACHE_SHARED
+
+
+def get_data_version() -> int:
+    """
+    Get the current data version
+
+    The version changes every time a rule or filter is written. It is seeded
+    from the clock so that a flushed cache never hands out an old version again.
+    """
+    version = cache.get(DATA_VERSION_KEY)
+    if version is None:
+        cache.add(DATA_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(DATA_VERSION_KEY, time.time_ns())
+    return version
+
+
+def bump_data_version(rule_ids: Optional[Iterable[int]] = None):
+    """
+    Mark rule and filter data as changed
+
+    The version is bumped immediately and again once the surrounding
+    transaction commits, so a reader that cached results computed before
+    the commit cannot keep serving them. Reads in the current context are
+    pinned to the primary database so they see the change.
+
+    Args:
+        rule_ids: IDs of the rules whose rule or filter rows changed, recorded
+            for get_changed_rules(); None when they are not known
+    """
+    pin_to_primary()
+    if _invalidation_deferred.get():
+        return
+    rule_ids = sorted(rule_ids) if rule_ids is not None else None
+    _increment_data_version(rule_ids)
+    transaction.on_commit(lambda: _increment_data_version(rule_ids))
+
+
+def get_changed_rules(since_version: int, version: int) -> Optional[Set[int]]:
+    """
+    Get the IDs of the rules changed after `since_version`, up to `version`
+
+    Returns:
+        set: The changed rule IDs, or None when they are not all known (a
+            write did not record them, the log expired, or the versions are
+            too far apart); the caller must then assume every rule changed
+    """
+    if not since_version < version <= since_version + CHANGE_LOG_MAX_VERSIONS:
+        return set() if version == since_version else None
+    keys = [f"{CHANGED_RULES_KEY}:{number}" for number in range(since_version + 1, version + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) != len(keys):
+        return None
+    return set().union(*changes.values())
+
+
+def in_bulk_invalidation() -> bool:
+    """Check whether a bulk_invalidation() block is running in the current context"""
+    return _invalidation_deferred.get()
+
+
+@contextmanager
+def bulk_invalidation():
+    """
+    Bump the data version once for a block of bulk writes
+
+    Row-level signal handlers inside the block are ignored, so deleting
+    thousands of rows does not touch the cache thousands of times. Add the
+    IDs of the changed rules to the yielded set; if none are added, every
+    rule counts as changed.
+    """
+    changed_rules = set()
+    token = _invalidation_deferred.set(True)
+    try:
+        yield changed_rules
+    finally:
+        _invalidation_deferred.reset(token)
+        bump_data_version(changed_rules or None)
+
+
+def versioned_key(name: str) -> str:
+    """Build a cache key that is only valid for the current data version"""
+    return f"forwarding_rules:{name}:{get_data_version()}"
+
+
+def _increment_data_version(rule_ids: Optional[list] = None):
+    """Increment the data version, seeding it if it is missing, and record the changed rules"""
+    try:
+        version = cache.incr(DATA_VERSION_KEY)
+    except ValueError:
+        cache.add(DATA_VERSION_KEY, time.time_ns(), timeout=None)
+        return
+    if rule_ids is not None:
+        cache.set(f"{CHANGED_RULES_KEY}:{version}", rule_ids, CHANGE_LOG_TIMEOUT)
@@ -0,0 +1,39 @@
+from typing import Any, Dict, Iterable, List, Optional
+
+from .domains import address_domain
+from .models import ForwardingDestination
+
+
+def normalize_address(address: Any) -> Optional[str]:
+    """Lower-case, trimmed email address, or None if it is empty or not a string"""
+    if not isinstance(address, str) or not address.strip():
+        return None
+    return address.strip().lower()
+
+
+def action_forward_targets(action: Any) -> List[str]:
+    """Addresses a filter action forwards to, normalized and each listed once"""
+    forward = action.get("forward") if isinstance(action, dict) else None
+    if not forward:
+        return []
+    targets = forward if isinstance(forward, list) else [forward]
+    return list(dict.fromkeys(filter(None, map(normalize_address, targets))))
+
+
+def replace_destinations(targets_by_rule: Dict[int, Iterable[str]], source: str):
+    """
+    Replace the destination rows of one source for many rules
+
+    Args:
+        targets_by_rule: Target addresses keyed by rule ID; an empty list
+            removes the rule's rows for this source
+        source: ForwardingDestination.RULE or ForwardingDestination.FILTER
+    """
+    if not targets_by_rule:
+        return
+    ForwardingDestination.objects.filter(forwarding_id__in=list(targets_by_rule), source=source).delete()
+    ForwardingDestination.objects.bulk_create([
+        ForwardingDestination(forwarding_id=rule_id, address=address, domain=address_domain(address), source=source)
+        for rule_id, targets in targets_by_rule.items()
+        for address in dict.fromkeys(filter(None, map(normalize_address, targets)))
+    ], batch_size=2000)
@@ -0,0 +1,34 @@
+from typing import Optional
+
+from django.conf import settings
+from django.db.models import Q
+
+
+def address_domain(address: Optional[str]) -> Optional[str]:
+    """Lower-case domain of an email address, or None if it has none"""
+    if not address or "@" not in address:
+        return None
+    domain = address.strip().rpartition("@")[2].strip().rstrip(".").lower()
+    return domain or None
+
+
+def is_internal_domain(domain: Optional[str]) -> bool:
+    """Check whether a domain, or a domain it is a subdomain of, is in INTERNAL_DOMAINS"""
+    while domain:
+        if domain in settings.INTERNAL_DOMAINS:
+            return True
+        domain = domain.partition(".")[2]
+    return False
+
+
+def internal_domain_q(field: str) -> Q:
+    """Condition on a lower-case domain column matching INTERNAL_DOMAINS or one of their subdomains"""
+    condition = Q(pk__in=[])
+    for domain in settings.INTERNAL_DOMAINS:
+        condition |= Q(**{field: domain}) | Q(**{f"{field}__endswith": f".{domain}"})
+    return condition
+
+
+def is_internal_address(address: Optional[str]) -> bool:
+    """Check whether an email address belongs to one of our own domains"""
+    return is_internal_domain(address_domain(address))
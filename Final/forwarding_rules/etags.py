@@ -0,0 +1,36 @@
+from django.http import HttpRequest, HttpResponseNotModified
+from django.utils.cache import parse_etags, quote_etag
+
+from .cache import get_data_version
+
+
+def data_etag(*parts) -> str:
+    """
+    Build a strong ETag that is valid until the next rule or filter write
+
+    The data version is read before the response data, so a write that lands
+    in between produces a newer ETag on the next request instead of pairing
+    an old ETag with new data.
+
+    Args:
+        parts: Values identifying the representation (e.g. "rule" and its ID)
+
+    Returns:
+        str: Quoted ETag value
+    """
+    return quote_etag("-".join(str(part) for part in (*parts, get_data_version())))
+
+
+def not_modified(request: HttpRequest, etag: str):
+    """
+    Return a 304 response if the request's If-None-Match matches `etag`, else None
+    """
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return None
+    etags = parse_etags(header)
+    if "*" in etags or etag in etags:
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+    return None
@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator
+
+from asgiref.sync import sync_to_async
+
+from .repository import get_joined_filter
+
+
+# Supported export formats and their content types
+EXPORT_CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# Column order for CSV exports
+CSV_COLUMNS = [
+    "id",
+    "email",
+    "name",
+    "forwarding_email",
+    "disposition",
+    "has_forwarding_filters",
+    "error",
+    "investigation_note",
+    "filter_id",
+    "filter_criteria",
+    "filter_action",
+    "filter_created_at",
+]
+
+# Number of rows written into each chunk sent to the client
+ROWS_PER_CHUNK = 500
+
+
+def rule_to_export_dict(rule) -> Dict[str, Any]:
+    """
+    Convert a rule with its joined filter into a plain dictionary
+
+    Args:
+        rule: AutoForwarding instance loaded with its filter
+
+    Returns:
+        dict: Rule fields plus a nested "filter" dictionary (or None)
+    """
+    filter_obj = get_joined_filter(rule)
+    return {
+        "id": rule.id,
+        "email": rule.email,
+        "name": rule.name,
+        "forwarding_email": rule.forwarding_email,
+        "disposition": rule.disposition,
+        "has_forwarding_filters": rule.has_forwarding_filters,
+        "error": rule.error,
+        "investigation_note": rule.investigation_note,
+        "filter": {
+            "id": filter_obj.id,
+            "criteria": filter_obj.criteria,
+            "action": filter_obj.action,
+            "created_at": filter_obj.created_at,
+        } if filter_obj else None,
+    }
+
+
+def iter_ndjson(rules: Iterable) -> Iterator[str]:
+    """
+    Stream rules as newline-delimited JSON, one rule per line
+
+    Args:
+        rules: Iterable of rules loaded with their filters
+
+    Yields:
+        str: Chunks of NDJSON text
+    """
+    lines = []
+    for rule in rules:
+        lines.append(json.dumps(rule_to_export_dict(rule)) + "\n")
+        if len(lines) >= ROWS_PER_CHUNK:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def iter_csv(rules: Iterable) -> Iterator[str]:
+    """
+    Stream rules as CSV with a header row; filter criteria and action are JSON encoded
+
+    Args:
+        rules: Iterable of rules loaded with their filters
+
+    Yields:
+        str: Chunks of CSV text
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+
+    rows = 0
+    for rule in rules:
+        data = rule_to_export_dict(rule)
+        filter_data = data.pop("filter") or {}
+        writer.writerow([
+            *data.values(),
+            filter_data.get("id"),
+            json.dumps(filter_data["criteria"]) if filter_data else None,
+            json.dumps(filter_data["action"]) if filter_data else None,
+            filter_data.get("created_at"),
+        ])
+        rows += 1
+        if rows % ROWS_PER_CHUNK == 0:
+            yield _drain(buffer)
+
+    chunk = _drain(buffer)
+    if chunk:
+        yield chunk
+
+
+async def aiter_chunks(chunks: Iterator[str]) -> AsyncIterator[str]:
+    """
+    Stream the chunks of iter_ndjson or iter_csv from async code
+
+    Each chunk is produced in the request's sync thread, so the chunked
+    database iterator behind it keeps one connection and only one chunk
+    is held in memory at a time.
+
+    Args:
+        chunks: Chunk iterator returned by iter_ndjson or iter_csv
+
+    Yields:
+        str: The same chunks
+    """
+    next_chunk = sync_to_async(next)
+    try:
+        while True:
+            chunk = await next_chunk(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
+
+
+def _drain(buffer: io.StringIO) -> str:
+    """Return everything written to the buffer and empty it"""
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return chunk
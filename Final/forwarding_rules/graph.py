@@ -0,0 +1,377 @@
+import heapq
+import threading
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .cache import get_changed_rules, get_data_version, shared_cache
+from .destinations import action_forward_targets, normalize_address
+from .domains import address_domain, is_internal_address, is_internal_domain
+
+
+# Longest chain, in hops, followed by ForwardingGraph.chains()
+MAX_CHAIN_HOPS = 20
+
+
+def forward_targets(row: Dict[str, Any]) -> List[str]:
+    """
+    Addresses a rule forwards to, from its forwarding_email and its filter's forward action
+
+    Args:
+        row: Row from the rule repository's iter_forwarding_targets()
+
+    Returns:
+        list: Lower-case target addresses, each listed once
+    """
+    targets = [normalize_address(row["forwarding_email"])] + action_forward_targets(row["filter__action"])
+    return list(dict.fromkeys(filter(None, targets)))
+
+
+class ForwardingGraph:
+    """
+    Directed graph of mailboxes, with an edge for every forward
+
+    A rule adds an edge from its mailbox to its forwarding_email and to each
+    forward target of its filter. Edges are kept per rule, so the graph is
+    updated by replacing the edges of the rules that changed. Analyses are
+    computed on first use and kept until the next update. Methods may be
+    called from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Source mailbox and targets of every rule with forwards
+        self._rules: Dict[int, Tuple[str, List[str]]] = {}
+        # Edge multiplicities (the number of rules adding each edge), both ways
+        self._out: Dict[str, Dict[str, int]] = {}
+        self._in: Dict[str, Dict[str, int]] = {}
+        # Results of the analyses for the current edges
+        self._analysis: Dict[str, Any] = {}
+        # Data version the graph reflects
+        self.version: Optional[int] = None
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, Any]]) -> "ForwardingGraph":
+        """
+        Build a graph from rule rows in one pass
+
+        Args:
+            rows: Rows from the rule repository's iter_forwarding_targets()
+
+        Returns:
+            ForwardingGraph: The graph
+        """
+        graph = cls()
+        for row in rows:
+            graph._add_rule(row["id"], row["email"], forward_targets(row))
+        return graph
+
+    def refresh(self, rule_ids: Iterable[int], rows: Iterable[Dict[str, Any]]):
+        """
+        Replace the edges of some rules
+
+        Args:
+            rule_ids: IDs of the rules that changed, including deleted ones
+            rows: Current rows of those rules that still exist
+        """
+        with self._lock:
+            for rule_id in rule_ids:
+                self._remove_rule(rule_id)
+            for row in rows:
+                self._add_rule(row["id"], row["email"], forward_targets(row))
+            self._analysis.clear()
+
+    @property
+    def edge_count(self) -> int:
+        """Number of distinct (mailbox, target) edges"""
+        with self._lock:
+            return sum(len(targets) for targets in self._out.values())
+
+    def _add_rule(self, rule_id: int, source: str, targets: List[str]):
+        if not targets:
+            return
+        source = source.strip().lower()
+        self._rules[rule_id] = (source, targets)
+        for target in targets:
+            self._out.setdefault(source, {})
+            self._out[source][target] = self._out[source].get(target, 0) + 1
+            self._in.setdefault(target, {})
+            self._in[target][source] = self._in[target].get(source, 0) + 1
+
+    def _remove_rule(self, rule_id: int):
+        source, targets = self._rules.pop(rule_id, (None, ()))
+        for target in targets:
+            for edges, key, other in ((self._out, source, target), (self._in, target, source)):
+                edges[key][other] -= 1
+                if not edges[key][other]:
+                    del edges[key][other]
+                    if not edges[key]:
+                        del edges[key]
+
+    def _analyze(self, name: str, compute):
+        """Return an analysis result, computing it once per update"""
+        with self._lock:
+            if name not in self._analysis:
+                self._analysis[name] = compute()
+            return self._analysis[name]
+
+    def _components(self) -> List[List[str]]:
+        """
+        Strongly connected components (Tarjan's algorithm, without recursion)
+
+        Components are listed in reverse topological order: every component
+        comes after all the components it forwards to.
+        """
+        return self._analyze("components", self._find_components)
+
+    def _find_components(self) -> List[List[str]]:
+        index: Dict[str, int] = {}
+        low: Dict[str, int] = {}
+        stack: List[str] = []
+        on_stack = set()
+        components = []
+        for root in self._out:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self._out[root]))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(self._out.get(child, ()))))
+                        break
+                    if child in on_stack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+        return components
+
+    def loops(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Find forwarding loops: groups of mailboxes that forward to each other
+
+        Every mailbox of a loop reaches every other one. A mailbox forwarding
+        to itself is a loop of one.
+
+        Returns:
+            list: Loops, largest first, each with its sorted addresses and size
+        """
+        def compute():
+            loops = [
+                sorted(component) for component in self._components()
+                if len(component) > 1 or component[0] in self._out.get(component[0], ())
+            ]
+            loops.sort(key=lambda addresses: (-len(addresses), addresses[0]))
+            return [{"addresses": addresses, "size": len(addresses)} for addresses in loops]
+        return self._analyze("loops", compute)[:limit]
+
+    def chains(self, min_hops: int = 2, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Find multi-hop forwarding chains
+
+        A chain starts at a mailbox that nothing forwards to and follows
+        forwards until a mailbox that forwards nowhere new, for at most
+        MAX_CHAIN_HOPS hops. Chains are listed by their first mailbox.
+
+        Args:
+            min_hops: Shortest chain reported, in forwards
+            limit: Most chains returned
+
+        Returns:
+            list: Chains with their addresses in order, hop count and
+                whether the last address is external
+        """
+        heads = self._analyze("heads", lambda: sorted(node for node in self._out if node not in self._in))
+        chains = []
+        with self._lock:
+            for head in heads:
+                path = [head]
+                on_path = {head}
+                work = [iter(sorted(self._out[head]))]
+                while work and len(chains) < limit:
+                    extended = False
+                    if len(path) <= MAX_CHAIN_HOPS:
+                        for child in work[-1]:
+                            if child not in on_path:
+                                path.append(child)
+                                on_path.add(child)
+                                work.append(iter(sorted(self._out.get(child, ()))))
+                                extended = True
+                                break
+                    if extended:
+                        continue
+                    if not self._can_extend(path, on_path) and len(path) - 1 >= min_hops:
+                        chains.append({
+                            "addresses": list(path),
+                            "hops": len(path) - 1,
+                            "external": not is_internal_address(path[-1]),
+                        })
+                    work.pop()
+                    on_path.discard(path.pop())
+                if len(chains) >= limit:
+                    break
+        return chains
+
+    def _can_extend(self, path: List[str], on_path: set) -> bool:
+        """Check whether a path could continue to a mailbox not yet on it"""
+        if len(path) > MAX_CHAIN_HOPS:
+            return False
+        return any(target not in on_path for target in self._out.get(path[-1], ()))
+
+    def _reach(self) -> Dict[str, Tuple[int, frozenset]]:
+        """
+        External addresses every internal mailbox reaches, directly or through others
+
+        The shortest hop count comes from one breadth-first search backwards
+        from all external addresses; the reached addresses are collected per
+        strongly connected component, each component joining the sets of
+        the components it forwards to.
+        """
+        internal_domains = {}
+
+        def internal(address):
+            domain = address_domain(address)
+            if domain not in internal_domains:
+                internal_domains[domain] = is_internal_domain(domain)
+            return internal_domains[domain]
+
+        external = [node for node in self._in if not internal(node)]
+        hops = dict.fromkeys(external, 0)
+        queue = deque(external)
+        while queue:
+            node = queue.popleft()
+            for source in self._in.get(node, ()):
+                if source not in hops:
+                    hops[source] = hops[node] + 1
+                    queue.append(source)
+
+        reached: Dict[int, frozenset] = {}
+        component_of: Dict[str, int] = {}
+        nothing = frozenset()
+        for number, component in enumerate(self._components()):
+            for node in component:
+                component_of[node] = number
+            parts = []
+            direct = set()
+            for node in component:
+                for target in self._out.get(node, ()):
+                    if target in hops and not hops[target]:
+                        direct.add(target)
+                    part = reached[component_of[target]] if component_of[target] != number else nothing
+                    if part and (not parts or part is not parts[-1]):
+                        parts.append(part)
+            if direct:
+                reached[number] = frozenset(direct.union(*parts))
+            elif not parts:
+                reached[number] = nothing
+            elif len(parts) == 1:
+                # Share the set of the only component forwarded to, instead of copying it
+                reached[number] = parts[0]
+            else:
+                reached[number] = frozenset().union(*parts)
+
+        return {
+            node: (hops[node], reached[component_of[node]])
+            for node in self._out
+            if node in hops and internal(node)
+        }
+
+    def external_reach(self, min_hops: int = 1, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Find internal mailboxes whose mail reaches external domains
+
+        Args:
+            min_hops: Fewest forwards to the nearest external address; 2 lists
+                only mailboxes that reach outside through another mailbox
+            limit: Most mailboxes returned
+
+        Returns:
+            list: Mailboxes, the longest way out first, with the hops to the
+                nearest external address and every external domain and
+                address they reach
+        """
+        def compute():
+            return sorted(self._reach().items(), key=lambda item: (-item[1][0], item[0]))
+        results = []
+        for mailbox, (hops, destinations) in self._analyze("reach", compute):
+            if len(results) >= limit:
+                break
+            if hops >= min_hops:
+                results.append({
+                    "mailbox": mailbox,
+                    "hops": hops,
+                    "external_domains": sorted({address_domain(address) or address for address in destinations}),
+                    "external_destinations": sorted(destinations),
+                })
+        return results
+
+    def top_inbound(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Find the addresses the most mailboxes forward to
+
+        Returns:
+            list: Addresses with their number of distinct forwarding
+                mailboxes, most first, and whether they are internal
+        """
+        with self._lock:
+            top = heapq.nsmallest(limit, self._in.items(), key=lambda item: (-len(item[1]), item[0]))
+            return [
+                {"address": address, "inbound": len(sources), "internal": is_internal_address(address)}
+                for address, sources in top
+            ]
+
+
+# Graph of the current rules, shared by the threads of a process
+_graph_lock = threading.Lock()
+_graph: Optional[ForwardingGraph] = None
+
+
+def get_forwarding_graph(rule_repo) -> ForwardingGraph:
+    """
+    Get the forwarding graph for the current rules and filters
+
+    The graph is built once per process. After rules or filters are
+    written, only the edges of the rules that changed are re-read; the
+    graph is rebuilt from scratch only when the changed rules are not
+    known (bulk imports, an expired change log, a flushed cache). Without
+    a shared cache the data version would miss writes made by other
+    processes, so the graph is built on every call.
+    """
+    global _graph
+    if not shared_cache():
+        graph = ForwardingGraph.from_rows(rule_repo.iter_forwarding_targets())
+        graph.version = get_data_version()
+        return graph
+    graph = _graph
+    if graph is not None and graph.version == get_data_version():
+        return graph
+    with _graph_lock:
+        graph = _graph
+        version = get_data_version()
+        if graph is not None and graph.version == version:
+            return graph
+        changed = get_changed_rules(graph.version, version) if graph is not None else None
+        if changed is None:
+            graph = ForwardingGraph.from_rows(rule_repo.iter_forwarding_targets())
+            _graph = graph
+        else:
+            graph.refresh(changed, rule_repo.iter_forwarding_targets(changed))
+        graph.version = version
+        return graph
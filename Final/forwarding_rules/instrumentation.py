@@ -0,0 +1,92 @@
+import time
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+
+class RequestStats:
+    """Database queries and time spent on them while handling one request"""
+
+    def __init__(self):
+        self.query_count = 0
+        self.db_time = 0.0
+        self.started = time.perf_counter()
+
+    @property
+    def total_time(self) -> float:
+        """Seconds since the request started"""
+        return time.perf_counter() - self.started
+
+
+# Stats of the request being handled. Context variables follow the request
+# into sync_to_async threads, so queries made by async views are counted too.
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def start_request_stats():
+    """Start collecting stats for the current request, returning (stats, reset token)"""
+    stats = RequestStats()
+    return stats, _request_stats.set(stats)
+
+
+def stop_request_stats(token):
+    """Stop collecting stats for the request started with `token`"""
+    _request_stats.reset(token)
+
+
+def measure_stream(content, stats: RequestStats, finished: Callable[[], None]):
+    """
+    Iterate over a streaming response's content, adding its queries to `stats`
+
+    The stats are made current only while each chunk is produced, since
+    the server iterates over the content outside the request's context.
+    `finished` is called once the content is exhausted or closed.
+    """
+    iterator = iter(content)
+    try:
+        while True:
+            token = _request_stats.set(stats)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _request_stats.reset(token)
+            yield chunk
+    finally:
+        finished()
+
+
+async def ameasure_stream(content, stats: RequestStats, finished: Callable[[], None]):
+    """Async version of measure_stream, for async streaming content"""
+    iterator = content.__aiter__()
+    try:
+        while True:
+            token = _request_stats.set(stats)
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                _request_stats.reset(token)
+            yield chunk
+    finally:
+        finished()
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding each query to the current request's stats"""
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.query_count += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def install_query_recorder(connection):
+    """Add record_query to a database connection's execute wrappers, once"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
@@ -0,0 +1,302 @@
+import re
+import threading
+from collections import deque
+from email.utils import getaddresses, parseaddr
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .cache import get_data_version, shared_cache
+
+
+# Gmail separates alternatives within one criterion with OR
+ALTERNATIVES_SEPARATOR = re.compile(r"\s+OR\s+")
+
+# Criteria that take a size like ">5M"; the suffixes are powers of 1024
+SIZE_CRITERION = re.compile(r"^\s*([<>]?)\s*(\d+)\s*([KMG]?)B?\s*$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# Criteria keys compared against message addresses
+ADDRESS_CRITERIA = ("from", "to")
+
+# Host names, such as "example.com" or "mail.example.co.uk"
+DOMAIN_PATTERN = re.compile(r"^(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z][a-z0-9-]*[a-z0-9]$")
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton finding every occurrence of many terms in one pass
+
+    Matching costs time proportional to the length of the text plus the
+    number of matches, however many terms were added.
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        self._built = True
+
+    def add(self, term: str, value: int):
+        """Add a term; `value` is reported whenever the term occurs"""
+        node = 0
+        for char in term:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append(value)
+        self._built = False
+
+    def build(self):
+        """Compute the failure links; call after the last add()"""
+        queue = deque(self._goto[0].values())
+        for node in queue:
+            self._fail[node] = 0
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+        self._built = True
+
+    def find(self, text: str) -> set:
+        """Return the values of every term occurring in `text`"""
+        if not self._built:
+            self.build()
+        found = set()
+        node = 0
+        goto, fail, output = self._goto, self._fail, self._output
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+class FilterMatch:
+    """A filter that fires for a message"""
+
+    __slots__ = ("filter_id", "rule_id", "email", "criteria", "action")
+
+    def __init__(self, filter_id: int, rule_id: int, email: str, criteria: Dict[str, Any], action: Dict[str, Any]):
+        self.filter_id = filter_id
+        self.rule_id = rule_id
+        self.email = email
+        self.criteria = criteria
+        self.action = action
+
+    @property
+    def forward_targets(self) -> List[str]:
+        """Addresses the message would be forwarded to"""
+        forward = self.action.get("forward")
+        if not forward:
+            return []
+        return [forward] if isinstance(forward, str) else list(forward)
+
+
+class FilterMatcher:
+    """
+    Index of every filter's criteria, answering which filters fire for a message
+
+    A filter fires when all of its criteria match (Gmail semantics):
+    - `from` / `to`: a full address matches exactly, `@domain` matches the
+      address's domain, anything else matches as a substring of the header;
+      a term shaped like a domain ("example.com", but also "jane.doe")
+      matches the address's domain or part of its local part; alternatives
+      are separated by " OR "
+    - `subject`: case-insensitive substring of the subject, " OR " allowed
+    - `hasAttachment`: the message has (or has no) attachment
+    - `size`: the message is larger (">5M", "5M") or smaller ("<100K") than the size
+
+    Exact addresses and domains are looked up in hash maps and substrings
+    found with one Aho-Corasick automaton per header, so a message is
+    matched against all filters in one pass over each header. Filters with
+    criteria the engine does not understand, or without any criteria, never
+    fire and are counted in `unsupported`.
+    """
+
+    def __init__(self):
+        # Per filter: (FilterMatch, number of indexed conditions, post checks)
+        self._filters: List[Tuple[FilterMatch, int, List[Tuple[str, Any]]]] = []
+        # Condition keys (filter index, condition index) by exact address and domain, per header
+        self._addresses: Dict[str, Dict[str, List[Tuple[int, int]]]] = {key: {} for key in ADDRESS_CRITERIA}
+        self._domains: Dict[str, Dict[str, List[Tuple[int, int]]]] = {key: {} for key in ADDRESS_CRITERIA}
+        # Substring terms per header, with the condition keys of each term
+        self._automata: Dict[str, AhoCorasick] = {key: AhoCorasick() for key in ADDRESS_CRITERIA + ("subject",)}
+        # Domain-shaped terms per header, also looked for in the local part of addresses
+        self._local_automata: Dict[str, AhoCorasick] = {key: AhoCorasick() for key in ADDRESS_CRITERIA}
+        self._terms: List[Tuple[int, int]] = []
+        # Filters without indexed conditions, checked for every message
+        self._unindexed: List[int] = []
+        self.unsupported = 0
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, Any]]) -> "FilterMatcher":
+        """
+        Compile filter rows into a matcher
+
+        Args:
+            rows: Dictionaries with id, forwarding_id, forwarding__email, criteria and action
+
+        Returns:
+            FilterMatcher: The compiled matcher
+        """
+        matcher = cls()
+        for row in rows:
+            matcher.add_filter(FilterMatch(
+                row["id"], row["forwarding_id"], row["forwarding__email"], row["criteria"] or {}, row["action"] or {}
+            ))
+        for automaton in [*matcher._automata.values(), *matcher._local_automata.values()]:
+            automaton.build()
+        return matcher
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+    def add_filter(self, filter_match: FilterMatch):
+        """Index one filter's criteria"""
+        # A filter without criteria would fire for every message
+        if not isinstance(filter_match.criteria, dict) or not filter_match.criteria:
+            self.unsupported += 1
+            return
+        checks = []
+        conditions = []
+        for key, value in filter_match.criteria.items():
+            if key in ADDRESS_CRITERIA or key == "subject":
+                conditions.append((key, str(value)))
+            elif key == "hasAttachment":
+                checks.append(("hasAttachment", value in (True, "true", "True", 1)))
+            elif key == "size" and SIZE_CRITERION.match(str(value)):
+                checks.append(("size", _parse_size(str(value))))
+            else:
+                self.unsupported += 1
+                return
+
+        index = len(self._filters)
+        self._filters.append((filter_match, len(conditions), checks))
+        if not conditions:
+            self._unindexed.append(index)
+
+        for condition_index, (key, value) in enumerate(conditions):
+            condition = (index, condition_index)
+            for alternative in ALTERNATIVES_SEPARATOR.split(value.strip()):
+                alternative = alternative.strip().strip('"').lower()
+                if not alternative:
+                    continue
+                if key in ADDRESS_CRITERIA and "@" in alternative and not alternative.startswith("@"):
+                    self._addresses[key].setdefault(alternative, []).append(condition)
+                elif key in ADDRESS_CRITERIA and alternative.startswith("@"):
+                    self._domains[key].setdefault(alternative[1:], []).append(condition)
+                elif key in ADDRESS_CRITERIA and DOMAIN_PATTERN.match(alternative):
+                    # "example.com" names a domain, "jane.doe" part of an address: match either
+                    self._domains[key].setdefault(alternative, []).append(condition)
+                    self._local_automata[key].add(alternative, len(self._terms))
+                    self._terms.append(condition)
+                else:
+                    self._automata[key].add(alternative, len(self._terms))
+                    self._terms.append(condition)
+
+    def match(self, sender: str = "", to: Iterable[str] = (), subject: str = "",
+              has_attachment: bool = False, size: Optional[int] = None) -> List[FilterMatch]:
+        """
+        Find the filters that fire for a message
+
+        Args:
+            sender: From header, e.g. "Jane <jane@example.com>"
+            to: To/Cc headers or addresses
+            subject: Subject header
+            has_attachment: Whether the message has attachments
+            size: Message size in bytes, if known
+
+        Returns:
+            list: The filters that fire, in the order they were added
+        """
+        satisfied: Dict[int, set] = {}
+
+        def satisfy(conditions):
+            for index, condition_index in conditions:
+                satisfied.setdefault(index, set()).add(condition_index)
+
+        headers = {
+            "from": (sender, [parseaddr(sender)[1]]),
+            "to": (", ".join(to), [address for _, address in getaddresses(list(to))]),
+        }
+        for key, (header, addresses) in headers.items():
+            for address in addresses:
+                address = address.lower()
+                if not address:
+                    continue
+                satisfy(self._addresses[key].get(address, ()))
+                local_part, _, domain = address.rpartition("@")
+                for term in self._local_automata[key].find(local_part):
+                    satisfy((self._terms[term],))
+                # A domain criterion also matches its subdomains
+                while domain:
+                    satisfy(self._domains[key].get(domain, ()))
+                    domain = domain.partition(".")[2]
+            for term in self._automata[key].find(header.lower()):
+                satisfy((self._terms[term],))
+        for term in self._automata["subject"].find(subject.lower()):
+            satisfy((self._terms[term],))
+
+        candidates = [index for index, hit in satisfied.items() if len(hit) == self._filters[index][1]]
+        matches = []
+        for index in sorted(candidates + self._unindexed):
+            filter_match, _, checks = self._filters[index]
+            if all(_check(check, has_attachment, size) for check in checks):
+                matches.append(filter_match)
+        return matches
+
+
+def _parse_size(value: str) -> Tuple[str, int]:
+    """Parse a size criterion into (">" or "<", bytes); a bare size means larger than"""
+    operator, number, unit = SIZE_CRITERION.match(value).groups()
+    return operator or ">", int(number) * SIZE_UNITS[unit.upper()]
+
+
+def _check(check: Tuple[str, Any], has_attachment: bool, size: Optional[int]) -> bool:
+    """Evaluate a criterion that is not indexed"""
+    key, expected = check
+    if key == "hasAttachment":
+        return has_attachment == expected
+    operator, limit = expected
+    if size is None:
+        return False
+    return size > limit if operator == ">" else size < limit
+
+
+# Matcher compiled from the current filters, with the data version it was built for
+_matcher_lock = threading.Lock()
+_matcher: Tuple[Optional[int], Optional[FilterMatcher]] = (None, None)
+
+
+def get_filter_matcher(filter_repo) -> FilterMatcher:
+    """
+    Get a matcher for the current filters
+
+    The matcher is compiled once per process and data version, so it is
+    rebuilt only after a rule or filter was written. Without a shared
+    cache the data version would miss writes made by other processes, so
+    the matcher is compiled on every call.
+    """
+    global _matcher
+    if not shared_cache():
+        return FilterMatcher.from_rows(filter_repo.iter_filter_rows())
+    version = get_data_version()
+    built_version, matcher = _matcher
+    if built_version != version:
+        with _matcher_lock:
+            built_version, matcher = _matcher
+            if built_version != version:
+                matcher = FilterMatcher.from_rows(filter_repo.iter_filter_rows())
+                _matcher = (version, matcher)
+    return matcher
@@ -0,0 +1,101 @@
+import logging
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from .instrumentation import ameasure_stream, measure_stream, start_request_stats, stop_request_stats
+from .routers import reset_primary_pin
+
+
+logger = logging.getLogger(__name__)
+
+# Header carrying the request's query count, DB time and total time
+SERVER_TIMING_HEADER = "Server-Timing"
+
+
+@sync_and_async_middleware
+def query_timing_middleware(get_response):
+    """
+    Measure database queries, DB time and total time of every request
+
+    The numbers are sent in a Server-Timing header, which browser developer
+    tools display, and requests over REQUEST_QUERY_BUDGET queries or
+    REQUEST_TIME_BUDGET_MS milliseconds are logged as warnings. Streaming
+    responses run most of their queries after the headers are sent, so
+    they get no header: they are measured until the last chunk is sent
+    and checked against the budget then.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            stats, token = start_request_stats()
+            try:
+                response = await get_response(request)
+            finally:
+                stop_request_stats(token)
+            return report_request_stats(request, response, stats)
+    else:
+        def middleware(request):
+            stats, token = start_request_stats()
+            try:
+                response = get_response(request)
+            finally:
+                stop_request_stats(token)
+            return report_request_stats(request, response, stats)
+
+    return middleware
+
+
+def report_request_stats(request, response, stats):
+    """
+    Add the Server-Timing header to `response` and log the request if it is over budget
+
+    Streaming responses are instead measured while their content is sent,
+    and logged once it has been sent completely.
+    """
+    if response.streaming:
+        measure = ameasure_stream if response.is_async else measure_stream
+        response.streaming_content = measure(
+            response.streaming_content, stats, lambda: log_over_budget(request, stats)
+        )
+        return response
+
+    db_ms = stats.db_time * 1000
+    response[SERVER_TIMING_HEADER] = (
+        f'db;dur={db_ms:.1f};desc="{stats.query_count} queries", total;dur={stats.total_time * 1000:.1f}'
+    )
+    log_over_budget(request, stats)
+    return response
+
+
+def log_over_budget(request, stats):
+    """Log the request as a warning if it ran more queries or took longer than its budget"""
+    db_ms = stats.db_time * 1000
+    total_ms = stats.total_time * 1000
+    if stats.query_count > settings.REQUEST_QUERY_BUDGET or total_ms > settings.REQUEST_TIME_BUDGET_MS:
+        match = request.resolver_match
+        endpoint = match.url_name if match and match.url_name else request.path
+        logger.warning(
+            "Request over budget: %s %s (%s) ran %d queries in %.1f ms of DB time, %.1f ms total",
+            request.method, request.path, endpoint, stats.query_count, db_ms, total_ms
+        )
+
+
+@sync_and_async_middleware
+def replica_pin_middleware(get_response):
+    """
+    Start every request without a pin to the primary database
+
+    Reads are pinned to the primary for a while after a write; the pin
+    belongs to the request that wrote, not to the thread that served it.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            reset_primary_pin()
+            return await get_response(request)
+    else:
+        def middleware(request):
+            reset_primary_pin()
+            return get_response(request)
+
+    return middleware
@@ -0,0 +1,65 @@
+from django.db import migrations
+
+
+# The statements below are written out here rather than imported from the
+# application, so that later changes to it do not change what the migration
+# creates. Migrations that rebuild the autoforwarding table on SQLite drop
+# its triggers and must create them again.
+
+# SQLite FTS5 table indexing autoforwarding.email by trigrams
+EMAIL_SEARCH_TABLE_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS autoforwarding_email_fts USING fts5("
+    "email, content='autoforwarding', content_rowid='id', tokenize='trigram')",
+]
+
+# Triggers keeping the index in sync with the autoforwarding table
+EMAIL_SEARCH_TRIGGERS_SQL = [
+    "CREATE TRIGGER IF NOT EXISTS autoforwarding_email_fts_ai AFTER INSERT ON autoforwarding BEGIN "
+    "INSERT INTO autoforwarding_email_fts(rowid, email) VALUES (new.id, new.email); END",
+    "CREATE TRIGGER IF NOT EXISTS autoforwarding_email_fts_ad AFTER DELETE ON autoforwarding BEGIN "
+    "INSERT INTO autoforwarding_email_fts(autoforwarding_email_fts, rowid, email) "
+    "VALUES ('delete', old.id, old.email); END",
+    "CREATE TRIGGER IF NOT EXISTS autoforwarding_email_fts_au AFTER UPDATE OF email ON autoforwarding BEGIN "
+    "INSERT INTO autoforwarding_email_fts(autoforwarding_email_fts, rowid, email) "
+    "VALUES ('delete', old.id, old.email); "
+    "INSERT INTO autoforwarding_email_fts(rowid, email) VALUES (new.id, new.email); END",
+]
+
+# Fills the index from existing rows
+EMAIL_SEARCH_REBUILD_SQL = [
+    "INSERT INTO autoforwarding_email_fts(autoforwarding_email_fts) VALUES ('rebuild')",
+]
+
+EMAIL_SEARCH_DROP_SQL = [
+    "DROP TRIGGER IF EXISTS autoforwarding_email_fts_ai",
+    "DROP TRIGGER IF EXISTS autoforwarding_email_fts_ad",
+    "DROP TRIGGER IF EXISTS autoforwarding_email_fts_au",
+    "DROP TABLE IF EXISTS autoforwarding_email_fts",
+]
+
+
+def create_email_search_index(apps, schema_editor):
+    """Create and fill the FTS5 trigram index on autoforwarding.email (SQLite only)"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in EMAIL_SEARCH_TABLE_SQL + EMAIL_SEARCH_TRIGGERS_SQL + EMAIL_SEARCH_REBUILD_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_email_search_index(apps, schema_editor):
+    """Drop the email search index and its triggers"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in EMAIL_SEARCH_DROP_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forwarding_rules', '0002_auto_20250406_1618'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_email_search_index, drop_email_search_index),
+    ]
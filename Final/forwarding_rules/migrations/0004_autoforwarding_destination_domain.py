@@ -0,0 +1,50 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:16
+
+from django.db import migrations, models
+
+
+# Rules updated per statement while filling in the destination domain
+BACKFILL_BATCH_SIZE = 2000
+
+
+# The helpers below are copies of the application code as of this migration,
+# so that later changes to it do not change what the migration writes
+def address_domain(address):
+    """Lower-case domain of an email address, or None if it has none"""
+    if not address or "@" not in address:
+        return None
+    domain = address.strip().rpartition("@")[2].strip().rstrip(".").lower()
+    return domain or None
+
+
+def backfill_destination_domain(apps, schema_editor):
+    """Fill in destination_domain for existing rules, a batch of rule IDs at a time"""
+    AutoForwarding = apps.get_model('forwarding_rules', 'AutoForwarding')
+    rules = AutoForwarding.objects.using(schema_editor.connection.alias).filter(forwarding_email__isnull=False)
+    last_id = 0
+    while True:
+        batch = list(rules.filter(id__gt=last_id).order_by('id').only('id', 'forwarding_email')[:BACKFILL_BATCH_SIZE])
+        if not batch:
+            break
+        for rule in batch:
+            rule.destination_domain = address_domain(rule.forwarding_email)
+        AutoForwarding.objects.using(schema_editor.connection.alias).bulk_update(batch, ['destination_domain'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forwarding_rules', '0003_autoforwarding_email_search_index'),
+    ]
+
+    operations = [
+        # Nullable without a default, so SQLite adds the column in place
+        # instead of rebuilding the table (which would drop the search triggers)
+        migrations.AddField(
+            model_name='autoforwarding',
+            name='destination_domain',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.RunPython(backfill_destination_domain, migrations.RunPython.noop),
+    ]
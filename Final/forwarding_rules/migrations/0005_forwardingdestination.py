@@ -0,0 +1,84 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Rules read per batch while filling in their destinations
+BACKFILL_BATCH_SIZE = 2000
+
+
+# The helpers below are copies of the application code as of this migration,
+# so that later changes to it do not change what the migration writes
+def address_domain(address):
+    """Lower-case domain of an email address, or None if it has none"""
+    if not address or "@" not in address:
+        return None
+    domain = address.strip().rpartition("@")[2].strip().rstrip(".").lower()
+    return domain or None
+
+
+def normalize_address(address):
+    """Lower-case, trimmed email address, or None if it is empty or not a string"""
+    if not isinstance(address, str) or not address.strip():
+        return None
+    return address.strip().lower()
+
+
+def action_forward_targets(action):
+    """Addresses a filter action forwards to, normalized and each listed once"""
+    forward = action.get("forward") if isinstance(action, dict) else None
+    if not forward:
+        return []
+    targets = forward if isinstance(forward, list) else [forward]
+    return list(dict.fromkeys(filter(None, map(normalize_address, targets))))
+
+
+def backfill_destinations(apps, schema_editor):
+    """Create the destination rows of existing rules and filters, a batch of rules at a time"""
+    AutoForwarding = apps.get_model('forwarding_rules', 'AutoForwarding')
+    ForwardingDestination = apps.get_model('forwarding_rules', 'ForwardingDestination')
+    alias = schema_editor.connection.alias
+    rules = AutoForwarding.objects.using(alias).order_by('id').values('id', 'forwarding_email', 'filter__action')
+    last_id = 0
+    while True:
+        batch = list(rules.filter(id__gt=last_id)[:BACKFILL_BATCH_SIZE])
+        if not batch:
+            break
+        destinations = []
+        for row in batch:
+            targets = [('rule', normalize_address(row['forwarding_email']))]
+            targets += [('filter', address) for address in action_forward_targets(row['filter__action'])]
+            destinations += [
+                ForwardingDestination(forwarding_id=row['id'], address=address,
+                                      domain=address_domain(address), source=source)
+                for source, address in targets if address
+            ]
+        ForwardingDestination.objects.using(alias).bulk_create(destinations)
+        last_id = batch[-1]['id']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forwarding_rules', '0004_autoforwarding_destination_domain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForwardingDestination',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(db_index=True, max_length=254)),
+                ('domain', models.CharField(db_index=True, max_length=255, null=True)),
+                ('source', models.CharField(choices=[('rule', 'Rule forwarding address'), ('filter', 'Filter forward action')], max_length=10)),
+                ('forwarding', models.ForeignKey(db_column='forwarding_id', on_delete=django.db.models.deletion.CASCADE, related_name='destinations', to='forwarding_rules.autoforwarding')),
+            ],
+            options={
+                'verbose_name': 'Forwarding Destination',
+                'verbose_name_plural': 'Forwarding Destinations',
+                'db_table': 'forwardingdestination',
+            },
+        ),
+        migrations.RunPython(backfill_destinations, migrations.RunPython.noop),
+    ]
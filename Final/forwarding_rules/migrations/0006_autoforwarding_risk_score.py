@@ -0,0 +1,116 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Rules read per batch while scoring them
+BACKFILL_BATCH_SIZE = 2000
+
+# Points added by each risk signal; a rule's score is their sum, at most 100
+EXTERNAL_DESTINATION_POINTS = 40
+SENSITIVE_CRITERIA_POINTS = 20
+TRASH_ACTION_POINTS = 25
+ERROR_POINTS = 15
+
+# Filter criteria terms that single out financial or credential mail
+SENSITIVE_KEYWORDS = ("invoice", "payment", "wire", "bank", "remittance", "payroll", "password")
+
+
+# The helpers below are copies of the application code as of this migration,
+# so that later changes to it do not change what the migration writes
+def address_domain(address):
+    """Lower-case domain of an email address, or None if it has none"""
+    if not address or "@" not in address:
+        return None
+    domain = address.strip().rpartition("@")[2].strip().rstrip(".").lower()
+    return domain or None
+
+
+def is_internal_domain(domain):
+    """Check whether a domain, or a domain it is a subdomain of, is in INTERNAL_DOMAINS"""
+    while domain:
+        if domain in settings.INTERNAL_DOMAINS:
+            return True
+        domain = domain.partition(".")[2]
+    return False
+
+
+def normalize_address(address):
+    """Lower-case, trimmed email address, or None if it is empty or not a string"""
+    if not isinstance(address, str) or not address.strip():
+        return None
+    return address.strip().lower()
+
+
+def action_forward_targets(action):
+    """Addresses a filter action forwards to, normalized and each listed once"""
+    forward = action.get("forward") if isinstance(action, dict) else None
+    if not forward:
+        return []
+    targets = forward if isinstance(forward, list) else [forward]
+    return list(dict.fromkeys(filter(None, map(normalize_address, targets))))
+
+
+def _strings(value):
+    """Strings in a filter criteria or action value (a string or a list of strings)"""
+    values = value if isinstance(value, list) else [value]
+    return (item for item in values if isinstance(item, str))
+
+
+def risk_score(destination_domain, error, criteria=None, action=None):
+    """Score how risky a rule is, from 0 to 100, as the sum of the points of the signals present"""
+    score = 0
+    domains = [destination_domain] + [address_domain(target) for target in action_forward_targets(action)]
+    if any(domain and not is_internal_domain(domain) for domain in domains):
+        score += EXTERNAL_DESTINATION_POINTS
+    if isinstance(criteria, dict) and any(
+        keyword in text.lower()
+        for value in criteria.values() for text in _strings(value) for keyword in SENSITIVE_KEYWORDS
+    ):
+        score += SENSITIVE_CRITERIA_POINTS
+    if isinstance(action, dict) and any(label.upper() == "TRASH" for label in _strings(action.get("addLabels"))):
+        score += TRASH_ACTION_POINTS
+    if error:
+        score += ERROR_POINTS
+    return min(score, 100)
+
+
+def backfill_risk_score(apps, schema_editor):
+    """Score existing rules, a batch of rules at a time, with one UPDATE per score in each batch"""
+    AutoForwarding = apps.get_model('forwarding_rules', 'AutoForwarding')
+    rules = AutoForwarding.objects.using(schema_editor.connection.alias).order_by('id').values_list(
+        'id', 'destination_domain', 'error', 'filter__criteria', 'filter__action')
+    last_id = 0
+    while True:
+        batch = list(rules.filter(id__gt=last_id)[:BACKFILL_BATCH_SIZE])
+        if not batch:
+            break
+        ids_by_score = {}
+        for rule_id, domain, error, criteria, action in batch:
+            ids_by_score.setdefault(risk_score(domain, error, criteria, action), []).append(rule_id)
+        for score, ids in ids_by_score.items():
+            AutoForwarding.objects.using(schema_editor.connection.alias).filter(id__in=ids).update(risk_score=score)
+        last_id = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forwarding_rules', '0005_forwardingdestination'),
+    ]
+
+    operations = [
+        # Nullable without a default, so SQLite adds the column in place
+        # instead of rebuilding the table (which would drop the search triggers)
+        migrations.AddField(
+            model_name='autoforwarding',
+            name='risk_score',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_risk_score, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='autoforwarding',
+            index=models.Index(fields=['-risk_score', 'id'], name='autoforwarding_risk_idx'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:27
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Filters read per batch while exploding their terms
+BACKFILL_BATCH_SIZE = 2000
+
+
+# The helpers below are copies of the application code as of this migration,
+# so that later changes to it do not change what the migration writes
+def normalize_term_value(value):
+    """Trimmed, lower-case string, JSON form of a boolean or number, or None for values that cannot be searched"""
+    if isinstance(value, str):
+        return value.strip().lower() or None
+    if isinstance(value, (bool, int, float)):
+        return json.dumps(value)
+    return None
+
+
+def filter_terms(criteria, action):
+    """Explode a filter's criteria and action into (kind, key, value) terms, each listed once"""
+    terms = []
+    for kind, data in (('criteria', criteria), ('action', action)):
+        if not isinstance(data, dict):
+            continue
+        for key, value in data.items():
+            for item in value if isinstance(value, list) else [value]:
+                normalized = normalize_term_value(item)
+                if normalized is not None and len(key) <= 64:
+                    terms.append((kind, key, normalized))
+    return list(dict.fromkeys(terms))
+
+
+def backfill_filter_terms(apps, schema_editor):
+    """Create the terms of existing filters, a batch of filters at a time"""
+    ForwardingFilter = apps.get_model('forwarding_rules', 'ForwardingFilter')
+    FilterTerm = apps.get_model('forwarding_rules', 'FilterTerm')
+    alias = schema_editor.connection.alias
+    filters = ForwardingFilter.objects.using(alias).order_by('id').values_list('id', 'criteria', 'action')
+    last_id = 0
+    while True:
+        batch = list(filters.filter(id__gt=last_id)[:BACKFILL_BATCH_SIZE])
+        if not batch:
+            break
+        FilterTerm.objects.using(alias).bulk_create([
+            FilterTerm(filter_id=filter_id, kind=kind, key=key, value=value)
+            for filter_id, criteria, action in batch
+            for kind, key, value in filter_terms(criteria, action)
+        ])
+        last_id = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forwarding_rules', '0006_autoforwarding_risk_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilterTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('criteria', 'Filter criteria'), ('action', 'Filter action')], max_length=10)),
+                ('key', models.CharField(max_length=64)),
+                ('value', models.TextField()),
+                ('filter', models.ForeignKey(db_column='filter_id', on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='forwarding_rules.forwardingfilter')),
+            ],
+            options={
+                'verbose_name': 'Filter Term',
+                'verbose_name_plural': 'Filter Terms',
+                'db_table': 'filterterm',
+                'indexes': [models.Index(fields=['kind', 'key', 'value', 'filter'], name='filterterm_lookup_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_filter_terms, migrations.RunPython.noop),
+    ]
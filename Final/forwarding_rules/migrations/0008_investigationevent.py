@@ -0,0 +1,33 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forwarding_rules', '0007_filterterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvestigationEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254)),
+                ('field', models.CharField(max_length=50)),
+                ('old_value', models.TextField(blank=True, null=True)),
+                ('new_value', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('forwarding', models.ForeignKey(db_column='forwarding_id', db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='events', to='forwarding_rules.autoforwarding')),
+            ],
+            options={
+                'verbose_name': 'Investigation Event',
+                'verbose_name_plural': 'Investigation Events',
+                'db_table': 'investigationevent',
+                'indexes': [models.Index(fields=['forwarding', 'created_at', 'id'], name='investigationevent_rule_idx'), models.Index(fields=['created_at', 'id'], name='investigationevent_time_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.10 on 2026-10-17 04:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forwarding_rules', '0008_investigationevent'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='investigationevent',
+            name='investigationevent_rule_idx',
+        ),
+        migrations.AddIndex(
+            model_name='investigationevent',
+            index=models.Index(fields=['forwarding', 'id'], name='investigationevent_rule_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 
 class AutoForwarding(models.Model):
@@ -9,10 +10,36 @@ class AutoForwarding(models.Model):
     email = models.EmailField(unique=True, db_index=True)
     name = models.CharField(max_length=255)
     forwarding_email = models.EmailField(null=True, blank=True)
+    # Lower-case domain of forwarding_email, set on save and by bulk_upsert_rules
+    destination_domain = models.CharField(max_length=255, null=True, blank=True, db_index=True, editable=False)
     disposition = models.CharField(max_length=50, null=True, blank=True)
     has_forwarding_filters = models.BooleanField(default=False)
     error = models.TextField(null=True, blank=True)
     investigation_note = models.TextField(null=True, blank=True)
+    # 0-100, from the destination, the filter and the error state (see risk.py);
+    # recomputed when those change, indexed for highest-risk-first listing
+    risk_score = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
+    
+    # Fields whose loaded values are remembered, so a save can tell whether they changed
+    TRACKED_FIELDS = ('forwarding_email', 'error')
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the loaded values of TRACKED_FIELDS"""
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {name: instance.__dict__.get(name, models.DEFERRED) for name in cls.TRACKED_FIELDS}
+        return instance
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = {name: self.__dict__.get(name, models.DEFERRED) for name in self.TRACKED_FIELDS}
+    
+    def field_changed(self, name: str) -> bool:
+        """Check whether a tracked field differs from the value last loaded or saved"""
+        if name not in self.__dict__:
+            # Deferred and never set, so the save leaves it alone
+            return False
+        return self.__dict__[name] != getattr(self, '_loaded_values', {}).get(name, models.DEFERRED)
     
     def __str__(self):
         return f"{self.email} ({self.name})"
@@ -21,6 +48,10 @@ class AutoForwarding(models.Model):
         db_table = 'autoforwarding'
         verbose_name = 'Auto Forwarding Rule'
         verbose_name_plural = 'Auto Forwarding Rules'
+        indexes = [
+            # Serves ORDER BY risk_score DESC, id with the (risk_score, id) keyset cursor
+            models.Index(fields=['-risk_score', 'id'], name='autoforwarding_risk_idx'),
+        ]
 
 
 class ForwardingFilter(models.Model):
@@ -49,4 +80,121 @@ class ForwardingFilter(models.Model):
     class Meta:
         db_table = 'forwardingfilter'
         verbose_name = 'Forwarding Filter'
-        verbose_name_plural = 'Forwarding Filters' 
\ No newline at end of file
+        verbose_name_plural = 'Forwarding Filters' 
+
+
+class ForwardingDestination(models.Model):
+    """
+    Django model for Forwarding Destinations
+    Stores every address a rule forwards to, one row per rule and target, for reverse lookups
+    
+    Derived data kept in sync by the repository and model signals:
+    - source "rule": the rule's forwarding_email
+    - source "filter": the forward targets of the rule's filter action
+    """
+    RULE = 'rule'
+    FILTER = 'filter'
+    SOURCES = [(RULE, 'Rule forwarding address'), (FILTER, 'Filter forward action')]
+    
+    forwarding = models.ForeignKey(
+        AutoForwarding,
+        on_delete=models.CASCADE,
+        related_name='destinations',
+        db_column='forwarding_id'
+    )
+    address = models.CharField(max_length=254, db_index=True)
+    domain = models.CharField(max_length=255, null=True, db_index=True)
+    source = models.CharField(max_length=10, choices=SOURCES)
+    
+    def __str__(self):
+        return f"{self.forwarding_id} -> {self.address} ({self.source})"
+    
+    class Meta:
+        db_table = 'forwardingdestination'
+        verbose_name = 'Forwarding Destination'
+        verbose_name_plural = 'Forwarding Destinations'
+
+
+class FilterTerm(models.Model):
+    """
+    Django model for Filter Terms
+    Stores each criteria and action value of a filter as its own row, for indexed filter search
+    
+    Derived data kept in sync by the filter repository and model signals:
+    - kind "criteria" or "action", and the key within that JSON object
+    - value normalized by terms.normalize_term_value (list values get a row each)
+    """
+    CRITERIA = 'criteria'
+    ACTION = 'action'
+    KINDS = [(CRITERIA, 'Filter criteria'), (ACTION, 'Filter action')]
+    
+    filter = models.ForeignKey(
+        ForwardingFilter,
+        on_delete=models.CASCADE,
+        related_name='terms',
+        db_column='filter_id'
+    )
+    kind = models.CharField(max_length=10, choices=KINDS)
+    key = models.CharField(max_length=64)
+    value = models.TextField()
+    
+    def __str__(self):
+        return f"{self.filter_id}: {self.kind}.{self.key} = {self.value}"
+    
+    class Meta:
+        db_table = 'filterterm'
+        verbose_name = 'Filter Term'
+        verbose_name_plural = 'Filter Terms'
+        indexes = [
+            # Covers the search lookup and returns matching filters in ID order
+            models.Index(fields=['kind', 'key', 'value', 'filter'], name='filterterm_lookup_idx'),
+        ]
+
+
+class InvestigationEvent(models.Model):
+    """
+    Django model for Investigation Events
+    Append-only history of analyst changes to a rule's investigation note and disposition
+    
+    Each row records one field change with its old and new value, written in
+    the same transaction as the rule update. Events outlive their rule: the
+    rule ID and email are kept when the rule is deleted.
+    """
+    # Rule fields whose changes are recorded
+    FIELDS = ('investigation_note', 'disposition')
+    
+    forwarding = models.ForeignKey(
+        AutoForwarding,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        # Covered by the timeline index below
+        db_index=False,
+        related_name='events',
+        db_column='forwarding_id'
+    )
+    email = models.EmailField()
+    field = models.CharField(max_length=50)
+    old_value = models.TextField(null=True, blank=True)
+    new_value = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Investigation events are append-only")
+        super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        raise ValueError("Investigation events are append-only")
+    
+    def __str__(self):
+        return f"{self.email} {self.field} at {self.created_at:%Y-%m-%d %H:%M:%S}"
+    
+    class Meta:
+        db_table = 'investigationevent'
+        verbose_name = 'Investigation Event'
+        verbose_name_plural = 'Investigation Events'
+        indexes = [
+            # A rule's timeline in ID order, and the time bounds of changes across all rules
+            models.Index(fields=['forwarding', 'id'], name='investigationevent_rule_idx'),
+            models.Index(fields=['created_at', 'id'], name='investigationevent_time_idx'),
+        ]
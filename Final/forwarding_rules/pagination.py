@@ -0,0 +1,81 @@
+import base64
+import json
+from typing import Any, List, Optional, Tuple
+
+
+# Response header carrying the cursor for the next page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(*values: Any) -> str:
+    """
+    Encode the sort key of the last row on a page into an opaque cursor
+
+    Args:
+        values: Sort key values of the last row (e.g. its id)
+
+    Returns:
+        str: URL-safe cursor token
+    """
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def check_page(limit: Optional[int], skip: int = 0):
+    """
+    Check the page size (and offset) of a paged request
+
+    Raises:
+        ValueError: If `limit` is below 1 or `skip` is negative
+    """
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be at least 1")
+    if skip < 0:
+        raise ValueError("skip must not be negative")
+
+
+def decode_cursor(cursor: str, size: int = 1) -> List[Any]:
+    """
+    Decode a cursor created by encode_cursor
+
+    Args:
+        cursor: Cursor token from a previous page
+        size: Number of sort key values the cursor must contain
+
+    Returns:
+        list: The sort key values
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def decode_id_cursor(cursor: Optional[str]) -> Optional[int]:
+    """Decode a cursor keyed on the row id, returning None when no cursor is given"""
+    if not cursor:
+        return None
+
+    (last_id,) = decode_cursor(cursor)
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError("Invalid cursor")
+    return last_id
+
+
+def decode_risk_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Decode a cursor keyed on (risk_score, id), returning None when no cursor is given"""
+    if not cursor:
+        return None
+
+    values = decode_cursor(cursor, size=2)
+    if any(not isinstance(value, int) or isinstance(value, bool) for value in values):
+        raise ValueError("Invalid cursor")
+    return tuple(values)
@@ -0,0 +1,268 @@
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .matching import FilterMatcher
+
+
+logger = logging.getLogger(__name__)
+
+# Messages sent to a worker process at a time
+REPLAY_BATCH_SIZE = 2000
+
+# (from, recipients, subject, has attachment, size in bytes)
+MessageSummary = Tuple[str, List[str], str, bool, int]
+
+_header_parser = BytesHeaderParser()
+
+
+def summarize_message(raw: bytes) -> MessageSummary:
+    """
+    Extract the fields filters are matched on from a raw RFC 822 message
+
+    Only the headers are parsed, with the fast compat32 policy; encoded
+    words are decoded only where they occur. A message counts as having an
+    attachment when any part is marked `Content-Disposition: attachment`.
+    """
+    headers = _header_parser.parsebytes(raw)
+    recipients = [_header_text(value) for name in ("to", "cc") for value in headers.get_all(name, [])]
+    return (
+        _header_text(headers.get("from", "")),
+        recipients,
+        _header_text(headers.get("subject", "")),
+        b"content-disposition: attachment" in raw.lower(),
+        len(raw),
+    )
+
+
+def _header_text(value) -> str:
+    """Header value as text, decoding RFC 2047 encoded words such as =?utf-8?q?...?="""
+    if not isinstance(value, str):
+        value = str(value)
+    if "=?" in value:
+        try:
+            return str(make_header(decode_header(value)))
+        except (LookupError, UnicodeDecodeError, ValueError):
+            pass
+    return value
+
+
+def iter_mailbox(path: str) -> Iterator[MessageSummary]:
+    """
+    Stream the messages of an mbox file or a directory of .eml files
+
+    Messages are read one at a time, so memory use does not depend on the
+    size of the mailbox.
+    """
+    if os.path.isdir(path):
+        return _iter_eml_directory(path)
+    return _iter_mbox(path)
+
+
+def _iter_eml_directory(path: str) -> Iterator[MessageSummary]:
+    """Stream the .eml files of a directory tree"""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(".eml"):
+                with open(os.path.join(root, name), "rb") as f:
+                    yield summarize_message(f.read())
+
+
+def _iter_mbox(path: str) -> Iterator[MessageSummary]:
+    """Stream the messages of an mbox file, split on its "From " separator lines"""
+    lines = []
+    previous_blank = True
+    with open(path, "rb") as f:
+        for line in f:
+            if previous_blank and line.startswith(b"From "):
+                if lines:
+                    yield summarize_message(b"".join(lines))
+                lines = []
+                previous_blank = False
+                continue
+            lines.append(line)
+            previous_blank = not line.strip()
+    if lines:
+        yield summarize_message(b"".join(lines))
+
+
+class ReplayCounts:
+    """Forwarded message counts, by rule, by destination and by both"""
+
+    def __init__(self):
+        self.messages = 0
+        self.forwarded_messages = 0
+        self.by_rule = Counter()
+        self.by_destination = Counter()
+        self.by_rule_destination = Counter()
+
+    def add_message(self, matches):
+        """Count one message and the filters that fire for it"""
+        self.messages += 1
+        if not matches:
+            return
+        self.forwarded_messages += 1
+        destinations = set()
+        for rule in {(match.rule_id, match.email): match for match in matches}.values():
+            targets = set(rule.forward_targets)
+            self.by_rule[(rule.rule_id, rule.email)] += 1
+            for target in targets:
+                self.by_rule_destination[(rule.rule_id, rule.email, target)] += 1
+            destinations |= targets
+        for destination in destinations:
+            self.by_destination[destination] += 1
+
+    def merge(self, other: "ReplayCounts"):
+        """Add the counts of another batch"""
+        self.messages += other.messages
+        self.forwarded_messages += other.forwarded_messages
+        self.by_rule.update(other.by_rule)
+        self.by_destination.update(other.by_destination)
+        self.by_rule_destination.update(other.by_rule_destination)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Counts as JSON-serializable data, largest first; ties in key order, however batches were merged"""
+        return {
+            "messages": self.messages,
+            "forwarded_messages": self.forwarded_messages,
+            "by_rule": [
+                {"rule_id": rule_id, "email": email, "forwarded": count}
+                for (rule_id, email), count in _largest_first(self.by_rule)
+            ],
+            "by_destination": [
+                {"destination": destination, "forwarded": count}
+                for destination, count in _largest_first(self.by_destination)
+            ],
+            "by_rule_destination": [
+                {"rule_id": rule_id, "email": email, "destination": destination, "forwarded": count}
+                for (rule_id, email, destination), count in _largest_first(self.by_rule_destination)
+            ],
+        }
+
+
+def _largest_first(counts: Counter) -> List[Tuple[Any, int]]:
+    """Counter items by descending count, then by key"""
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+# Matcher of a worker process, compiled once when the process starts
+_worker_matcher: Optional[FilterMatcher] = None
+
+
+def _init_worker(filter_rows: List[Dict[str, Any]]):
+    """Compile the filters once in each worker process"""
+    global _worker_matcher
+    _worker_matcher = FilterMatcher.from_rows(filter_rows)
+
+
+def _match_batch(batch: List[MessageSummary], matcher: Optional[FilterMatcher] = None) -> ReplayCounts:
+    """Match a batch of messages against every filter"""
+    matcher = matcher or _worker_matcher
+    counts = ReplayCounts()
+    for sender, recipients, subject, has_attachment, size in batch:
+        counts.add_message(matcher.match(sender, recipients, subject, has_attachment, size))
+    return counts
+
+
+def _batches(messages: Iterable[MessageSummary], batch_size: int) -> Iterator[List[MessageSummary]]:
+    """Group messages into lists of `batch_size`"""
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def replay_processes(processes: Optional[int] = None) -> int:
+    """
+    Number of worker processes for a replay, one per CPU of this machine
+
+    Runs where the replay does, so that a request made on another machine
+    is held to this one's CPUs: more processes than CPUs are cut down to
+    one per CPU.
+
+    Raises:
+        ValueError: If `processes` is below 1
+    """
+    cpus = os.cpu_count() or 1
+    if processes is None:
+        return cpus
+    if processes < 1:
+        raise ValueError("processes must be at least 1")
+    if processes > cpus:
+        logger.warning("Replaying with %d processes instead of %d, one per CPU", cpus, processes)
+        return cpus
+    return processes
+
+
+def replay_mailbox(path: str, filter_rows: List[Dict[str, Any]], processes: Optional[int] = None,
+                   batch_size: int = REPLAY_BATCH_SIZE) -> Dict[str, Any]:
+    """
+    Count the messages of a mailbox that the filters would have forwarded
+
+    The mailbox is streamed in batches to a pool of worker processes, each
+    holding its own compiled copy of the filters. At most two batches per
+    process are in flight, so memory stays bounded. Inside a daemonic
+    process (a Celery prefork worker) child processes cannot be started, and
+    the batches are matched in the current process instead; the task is
+    therefore routed to the "replay" queue, served by a --pool=solo worker.
+
+    Args:
+        path: mbox file or directory of .eml files
+        filter_rows: Filter rows from the filter repository's iter_filter_rows()
+        processes: Number of worker processes, at most one per CPU
+            (default: one per CPU)
+        batch_size: Messages sent to a worker at a time
+
+    Returns:
+        dict: Message counts from ReplayCounts.as_dict(), plus the number of
+            processes used, unsupported filters and the elapsed time
+
+    Raises:
+        ValueError: If `processes` is below 1
+    """
+    started = time.perf_counter()
+    processes = replay_processes(processes)
+    if processes > 1 and multiprocessing.current_process().daemon:
+        logger.warning("Replaying %s in a daemonic process, matching without a process pool; "
+                       "run the Celery worker with --pool=threads or --pool=solo to use %d processes",
+                       path, processes)
+        processes = 1
+
+    matcher = FilterMatcher.from_rows(filter_rows)
+    counts = ReplayCounts()
+    batches = _batches(iter_mailbox(path), batch_size)
+
+    if processes == 1:
+        for batch in batches:
+            counts.merge(_match_batch(batch, matcher))
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(filter_rows,)) as executor:
+            pending = set()
+            for batch in batches:
+                pending.add(executor.submit(_match_batch, batch))
+                if len(pending) >= processes * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        counts.merge(future.result())
+            for future in pending:
+                counts.merge(future.result())
+
+    result = counts.as_dict()
+    result.update({
+        "processes": processes,
+        "unsupported_filters": matcher.unsupported,
+        "elapsed_seconds": round(time.perf_counter() - started, 2),
+    })
+    return result
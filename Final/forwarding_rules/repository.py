@@ -1,9 +1,22 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional, Dict, Any
-from django.db.models import Count
+from datetime import datetime
+from typing import List, Optional, Dict, Any, Iterable, Iterator, Tuple
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Max
 from django.conf import settings
+from django.core.cache import cache
 
-from .models import AutoForwarding, ForwardingFilter
+from .models import AutoForwarding, ForwardingFilter, ForwardingDestination, FilterTerm, InvestigationEvent
+from .cache import versioned_key, bulk_invalidation, get_data_version, shared_cache
+from .search import filter_email_contains
+from .destinations import action_forward_targets, normalize_address, replace_destinations
+from .domains import address_domain, internal_domain_q
+from .risk import refresh_risk_scores, risk_score
+from .terms import create_filter_terms, normalize_term_value
+from .serialization import RULE_ROW_FIELDS
+from .sqlite import retry_on_lock
+from .routers import PRIMARY_DATABASE, read_database, versioned_read_database
 
 
 # BaseRepository Interface
@@ -20,6 +33,22 @@ class BaseAutoForwardingRepository(ABC):
         """Get all forwarding rules with pagination"""
         pass
     
+    @abstractmethod
+    def get_rules_with_filters(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[AutoForwarding]:
+        """Get forwarding rules with their filter already loaded, ordered by ID"""
+        pass
+    
+    @abstractmethod
+    def iter_rules_with_filters(self, chunk_size: int = 2000, start_id: Optional[int] = None,
+                                end_id: Optional[int] = None) -> Iterator[AutoForwarding]:
+        """Iterate over forwarding rules with their filter, ordered by ID, optionally within an ID range"""
+        pass
+    
+    @abstractmethod
+    def get_id_ranges(self, shard_count: int) -> List[Tuple[int, Optional[int]]]:
+        """Split the rules into ID ranges holding roughly equal numbers of rules"""
+        pass
+    
     @abstractmethod
     def get_rule_by_id(self, rule_id: int) -> Optional[AutoForwarding]:
         """Get a forwarding rule by ID"""
@@ -36,14 +65,171 @@ class BaseAutoForwardingRepository(ABC):
         pass
     
     @abstractmethod
-    def search_rules(self, email: Optional[str] = None, has_filters: Optional[bool] = None) -> List[AutoForwarding]:
+    def bulk_delete_rules(self, rule_ids: Optional[List[int]] = None, email: Optional[str] = None,
+                          has_filters: Optional[bool] = None) -> List[int]:
+        """Delete many forwarding rules and their filters, returning the deleted IDs"""
+        pass
+    
+    @abstractmethod
+    def search_rules(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                     destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[AutoForwarding]:
         """Search for forwarding rules"""
         pass
     
+    @abstractmethod
+    def search_rules_with_filters(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                                  after: Optional[int] = None, limit: Optional[int] = None,
+                                  destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[AutoForwarding]:
+        """Search for forwarding rules with their filter already loaded, ordered by ID"""
+        pass
+    
+    @abstractmethod
+    def get_rule_rows(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get forwarding rules with their filter as plain rows, ordered by ID"""
+        pass
+    
+    @abstractmethod
+    def get_rule_rows_by_risk(self, skip: int = 0, limit: int = 100,
+                              after: Optional[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+        """Get forwarding rules with their filter as plain rows, highest risk score first"""
+        pass
+    
+    @abstractmethod
+    def search_rule_rows(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                         after: Optional[int] = None, limit: Optional[int] = None,
+                         destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """Search for forwarding rules with their filter as plain rows, ordered by ID"""
+        pass
+    
     @abstractmethod
     def get_statistics(self) -> Dict[str, int]:
         """Get statistics about forwarding rules"""
         pass
+    
+    @abstractmethod
+    def get_destination_domain_counts(self) -> List[Tuple[Optional[str], int]]:
+        """Get the number of rules forwarding to each destination domain (None for no forwarding)"""
+        pass
+    
+    @abstractmethod
+    def get_data_fingerprint(self) -> str:
+        """Get a value that changes whenever rule or filter data changes"""
+        pass
+    
+    @abstractmethod
+    def bulk_upsert_rules(self, rules_data: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Create or update many forwarding rules keyed on email, returning their IDs by email"""
+        pass
+    
+    @abstractmethod
+    def iter_forwarding_targets(self, rule_ids: Optional[Iterable[int]] = None) -> Iterator[Dict[str, Any]]:
+        """Iterate over rules as rows of id, email, forwarding_email and their filter's action"""
+        pass
+    
+    @abstractmethod
+    def get_rules_forwarding_to(self, address: Optional[str] = None, domain: Optional[str] = None,
+                                after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Find the rules forwarding to an address or to any address of a domain"""
+        pass
+    
+    @abstractmethod
+    def get_rule_history(self, rule_id: int, after: Optional[int] = None,
+                         limit: int = 100) -> List[Dict[str, Any]]:
+        """Get the investigation events of a rule, oldest first"""
+        pass
+    
+    @abstractmethod
+    def get_history_since(self, since: datetime, until: Optional[datetime] = None,
+                          after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Get the investigation events of all rules in a time range, oldest first"""
+        pass
+
+
+    # Async variants, for use from async views
+    
+    @abstractmethod
+    async def aget_rules_with_filters(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[AutoForwarding]:
+        """Async version of get_rules_with_filters"""
+        pass
+    
+    @abstractmethod
+    async def aget_rule_by_id(self, rule_id: int) -> Optional[AutoForwarding]:
+        """Async version of get_rule_by_id"""
+        pass
+    
+    @abstractmethod
+    async def aupdate_rule(self, rule_id: int, updates: Dict[str, Any]) -> Optional[AutoForwarding]:
+        """Async version of update_rule"""
+        pass
+    
+    @abstractmethod
+    async def adelete_rule(self, rule_id: int) -> bool:
+        """Async version of delete_rule"""
+        pass
+    
+    @abstractmethod
+    async def abulk_delete_rules(self, rule_ids: Optional[List[int]] = None, email: Optional[str] = None,
+                                 has_filters: Optional[bool] = None) -> List[int]:
+        """Async version of bulk_delete_rules"""
+        pass
+    
+    @abstractmethod
+    async def asearch_rules_with_filters(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                                         after: Optional[int] = None, limit: Optional[int] = None,
+                                         destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[AutoForwarding]:
+        """Async version of search_rules_with_filters"""
+        pass
+    
+    @abstractmethod
+    async def aget_rule_rows(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Async version of get_rule_rows"""
+        pass
+    
+    @abstractmethod
+    async def aget_rule_rows_by_risk(self, skip: int = 0, limit: int = 100,
+                                     after: Optional[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+        """Async version of get_rule_rows_by_risk"""
+        pass
+    
+    @abstractmethod
+    async def asearch_rule_rows(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                                after: Optional[int] = None, limit: Optional[int] = None,
+                                destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """Async version of search_rule_rows"""
+        pass
+    
+    @abstractmethod
+    async def aget_statistics(self) -> Dict[str, int]:
+        """Async version of get_statistics"""
+        pass
+    
+    @abstractmethod
+    async def aget_destination_domain_counts(self) -> List[Tuple[Optional[str], int]]:
+        """Async version of get_destination_domain_counts"""
+        pass
+    
+    @abstractmethod
+    async def aget_data_fingerprint(self) -> str:
+        """Async version of get_data_fingerprint"""
+        pass
+    
+    @abstractmethod
+    async def aget_rules_forwarding_to(self, address: Optional[str] = None, domain: Optional[str] = None,
+                                       after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Async version of get_rules_forwarding_to"""
+        pass
+    
+    @abstractmethod
+    async def aget_rule_history(self, rule_id: int, after: Optional[int] = None,
+                                limit: int = 100) -> List[Dict[str, Any]]:
+        """Async version of get_rule_history"""
+        pass
+    
+    @abstractmethod
+    async def aget_history_since(self, since: datetime, until: Optional[datetime] = None,
+                                 after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Async version of get_history_since"""
+        pass
 
 
 class BaseForwardingFilterRepository(ABC):
@@ -63,39 +249,145 @@ class BaseForwardingFilterRepository(ABC):
     def delete_filters_for_rule(self, rule_id: int) -> bool:
         """Delete all filters for a forwarding rule"""
         pass
+    
+    @abstractmethod
+    def replace_filters_for_rules(self, filters_by_rule: Dict[int, Optional[Dict[str, Any]]]) -> int:
+        """Replace the filters of many forwarding rules, returning the number of filters created"""
+        pass
+    
+    @abstractmethod
+    def iter_filter_rows(self) -> Iterator[Dict[str, Any]]:
+        """Iterate over all filters as rows with the rule's email, for compiling the match engine"""
+        pass
+    
+    @abstractmethod
+    def search_filters(self, terms: List[Tuple[str, str, Any]], after: Optional[int] = None,
+                       limit: int = 100) -> List[Dict[str, Any]]:
+        """Find the filters having every (kind, key, value) criteria or action term"""
+        pass
+    
+    # Async variants, for use from async views
+    
+    @abstractmethod
+    async def aget_filters_for_rule(self, rule_id: int) -> List[ForwardingFilter]:
+        """Async version of get_filters_for_rule"""
+        pass
+    
+    @abstractmethod
+    async def adelete_filters_for_rule(self, rule_id: int) -> bool:
+        """Async version of delete_filters_for_rule"""
+        pass
+    
+    @abstractmethod
+    async def asearch_filters(self, terms: List[Tuple[str, str, Any]], after: Optional[int] = None,
+                              limit: int = 100) -> List[Dict[str, Any]]:
+        """Async version of search_filters"""
+        pass
 
 
 # Django Implementation
 class DjangoAutoForwardingRepository(BaseAutoForwardingRepository):
     """Django implementation of Auto Forwarding repository"""
     
+    # Number of rules deleted per statement by bulk_delete_rules
+    DELETE_BATCH_SIZE = 500
+    
+    # Number of rule IDs per IN (...) lookup
+    LOOKUP_BATCH_SIZE = 500
+    
+    @retry_on_lock
     def create_rule(self, rule_data: Dict[str, Any]) -> AutoForwarding:
         """Create a new forwarding rule"""
         rule = AutoForwarding.objects.create(**rule_data)
         return rule
     
     def get_all_rules(self, skip: int = 0, limit: int = 100) -> List[AutoForwarding]:
-        """Get all forwarding rules with pagination"""
-        return list(AutoForwarding.objects.all()[skip:skip + limit])
+        """Get all forwarding rules with pagination (from the read replica, if configured)"""
+        return list(AutoForwarding.objects.using(read_database()).order_by('id')[skip:skip + limit])
+    
+    def get_rules_with_filters(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[AutoForwarding]:
+        """
+        Get forwarding rules with their filter joined in the same query
+        
+        When `after` is given, the page starts after that rule ID (keyset
+        pagination on the primary key) and `skip` is ignored.
+        """
+        queryset = AutoForwarding.objects.select_related('filter').order_by('id')
+        if after is not None:
+            return list(queryset.filter(id__gt=after)[:limit])
+        return list(queryset[skip:skip + limit])
+    
+    def iter_rules_with_filters(self, chunk_size: int = 2000, start_id: Optional[int] = None,
+                                end_id: Optional[int] = None) -> Iterator[AutoForwarding]:
+        """
+        Iterate over forwarding rules with their filter joined
+        
+        Rows are fetched from the database `chunk_size` at a time and not
+        cached on the queryset, so memory use does not grow with the table.
+        `start_id` (inclusive) and `end_id` (exclusive) limit the ID range.
+        Reads from the read replica, if configured.
+        """
+        queryset = AutoForwarding.objects.using(read_database()).select_related('filter').order_by('id')
+        if start_id is not None:
+            queryset = queryset.filter(id__gte=start_id)
+        if end_id is not None:
+            queryset = queryset.filter(id__lt=end_id)
+        return queryset.iterator(chunk_size=chunk_size)
+    
+    def get_id_ranges(self, shard_count: int) -> List[Tuple[int, Optional[int]]]:
+        """
+        Split the rules into ID ranges holding roughly equal numbers of rules
+        
+        Reads from the read replica, if configured.
+        
+        Returns:
+            list: (start_id, end_id) tuples, start inclusive and end exclusive;
+                the last range has no end
+        """
+        rules = AutoForwarding.objects.using(read_database())
+        total = rules.count()
+        if total == 0:
+            return []
+        
+        shard_size = -(-total // shard_count)
+        ids = rules.order_by('id').values_list('id', flat=True)
+        starts = [ids[offset] for offset in range(0, total, shard_size)]
+        ends = starts[1:] + [None]
+        return list(zip(starts, ends))
     
     def get_rule_by_id(self, rule_id: int) -> Optional[AutoForwarding]:
-        """Get a forwarding rule by ID"""
+        """Get a forwarding rule by ID (with its filter joined)"""
         try:
-            return AutoForwarding.objects.get(id=rule_id)
+            return AutoForwarding.objects.select_related('filter').get(id=rule_id)
         except AutoForwarding.DoesNotExist:
             return None
     
+    @retry_on_lock
     def update_rule(self, rule_id: int, updates: Dict[str, Any]) -> Optional[AutoForwarding]:
-        """Update a forwarding rule"""
-        try:
-            rule = AutoForwarding.objects.get(id=rule_id)
+        """
+        Update a forwarding rule
+        
+        Changes to the investigation note and disposition are appended to
+        the rule's investigation history in the same transaction.
+        """
+        with transaction.atomic():
+            try:
+                rule = AutoForwarding.objects.select_related('filter').get(id=rule_id)
+            except AutoForwarding.DoesNotExist:
+                return None
+            events = [
+                InvestigationEvent(forwarding_id=rule.id, email=rule.email, field=key,
+                                   old_value=getattr(rule, key), new_value=value)
+                for key, value in updates.items()
+                if key in InvestigationEvent.FIELDS and getattr(rule, key) != value
+            ]
             for key, value in updates.items():
                 setattr(rule, key, value)
             rule.save()
+            InvestigationEvent.objects.bulk_create(events)
             return rule
-        except AutoForwarding.DoesNotExist:
-            return None
     
+    @retry_on_lock
     def delete_rule(self, rule_id: int) -> bool:
         """Delete a forwarding rule"""
         try:
@@ -105,40 +397,485 @@ class DjangoAutoForwardingRepository(BaseAutoForwardingRepository):
         except AutoForwarding.DoesNotExist:
             return False
     
-    def search_rules(self, email: Optional[str] = None, has_filters: Optional[bool] = None) -> List[AutoForwarding]:
-        """Search for forwarding rules"""
-        queryset = AutoForwarding.objects.all()
+    @retry_on_lock
+    def bulk_delete_rules(self, rule_ids: Optional[List[int]] = None, email: Optional[str] = None,
+                          has_filters: Optional[bool] = None) -> List[int]:
+        """
+        Delete many forwarding rules and their filters in one transaction
+        
+        Rules are selected by ID, by the same predicate as search_rules, or
+        by both (rules must then match both). Rows are deleted with
+        DELETE ... WHERE id IN (...) statements, a batch of IDs at a time.
+        
+        Returns:
+            list: IDs of the deleted rules
+        """
+        queryset = self._search_queryset(email, has_filters)
+        if rule_ids is not None:
+            queryset = queryset.filter(id__in=rule_ids)
+        
+        with transaction.atomic(), bulk_invalidation() as changed_rules:
+            deleted_ids = list(queryset.order_by('id').values_list('id', flat=True))
+            changed_rules.update(deleted_ids)
+            for start in range(0, len(deleted_ids), self.DELETE_BATCH_SIZE):
+                batch = deleted_ids[start:start + self.DELETE_BATCH_SIZE]
+                # Filters are removed by the cascade, in the same batch
+                AutoForwarding.objects.filter(id__in=batch).delete()
+        
+        return deleted_ids
+    
+    def search_rules(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                     destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[AutoForwarding]:
+        """Search for forwarding rules (on the read replica, if configured)"""
+        return list(self._search_queryset(email, has_filters, using=read_database(),
+                                          destination_domain=destination_domain, external=external))
+    
+    def search_rules_with_filters(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                                  after: Optional[int] = None, limit: Optional[int] = None,
+                                  destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[AutoForwarding]:
+        """Search for forwarding rules with their filter joined in the same query"""
+        queryset = self._search_queryset(email, has_filters, destination_domain=destination_domain, external=external)
+        queryset = queryset.select_related('filter').order_by('id')
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        if limit is not None:
+            queryset = queryset[:limit]
+        return list(queryset)
+    
+    def get_rule_rows(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Get forwarding rules with their filter joined, as .values() rows
+        
+        Skipping model instances saves most of the per-row cost on large
+        pages. Paging works as in get_rules_with_filters. Reads from the
+        read replica, if configured.
+        """
+        return list(self._rows_page(AutoForwarding.objects.using(read_database()), skip, limit, after))
+    
+    def get_rule_rows_by_risk(self, skip: int = 0, limit: int = 100,
+                              after: Optional[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+        """
+        Get forwarding rules with their filter joined, as .values() rows, highest risk score first
+        
+        Rules with the same score are ordered by ID. Reads walk the
+        (risk_score DESC, id) index. When `after` is given, as the
+        (risk_score, id) of the last row of the previous page, the page
+        starts after that rule and `skip` is ignored. Reads from the read
+        replica, if configured.
+        """
+        return list(self._risk_rows_page(skip, limit, after))
+    
+    def search_rule_rows(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                         after: Optional[int] = None, limit: Optional[int] = None,
+                         destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """Search for forwarding rules with their filter joined, as .values() rows (on the read replica, if configured)"""
+        queryset = self._search_queryset(email, has_filters, using=read_database(),
+                                         destination_domain=destination_domain, external=external)
+        return list(self._rows_page(queryset, 0, limit, after))
+    
+    def _risk_rows_page(self, skip: int, limit: int, after: Optional[Tuple[int, int]]):
+        """Select one page of rule rows (RULE_ROW_FIELDS), ordered by risk score and then ID"""
+        queryset = AutoForwarding.objects.using(read_database()).order_by('-risk_score', 'id').values(*RULE_ROW_FIELDS)
+        if after is not None:
+            last_score, last_id = after
+            # The redundant <= bound lets the database seek into the index instead of scanning it
+            queryset = queryset.filter(
+                Q(risk_score__lt=last_score) | Q(risk_score=last_score, id__gt=last_id),
+                risk_score__lte=last_score,
+            )
+            skip = 0
+        return queryset[skip:skip + limit]
+    
+    def _rows_page(self, queryset, skip: int, limit: Optional[int], after: Optional[int]):
+        """Select one page of rule rows (RULE_ROW_FIELDS) from a queryset, ordered by ID"""
+        queryset = queryset.order_by('id').values(*RULE_ROW_FIELDS)
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+            skip = 0
+        if limit is not None:
+            return queryset[skip:skip + limit]
+        return queryset[skip:]
+    
+    def _search_queryset(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                         using: Optional[str] = None, destination_domain: Optional[str] = None,
+                         external: Optional[bool] = None):
+        """
+        Build the queryset shared by the search methods, on the `using` database (the primary by default)
+        
+        `destination_domain` and `external` are answered from the
+        destination_domain column. `external` matches that column against
+        INTERNAL_DOMAINS and their subdomains in the same query, so a rule
+        written a moment ago is classed like every other rule.
+        """
+        queryset = AutoForwarding.objects.using(using)
         
         if email:
-            queryset = queryset.filter(email__icontains=email)
+            queryset = filter_email_contains(queryset, email)
         
         if has_filters is not None:
             queryset = queryset.filter(has_forwarding_filters=has_filters)
         
-        return list(queryset)
+        if destination_domain:
+            queryset = queryset.filter(destination_domain=destination_domain.strip().lstrip('@').lower())
+        
+        if external is not None:
+            internal = internal_domain_q('destination_domain')
+            if external:
+                queryset = queryset.filter(destination_domain__isnull=False).exclude(internal)
+            else:
+                queryset = queryset.filter(internal)
+        
+        return queryset
     
     def get_statistics(self) -> Dict[str, int]:
-        """Get statistics about forwarding rules"""
-        total_rules = AutoForwarding.objects.count()
-        active_forwarding = AutoForwarding.objects.exclude(forwarding_email__isnull=True).count()
-        with_filters = AutoForwarding.objects.filter(has_forwarding_filters=True).count()
-        with_errors = AutoForwarding.objects.exclude(error__isnull=True).count()
+        """
+        Get statistics about forwarding rules
+        
+        Computed on the read replica, if configured. With a shared cache,
+        results read from the primary are cached until the next write to a
+        rule or filter; those read from the replica are not (see
+        versioned_read_database()).
+        """
+        database = read_database()
+        if database != PRIMARY_DATABASE or not shared_cache():
+            return self._compute_statistics(database)
+        key = versioned_key("statistics")
+        stats = cache.get(key)
+        if stats is None:
+            stats = self._compute_statistics(database)
+            cache.set(key, stats, settings.STATISTICS_CACHE_TIMEOUT)
+        return stats
+    
+    def _compute_statistics(self, using: Optional[str] = None) -> Dict[str, int]:
+        """Compute all statistics with a single conditional-aggregation query"""
+        # Each rule has at most one filter, so the join does not duplicate rules
+        return AutoForwarding.objects.using(using).aggregate(
+            total_rules=Count('id'),
+            active_forwarding=Count('id', filter=Q(forwarding_email__isnull=False)),
+            rules_with_filters=Count('id', filter=Q(has_forwarding_filters=True)),
+            rules_with_errors=Count('id', filter=Q(error__isnull=False)),
+            total_filters=Count('filter'),
+        )
+    
+    def get_destination_domain_counts(self) -> List[Tuple[Optional[str], int]]:
+        """
+        Get the number of rules forwarding to each destination domain, most first
+        
+        One GROUP BY over the destination_domain index, read and cached like
+        the statistics. Rules without forwarding are counted under None.
+        """
+        database = read_database()
+        if database != PRIMARY_DATABASE or not shared_cache():
+            return self._compute_destination_domain_counts(database)
+        key = versioned_key("destination_domains")
+        counts = cache.get(key)
+        if counts is None:
+            counts = self._compute_destination_domain_counts(database)
+            cache.set(key, counts, settings.STATISTICS_CACHE_TIMEOUT)
+        return counts
+    
+    def _compute_destination_domain_counts(self, using: Optional[str] = None) -> List[Tuple[Optional[str], int]]:
+        """Count the rules per destination domain with one GROUP BY"""
+        rows = (
+            AutoForwarding.objects.using(using)
+            .values_list('destination_domain')
+            .annotate(rules=Count('id'))
+            .order_by()
+        )
+        return sorted(rows, key=lambda row: (-row[1], row[0] or ''))
+    
+    def get_data_fingerprint(self) -> str:
+        """
+        Get a value that changes whenever rule or filter data changes
+        
+        Combines the data version with the highest rule ID and the row
+        counts, so writes that bypass the model signals (bulk updates,
+        other tools writing to the database) still change the fingerprint.
+        The counts are read from the read replica, if configured, like the
+        report data they fingerprint.
+        """
+        data = AutoForwarding.objects.using(read_database()).aggregate(
+            max_id=Max('id'),
+            rules=Count('id'),
+            filters=Count('filter'),
+        )
+        return f"{get_data_version()}-{data['max_id'] or 0}-{data['rules']}-{data['filters']}"
+    
+    @retry_on_lock
+    def bulk_upsert_rules(self, rules_data: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Create or update many forwarding rules keyed on their unique email
+        
+        Uses a single INSERT ... ON CONFLICT DO UPDATE per database batch
+        instead of a lookup and a save per rule. Existing rules only have the
+        fields given for them updated, and changes to their investigation
+        note or disposition are appended to the investigation history in the
+        same transaction, as with update_rule.
+        
+        Args:
+            rules_data: Rule field dictionaries, each including "email"
+            
+        Returns:
+            dict: Rule IDs keyed by email
+        """
+        if not rules_data:
+            return {}
         
-        # Get total filters
-        total_filters = ForwardingFilter.objects.count()
+        emails = [data['email'] for data in rules_data]
+        # Rows giving the same fields are upserted together, so a rule is never
+        # reset to the defaults of fields given only for other rules
+        rows_by_fields: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for data in rules_data:
+            rows_by_fields.setdefault(tuple(sorted(set(data) - {'email'})), []).append(data)
         
-        return {
-            "total_rules": total_rules,
-            "active_forwarding": active_forwarding,
-            "rules_with_filters": with_filters,
-            "rules_with_errors": with_errors,
-            "total_filters": total_filters
-        }
+        with transaction.atomic(), bulk_invalidation() as changed_rules:
+            tracked = sorted({key for data in rules_data for key in data} & set(InvestigationEvent.FIELDS))
+            previous = {}
+            if tracked:
+                previous = {
+                    row['email']: row
+                    for row in AutoForwarding.objects.filter(email__in=emails).values('id', 'email', *tracked)
+                }
+            
+            for fields, rows in rows_by_fields.items():
+                # bulk_create skips the pre_save signals, so derive the destination domain and
+                # the risk score here; scores of existing rules are all refreshed below
+                rules = [AutoForwarding(**data) for data in rows]
+                for rule in rules:
+                    rule.destination_domain = address_domain(rule.forwarding_email)
+                    rule.risk_score = risk_score(rule.destination_domain, rule.error)
+                update_fields = list(fields) + (['destination_domain'] if 'forwarding_email' in fields else [])
+                AutoForwarding.objects.bulk_create(
+                    rules,
+                    update_conflicts=bool(update_fields),
+                    ignore_conflicts=not update_fields,
+                    unique_fields=['email'] if update_fields else None,
+                    update_fields=update_fields or None,
+                )
+            
+            InvestigationEvent.objects.bulk_create([
+                InvestigationEvent(forwarding_id=previous[data['email']]['id'], email=data['email'], field=key,
+                                   old_value=previous[data['email']][key], new_value=data[key])
+                for data in rules_data if data['email'] in previous
+                for key in tracked if key in data and previous[data['email']][key] != data[key]
+            ])
+            
+            # Upserts do not return primary keys on every backend, so read them back
+            ids_by_email = dict(AutoForwarding.objects.filter(email__in=emails).values_list('email', 'id'))
+            changed_rules.update(ids_by_email.values())
+            replace_destinations({
+                ids_by_email[data['email']]: [data.get('forwarding_email')]
+                for data in rules_data if 'forwarding_email' in data
+            }, ForwardingDestination.RULE)
+            refresh_risk_scores(ids_by_email.values())
+        
+        return ids_by_email
+    
+    def iter_forwarding_targets(self, rule_ids: Optional[Iterable[int]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over rules with their rule-level and filter-level forward targets
+        
+        One LEFT JOIN over both tables, as .values() rows with id, email,
+        forwarding_email and filter__action, fetched in chunks. `rule_ids`
+        limits the rows to those rules. Reads from the primary, so a caller
+        refreshing the rules of a write never sees the replica lag behind it.
+        """
+        queryset = AutoForwarding.objects.order_by('id').values('id', 'email', 'forwarding_email', 'filter__action')
+        if rule_ids is None:
+            yield from queryset.iterator(chunk_size=2000)
+            return
+        rule_ids = sorted(rule_ids)
+        for start in range(0, len(rule_ids), self.LOOKUP_BATCH_SIZE):
+            yield from queryset.filter(id__in=rule_ids[start:start + self.LOOKUP_BATCH_SIZE])
+    
+    def get_rules_forwarding_to(self, address: Optional[str] = None, domain: Optional[str] = None,
+                                after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Find the rules forwarding to an address or to any address of a domain
+        
+        Looks the target up in the indexed destination table, which holds
+        one row per rule and target for both forwarding_email and the
+        forward action of the rule's filter, instead of scanning the rules.
+        
+        Args:
+            address: Exact target address (case-insensitive)
+            domain: Target domain (case-insensitive)
+            after: Only return matches with a higher match ID (keyset cursor)
+            limit: Most matches returned
+            
+        Returns:
+            list: Rows of id (the match, for paging), rule_id, email, address
+                and source ("rule" or "filter"), ordered by id
+        """
+        return list(self._destination_rows(address, domain, after)[:limit])
+    
+    def _destination_rows(self, address: Optional[str], domain: Optional[str], after: Optional[int]):
+        """Select destination matches as rows with the email of their rule, ordered by ID"""
+        queryset = ForwardingDestination.objects.using(versioned_read_database())
+        if address is not None:
+            queryset = queryset.filter(address=normalize_address(address))
+        if domain is not None:
+            queryset = queryset.filter(domain=domain.strip().lower())
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        return queryset.order_by('id').values(
+            'id', 'address', 'source', rule_id=F('forwarding_id'), email=F('forwarding__email'),
+        )
+    
+    def get_rule_history(self, rule_id: int, after: Optional[int] = None,
+                         limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Get the investigation events of a rule, oldest first
+        
+        One range scan of the (rule, id) index. Events of deleted rules
+        are kept and still returned.
+        
+        Args:
+            rule_id: Rule ID
+            after: ID of the last event of the previous page
+            limit: Most events returned
+        """
+        return list(self._history_rows(after, rule_id=rule_id)[:limit])
+    
+    def get_history_since(self, since: datetime, until: Optional[datetime] = None,
+                          after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Get the investigation events of all rules in a time range, oldest first
+        
+        Events are paged in ID order, which is the order they were
+        committed in as SQLite runs one write transaction at a time;
+        `created_at` only bounds the range. The time is taken before the
+        write commits, so an event can commit after one stamped later, and
+        a cursor on the time would skip it.
+        
+        Args:
+            since: Earliest event time (inclusive)
+            until: Latest event time (exclusive), or None for no end
+            after: ID of the last event of the previous page
+            limit: Most events returned
+        """
+        return list(self._history_rows(after, since=since, until=until)[:limit])
+    
+    def _history_rows(self, after: Optional[int], rule_id: Optional[int] = None,
+                      since: Optional[datetime] = None, until: Optional[datetime] = None):
+        """Select investigation events as rows ordered by ID, after a keyset cursor"""
+        queryset = InvestigationEvent.objects.using(versioned_read_database())
+        if rule_id is not None:
+            queryset = queryset.filter(forwarding_id=rule_id)
+        if since is not None:
+            queryset = queryset.filter(created_at__gte=since)
+        if until is not None:
+            queryset = queryset.filter(created_at__lt=until)
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        return queryset.order_by('id').values(
+            'id', 'email', 'field', 'old_value', 'new_value', 'created_at', rule_id=F('forwarding_id'),
+        )
+
+
+    # Async variants. Reads use the async ORM; methods that need a transaction
+    # or the cache run their sync version in a worker thread.
+    
+    async def aget_rules_with_filters(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[AutoForwarding]:
+        """Get forwarding rules with their filter joined, without blocking the event loop"""
+        queryset = AutoForwarding.objects.select_related('filter').order_by('id')
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)[:limit]
+        else:
+            queryset = queryset[skip:skip + limit]
+        return [rule async for rule in queryset]
+    
+    async def aget_rule_by_id(self, rule_id: int) -> Optional[AutoForwarding]:
+        """Get a forwarding rule by ID (with its filter joined), without blocking the event loop"""
+        try:
+            return await AutoForwarding.objects.select_related('filter').aget(id=rule_id)
+        except AutoForwarding.DoesNotExist:
+            return None
+    
+    async def aupdate_rule(self, rule_id: int, updates: Dict[str, Any]) -> Optional[AutoForwarding]:
+        """Update a forwarding rule and record its history in one transaction, run in a worker thread"""
+        return await sync_to_async(self.update_rule)(rule_id, updates)
+    
+    async def adelete_rule(self, rule_id: int) -> bool:
+        """Delete a forwarding rule in one transaction, run in a worker thread"""
+        return await sync_to_async(self.delete_rule)(rule_id)
+    
+    async def abulk_delete_rules(self, rule_ids: Optional[List[int]] = None, email: Optional[str] = None,
+                                 has_filters: Optional[bool] = None) -> List[int]:
+        """Delete many forwarding rules in one transaction, run in a worker thread"""
+        return await sync_to_async(self.bulk_delete_rules)(rule_ids, email, has_filters)
+    
+    async def asearch_rules_with_filters(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                                         after: Optional[int] = None, limit: Optional[int] = None,
+                                         destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[AutoForwarding]:
+        """Search for forwarding rules with their filter joined, without blocking the event loop"""
+        # Building the queryset introspects the schema for the search index,
+        # which is only possible from sync code
+        queryset = await sync_to_async(self._search_queryset)(
+            email, has_filters, destination_domain=destination_domain, external=external)
+        queryset = queryset.select_related('filter').order_by('id')
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        if limit is not None:
+            queryset = queryset[:limit]
+        return [rule async for rule in queryset]
+    
+    async def aget_rule_rows(self, skip: int = 0, limit: int = 100, after: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get forwarding rules with their filter joined, as .values() rows, without blocking the event loop"""
+        queryset = self._rows_page(AutoForwarding.objects.using(read_database()), skip, limit, after)
+        return [row async for row in queryset]
+    
+    async def aget_rule_rows_by_risk(self, skip: int = 0, limit: int = 100,
+                                     after: Optional[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+        """Get forwarding rules as .values() rows, highest risk score first, without blocking the event loop"""
+        return [row async for row in self._risk_rows_page(skip, limit, after)]
+    
+    async def asearch_rule_rows(self, email: Optional[str] = None, has_filters: Optional[bool] = None,
+                                after: Optional[int] = None, limit: Optional[int] = None,
+                                destination_domain: Optional[str] = None, external: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """Search for forwarding rules with their filter joined, as .values() rows, without blocking the event loop"""
+        # Building the queryset introspects the schema for the search index,
+        # which is only possible from sync code
+        queryset = await sync_to_async(self._search_queryset)(
+            email, has_filters, using=read_database(), destination_domain=destination_domain, external=external)
+        queryset = self._rows_page(queryset, 0, limit, after)
+        return [row async for row in queryset]
+    
+    async def aget_statistics(self) -> Dict[str, int]:
+        """Get (cached) statistics, run in a worker thread"""
+        return await sync_to_async(self.get_statistics)()
+    
+    async def aget_destination_domain_counts(self) -> List[Tuple[Optional[str], int]]:
+        """Get (cached) destination domain counts, run in a worker thread"""
+        return await sync_to_async(self.get_destination_domain_counts)()
+    
+    async def aget_data_fingerprint(self) -> str:
+        """Get the data fingerprint, run in a worker thread"""
+        return await sync_to_async(self.get_data_fingerprint)()
+    
+    async def aget_rules_forwarding_to(self, address: Optional[str] = None, domain: Optional[str] = None,
+                                       after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Find the rules forwarding to an address or domain without blocking the event loop"""
+        return [row async for row in self._destination_rows(address, domain, after)[:limit]]
+    
+    async def aget_rule_history(self, rule_id: int, after: Optional[int] = None,
+                                limit: int = 100) -> List[Dict[str, Any]]:
+        """Get the investigation events of a rule without blocking the event loop"""
+        return [row async for row in self._history_rows(after, rule_id=rule_id)[:limit]]
+    
+    async def aget_history_since(self, since: datetime, until: Optional[datetime] = None,
+                                 after: Optional[int] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Get the investigation events of all rules in a time range without blocking the event loop"""
+        return [row async for row in self._history_rows(after, since=since, until=until)[:limit]]
 
 
 class DjangoForwardingFilterRepository(BaseForwardingFilterRepository):
     """Django implementation of Forwarding Filter repository"""
     
+    # Index entries counted per term to find the rarest term of a search
+    TERM_SAMPLE_SIZE = 10000
+    
+    @retry_on_lock
     def create_filter(self, filter_data: Dict[str, Any]) -> ForwardingFilter:
         """Create a new forwarding filter"""
         forwarding_id = filter_data.pop('forwarding_id', None)
@@ -163,6 +900,7 @@ class DjangoForwardingFilterRepository(BaseForwardingFilterRepository):
         """Get all filters for a forwarding rule"""
         return list(ForwardingFilter.objects.filter(forwarding_id=rule_id))
     
+    @retry_on_lock
     def delete_filters_for_rule(self, rule_id: int) -> bool:
         """Delete all filters for a forwarding rule"""
         filters = ForwardingFilter.objects.filter(forwarding_id=rule_id)
@@ -178,6 +916,158 @@ class DjangoForwardingFilterRepository(BaseForwardingFilterRepository):
             pass
             
         return count > 0
+    
+    @retry_on_lock
+    def replace_filters_for_rules(self, filters_by_rule: Dict[int, Optional[Dict[str, Any]]]) -> int:
+        """
+        Replace the filters of many forwarding rules with set-based statements
+        
+        Existing filters of the given rules are deleted, the new ones are
+        bulk inserted, and has_forwarding_filters is updated to match.
+        Call it inside a transaction.
+        
+        Args:
+            filters_by_rule: Filter data (criteria, action, created_at) keyed by
+                rule ID, or None for rules that should have no filter
+                
+        Returns:
+            int: Number of filters created
+        """
+        rule_ids = list(filters_by_rule)
+        with_filters = [rule_id for rule_id, data in filters_by_rule.items() if data]
+        without_filters = [rule_id for rule_id, data in filters_by_rule.items() if not data]
+        
+        with bulk_invalidation() as changed_rules:
+            changed_rules.update(rule_ids)
+            ForwardingFilter.objects.filter(forwarding_id__in=rule_ids).delete()
+            filters = ForwardingFilter.objects.bulk_create([
+                ForwardingFilter(
+                    forwarding_id=rule_id,
+                    criteria=filters_by_rule[rule_id].get('criteria', {}),
+                    action=filters_by_rule[rule_id].get('action', {}),
+                    created_at=filters_by_rule[rule_id].get('created_at'),
+                )
+                for rule_id in with_filters
+            ])
+            if any(filter_obj.pk is None for filter_obj in filters):
+                # Backends that cannot return IDs from a bulk insert
+                ids_by_rule = dict(
+                    ForwardingFilter.objects.filter(forwarding_id__in=with_filters).values_list('forwarding_id', 'id'))
+                for filter_obj in filters:
+                    filter_obj.pk = ids_by_rule[filter_obj.forwarding_id]
+            create_filter_terms((filter_obj.pk, filter_obj.criteria, filter_obj.action) for filter_obj in filters)
+            AutoForwarding.objects.filter(id__in=with_filters).update(has_forwarding_filters=True)
+            AutoForwarding.objects.filter(id__in=without_filters).update(has_forwarding_filters=False)
+            replace_destinations({
+                rule_id: action_forward_targets((data or {}).get('action'))
+                for rule_id, data in filters_by_rule.items()
+            }, ForwardingDestination.FILTER)
+            refresh_risk_scores(rule_ids)
+        
+        return len(with_filters)
+    
+    def iter_filter_rows(self) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over all filters as .values() rows, with the email of their rule
+        
+        Rows are fetched in chunks, so compiling the match engine does not
+        hold every filter as a model instance.
+        """
+        return ForwardingFilter.objects.order_by('id').values(
+            'id', 'forwarding_id', 'forwarding__email', 'criteria', 'action'
+        ).iterator(chunk_size=2000)
+    
+    def search_filters(self, terms: List[Tuple[str, str, Any]], after: Optional[int] = None,
+                       limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Find the filters having every given criteria or action term
+        
+        Each term is looked up in the filterterm index, which holds a row per
+        criteria or action value, instead of loading and scanning the JSON of
+        every filter. Values match exactly, ignoring case; a term matches a
+        list value if any of its items matches.
+        
+        Args:
+            terms: (kind, key, value) with kind FilterTerm.CRITERIA or
+                FilterTerm.ACTION, e.g. ("action", "addLabels", "TRASH")
+            after: Only return filters with a higher ID (keyset cursor)
+            limit: Most filters returned
+            
+        Returns:
+            list: Filter rows (id, forwarding_id, criteria, action, created_at), ordered by ID
+        """
+        if len(terms) > 1:
+            terms = sorted(terms, key=lambda term: self._term_queryset(*term)[:self.TERM_SAMPLE_SIZE].count())
+        return [self._filter_row(row) for row in self._search_filter_rows(terms, after)[:limit]]
+    
+    def _term_queryset(self, kind: str, key: str, value: Any):
+        """Select the index entries of one term"""
+        return FilterTerm.objects.using(versioned_read_database()).filter(kind=kind, key=key, value=normalize_term_value(value))
+    
+    def _search_filter_rows(self, terms: List[Tuple[str, str, Any]], after: Optional[int]):
+        """
+        Select the filters matching every term, ordered by ID
+        
+        The query starts from the first term's index entries, which are
+        already in filter ID order, so pages need no sort; every other term
+        is an EXISTS probing the same index for one filter ID. (As joins,
+        SQLite would carry the cursor's range over to the other terms and
+        scan them instead.) Callers put the rarest term first.
+        """
+        first, *others = terms
+        queryset = self._term_queryset(*first)
+        for kind, key, value in others:
+            queryset = queryset.filter(Exists(FilterTerm.objects.filter(
+                kind=kind, key=key, value=normalize_term_value(value), filter_id=OuterRef('filter_id'))))
+        if after is not None:
+            queryset = queryset.filter(filter_id__gt=after)
+        return queryset.order_by('filter_id').values(
+            'filter_id',
+            forwarding_id=F('filter__forwarding_id'),
+            criteria=F('filter__criteria'),
+            action=F('filter__action'),
+            created_at=F('filter__created_at'),
+        )
+    
+    @staticmethod
+    def _filter_row(row: Dict[str, Any]) -> Dict[str, Any]:
+        """Shape a term search row like the ForwardingFilter schema"""
+        row["id"] = row.pop("filter_id")
+        return row
+    
+    # Async variants
+    
+    async def aget_filters_for_rule(self, rule_id: int) -> List[ForwardingFilter]:
+        """Get all filters for a forwarding rule without blocking the event loop"""
+        return [filter_obj async for filter_obj in ForwardingFilter.objects.filter(forwarding_id=rule_id)]
+    
+    async def adelete_filters_for_rule(self, rule_id: int) -> bool:
+        """Delete all filters for a forwarding rule in one transaction, run in a worker thread"""
+        return await sync_to_async(self.delete_filters_for_rule)(rule_id)
+    
+    async def asearch_filters(self, terms: List[Tuple[str, str, Any]], after: Optional[int] = None,
+                              limit: int = 100) -> List[Dict[str, Any]]:
+        """Find the filters having every given term without blocking the event loop"""
+        if len(terms) > 1:
+            counts = [await self._term_queryset(*term)[:self.TERM_SAMPLE_SIZE].acount() for term in terms]
+            terms = [term for _, term in sorted(zip(counts, terms), key=lambda item: item[0])]
+        return [self._filter_row(row) async for row in self._search_filter_rows(terms, after)[:limit]]
+
+
+def get_joined_filter(rule: AutoForwarding) -> Optional[ForwardingFilter]:
+    """
+    Return the filter joined onto a rule, or None if the rule has no filter
+    
+    Raises:
+        ValueError: If the rule was loaded without its filter, since reading
+            it would issue one query per rule
+    """
+    if not AutoForwarding.filter.is_cached(rule):
+        raise ValueError(f"Filter for rule {rule.id} was not loaded with the rule")
+    try:
+        return rule.filter
+    except ForwardingFilter.DoesNotExist:
+        return None
 
 
 # Factory function to create repositories
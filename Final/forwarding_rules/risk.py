@@ -0,0 +1,80 @@
+from typing import Any, Dict, Iterable, Optional
+
+from .destinations import action_forward_targets
+from .domains import address_domain, is_internal_domain
+from .models import AutoForwarding
+
+
+# Points added by each risk signal; a rule's score is their sum, at most 100
+EXTERNAL_DESTINATION_POINTS = 40
+SENSITIVE_CRITERIA_POINTS = 20
+TRASH_ACTION_POINTS = 25
+ERROR_POINTS = 15
+
+# Filter criteria terms that single out financial or credential mail
+SENSITIVE_KEYWORDS = ("invoice", "payment", "wire", "bank", "remittance", "payroll", "password")
+
+# Rules read per query while refreshing scores
+REFRESH_BATCH_SIZE = 500
+
+
+def _strings(value: Any) -> Iterable[str]:
+    """Strings in a filter criteria or action value (a string or a list of strings)"""
+    values = value if isinstance(value, list) else [value]
+    return (item for item in values if isinstance(item, str))
+
+
+def risk_score(destination_domain: Optional[str], error: Optional[str],
+               criteria: Any = None, action: Any = None) -> int:
+    """
+    Score how risky a rule is, from 0 to 100
+
+    Args:
+        destination_domain: Domain of the rule's forwarding_email
+        error: The rule's error, if any
+        criteria: Criteria of the rule's filter, if it has one
+        action: Action of the rule's filter, if it has one
+
+    Returns:
+        int: Sum of the points of the signals present
+    """
+    score = 0
+    domains = [destination_domain] + [address_domain(target) for target in action_forward_targets(action)]
+    if any(domain and not is_internal_domain(domain) for domain in domains):
+        score += EXTERNAL_DESTINATION_POINTS
+    if isinstance(criteria, dict) and any(
+        keyword in text.lower()
+        for value in criteria.values() for text in _strings(value) for keyword in SENSITIVE_KEYWORDS
+    ):
+        score += SENSITIVE_CRITERIA_POINTS
+    if isinstance(action, dict) and any(label.upper() == "TRASH" for label in _strings(action.get("addLabels"))):
+        score += TRASH_ACTION_POINTS
+    if error:
+        score += ERROR_POINTS
+    return min(score, 100)
+
+
+def refresh_risk_scores(rule_ids: Iterable[int]) -> Dict[int, int]:
+    """
+    Recompute the risk scores of some rules after their filters changed
+
+    Reads the rules with their filter joined, a batch at a time, and
+    updates only the scores that changed, one UPDATE per new score value.
+
+    Returns:
+        dict: Current scores keyed by rule ID, for the rules that exist
+    """
+    rule_ids = sorted(set(rule_ids))
+    scores = {}
+    changed: Dict[int, list] = {}
+    for start in range(0, len(rule_ids), REFRESH_BATCH_SIZE):
+        rows = AutoForwarding.objects.filter(id__in=rule_ids[start:start + REFRESH_BATCH_SIZE]).values_list(
+            'id', 'destination_domain', 'error', 'filter__criteria', 'filter__action', 'risk_score')
+        for rule_id, domain, error, criteria, action, current in rows:
+            scores[rule_id] = risk_score(domain, error, criteria, action)
+            if scores[rule_id] != current:
+                changed.setdefault(scores[rule_id], []).append(rule_id)
+    for score, ids in changed.items():
+        for start in range(0, len(ids), REFRESH_BATCH_SIZE):
+            AutoForwarding.objects.filter(id__in=ids[start:start + REFRESH_BATCH_SIZE]).update(risk_score=score)
+    return scores
@@ -0,0 +1,89 @@
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+
+
+# Database alias of the read replica, configured with DATABASE_REPLICA_NAME
+REPLICA_DATABASE = "replica"
+PRIMARY_DATABASE = "default"
+
+# Until when reads in the current request or task stay on the primary
+_pinned_until = ContextVar("pinned_to_primary_until", default=0.0)
+
+
+def replica_configured() -> bool:
+    """Check whether a read replica is configured"""
+    return REPLICA_DATABASE in settings.DATABASES
+
+
+def pin_to_primary():
+    """
+    Send reads to the primary for the next REPLICA_PIN_SECONDS
+
+    Called on every write, so a request or task reads its own writes even
+    though the replica may not have caught up yet.
+    """
+    _pinned_until.set(time.monotonic() + settings.REPLICA_PIN_SECONDS)
+
+
+def reset_primary_pin():
+    """
+    Forget the writes of earlier work in this context
+
+    Called at the start of every request and task: WSGI threads and Celery
+    worker processes are reused, and a write in a previous request must
+    not pin the next one to the primary.
+    """
+    _pinned_until.set(0.0)
+
+
+def read_database() -> str:
+    """
+    Alias to use for read-only queries that may lag slightly behind writes
+
+    The replica when one is configured and nothing was written recently in
+    the current context, otherwise the primary. Results read from the
+    replica must not be cached or sent under the data version, see
+    versioned_read_database().
+    """
+    if replica_configured() and time.monotonic() >= _pinned_until.get():
+        return REPLICA_DATABASE
+    return PRIMARY_DATABASE
+
+
+def versioned_read_database() -> str:
+    """
+    Alias to use for reads whose results are sent or cached under the data version
+
+    Always the primary: the data version counts writes on the primary, so
+    rows read from a replica that has not caught up would be revalidated
+    or reused as current until the next write.
+    """
+    return PRIMARY_DATABASE
+
+
+class PrimaryReplicaRouter:
+    """
+    Database router for a primary with an optional read replica
+
+    Repository read paths choose the replica explicitly with read_database();
+    every other read, and every write, goes to the primary. Rows read from
+    the replica are saved to the primary. The replica is a copy of the
+    primary, so migrations only run on the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        return PRIMARY_DATABASE
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY_DATABASE, REPLICA_DATABASE}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY_DATABASE
@@ -1,5 +1,6 @@
+from datetime import datetime
 from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class ForwardingFilterBase(BaseModel):
@@ -45,6 +46,7 @@ class ForwardingRuleCreate(ForwardingRuleBase):
 class ForwardingRuleUpdate(BaseModel):
     """Schema for updating Auto Forwarding rules"""
     investigation_note: Optional[str] = None
+    disposition: Optional[str] = None
     
     model_config = ConfigDict(from_attributes=True)
 
@@ -52,11 +54,123 @@ class ForwardingRuleUpdate(BaseModel):
 class ForwardingRule(ForwardingRuleBase):
     """Schema for Auto Forwarding rules with ID and filter"""
     id: int
+    destination_domain: Optional[str] = None
+    risk_score: Optional[int] = None
     filter: Optional[ForwardingFilter] = None
     
     model_config = ConfigDict(from_attributes=True)
 
 
+class BulkDeleteRequest(BaseModel):
+    """Schema for deleting many rules by ID and/or search predicate"""
+    ids: Optional[List[int]] = None
+    email: Optional[str] = None
+    has_filters: Optional[bool] = None
+
+
+class BulkDeleteItem(BaseModel):
+    """Schema for the outcome of deleting one rule"""
+    id: int
+    status: str
+
+
+class BulkDeleteResult(BaseModel):
+    """Schema for bulk delete responses"""
+    deleted: int
+    results: List[BulkDeleteItem]
+
+
+class MessageHeaders(BaseModel):
+    """Schema for the headers of a message checked against the forwarding filters"""
+    sender: str = Field("", alias="from")
+    to: List[str] = []
+    subject: str = ""
+    has_attachment: bool = False
+    size: Optional[int] = None
+    
+    model_config = ConfigDict(populate_by_name=True)
+
+
+class FilterMatchItem(BaseModel):
+    """Schema for a filter that fires for a message"""
+    filter_id: int
+    rule_id: int
+    email: str
+    criteria: Dict[str, Any]
+    action: Dict[str, Any]
+    forward_targets: List[str]
+
+
+class FilterMatchResult(BaseModel):
+    """Schema for filter match responses"""
+    matched: int
+    forward_targets: List[str]
+    matches: List[FilterMatchItem]
+
+
+class ForwardingChain(BaseModel):
+    """Schema for a chain of forwards through several mailboxes"""
+    addresses: List[str]
+    hops: int
+    external: bool
+
+
+class ForwardingLoop(BaseModel):
+    """Schema for a group of mailboxes that forward to each other"""
+    addresses: List[str]
+    size: int
+
+
+class ExternalReach(BaseModel):
+    """Schema for an internal mailbox whose mail reaches external addresses"""
+    mailbox: str
+    hops: int
+    external_domains: List[str]
+    external_destinations: List[str]
+
+
+class InboundForwards(BaseModel):
+    """Schema for an address and the number of mailboxes forwarding to it"""
+    address: str
+    inbound: int
+    internal: bool
+
+
+class DestinationDomainCount(BaseModel):
+    """Schema for the number of rules forwarding to one domain"""
+    domain: str
+    rules: int
+    internal: bool
+
+
+class DestinationMatch(BaseModel):
+    """Schema for a rule forwarding to a looked-up address or domain"""
+    id: int
+    rule_id: int
+    email: str
+    address: str
+    source: str
+
+
+class InvestigationEvent(BaseModel):
+    """Schema for one recorded change to a rule's investigation note or disposition"""
+    id: int
+    rule_id: int
+    email: str
+    field: str
+    old_value: Optional[str] = None
+    new_value: Optional[str] = None
+    created_at: datetime
+
+
+class DestinationStatistics(BaseModel):
+    """Schema for rule counts by destination: internal, external and per domain"""
+    internal: int
+    external: int
+    no_forwarding: int
+    domains: List[DestinationDomainCount]
+
+
 class Error(BaseModel):
     """Schema for error responses"""
     detail: str
@@ -0,0 +1,50 @@
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+
+# SQLite FTS5 table indexing AutoForwarding.email by trigrams, created and
+# kept in sync with the autoforwarding table by triggers (migration 0003)
+EMAIL_SEARCH_TABLE = "autoforwarding_email_fts"
+
+# The trigram tokenizer cannot match phrases shorter than one trigram
+MIN_INDEXED_QUERY_LENGTH = 3
+
+# Whether the index exists, per database alias and database name
+_index_available = {}
+
+
+def email_search_available(using: str = "default") -> bool:
+    """Check whether the email search index exists in the given database"""
+    connection = connections[using]
+    key = (using, str(connection.settings_dict["NAME"]))
+    if key not in _index_available:
+        _index_available[key] = (
+            connection.vendor == "sqlite"
+            and EMAIL_SEARCH_TABLE in connection.introspection.table_names()
+        )
+    return _index_available[key]
+
+
+def filter_email_contains(queryset, email: str):
+    """
+    Filter rules whose email contains `email`, ignoring case
+
+    When the trigram index is available it narrows the candidates first, so
+    the search no longer scans the whole table. The icontains filter is
+    always applied as well, which keeps the results identical to a plain
+    icontains search.
+
+    Args:
+        queryset: AutoForwarding queryset to filter
+        email: Substring to search for
+
+    Returns:
+        QuerySet: The filtered queryset
+    """
+    if len(email) >= MIN_INDEXED_QUERY_LENGTH and email_search_available(queryset.db):
+        phrase = '"' + email.replace('"', '""') + '"'
+        queryset = queryset.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {EMAIL_SEARCH_TABLE} WHERE {EMAIL_SEARCH_TABLE} MATCH %s",
+            (phrase,)
+        ))
+    return queryset.filter(email__icontains=email)
@@ -0,0 +1,78 @@
+from typing import Any, Dict, Iterable, List
+
+from django.http import HttpRequest
+from ninja.renderers import JSONRenderer
+from ninja.responses import NinjaJSONEncoder
+from pydantic_core import to_json
+
+
+# Columns selected with .values() for rule list responses, filter fields joined in
+RULE_ROW_FIELDS = (
+    "id",
+    "email",
+    "name",
+    "forwarding_email",
+    "disposition",
+    "has_forwarding_filters",
+    "error",
+    "investigation_note",
+    "destination_domain",
+    "risk_score",
+    "filter__id",
+    "filter__criteria",
+    "filter__action",
+    "filter__created_at",
+)
+
+
+def rule_row_to_dict(row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Shape a rule row from .values(RULE_ROW_FIELDS) like the ForwardingRule schema
+
+    Rows come straight from the database, so they are trusted and not
+    validated again.
+
+    Args:
+        row: Dictionary with the RULE_ROW_FIELDS keys
+
+    Returns:
+        dict: Rule fields plus a nested "filter" dictionary (or None)
+    """
+    filter_id = row["filter__id"]
+    return {
+        "email": row["email"],
+        "name": row["name"],
+        "forwarding_email": row["forwarding_email"],
+        "disposition": row["disposition"],
+        "has_forwarding_filters": row["has_forwarding_filters"],
+        "error": row["error"],
+        "investigation_note": row["investigation_note"],
+        "id": row["id"],
+        "destination_domain": row["destination_domain"],
+        "risk_score": row["risk_score"],
+        "filter": {
+            "criteria": row["filter__criteria"],
+            "action": row["filter__action"],
+            "created_at": row["filter__created_at"],
+            "id": filter_id,
+            "forwarding_id": row["id"],
+        } if filter_id is not None else None,
+    }
+
+
+def rule_rows_to_dicts(rows: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Shape many rule rows like the ForwardingRule schema"""
+    return [rule_row_to_dict(row) for row in rows]
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON renderer that encodes responses with pydantic-core
+
+    pydantic-core encodes dicts and lists in Rust, which is several times
+    faster than json.dumps on large pages. Values it does not know are
+    converted by the default Ninja encoder.
+    """
+
+    def render(self, request: HttpRequest, data: Any, *, response_status: int) -> Any:
+        return to_json(data, fallback=NinjaJSONEncoder().default)
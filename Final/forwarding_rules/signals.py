@@ -0,0 +1,108 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .cache import bump_data_version, in_bulk_invalidation
+from .destinations import action_forward_targets, replace_destinations
+from .domains import address_domain
+from .instrumentation import install_query_recorder
+from .risk import refresh_risk_scores, risk_score
+from .terms import create_filter_terms, replace_filter_terms
+from .sqlite import configure_sqlite_connection
+from .models import AutoForwarding, ForwardingFilter, ForwardingDestination
+
+
+@receiver(pre_save, sender=AutoForwarding)
+def set_destination_domain(sender, instance, **kwargs):
+    """Keep the indexed destination domain in step with forwarding_email"""
+    instance.destination_domain = address_domain(instance.forwarding_email)
+
+
+@receiver(pre_save, sender=AutoForwarding)
+def set_risk_score(sender, instance, **kwargs):
+    """
+    Recompute the risk score of a new rule, or of a rule whose destination or error changed
+    
+    A filter joined with select_related is scored for free, so the score is
+    then always recomputed. Filter writes refresh the score themselves.
+    """
+    filter_joined = AutoForwarding.filter.is_cached(instance)
+    if not (instance._state.adding or filter_joined or instance.risk_score is None
+            or instance.field_changed('forwarding_email') or instance.field_changed('error')):
+        return
+    if instance._state.adding:
+        criteria = action = None
+    elif filter_joined:
+        rule_filter = getattr(instance, 'filter', None)
+        criteria, action = (rule_filter.criteria, rule_filter.action) if rule_filter else (None, None)
+    else:
+        criteria, action = ForwardingFilter.objects.filter(forwarding_id=instance.id).values_list(
+            'criteria', 'action').first() or (None, None)
+    instance.risk_score = risk_score(instance.destination_domain, instance.error, criteria, action)
+
+
+@receiver(post_save, sender=AutoForwarding)
+def sync_rule_destination(sender, instance, created, **kwargs):
+    """Keep the rule's destination row in step with forwarding_email, when it changed"""
+    if in_bulk_invalidation():
+        return
+    if created and not instance.forwarding_email:
+        return
+    if not created and not instance.field_changed('forwarding_email'):
+        return
+    replace_destinations({instance.id: [instance.forwarding_email]}, ForwardingDestination.RULE)
+
+
+@receiver(post_save, sender=ForwardingFilter)
+@receiver(post_delete, sender=ForwardingFilter)
+def sync_filter_destinations(sender, instance, **kwargs):
+    """Keep the destination rows of a filter's forward action in step with the filter"""
+    if in_bulk_invalidation():
+        return
+    targets = action_forward_targets(instance.action) if kwargs['signal'] is post_save else []
+    replace_destinations({instance.forwarding_id: targets}, ForwardingDestination.FILTER)
+
+
+@receiver(post_save, sender=ForwardingFilter)
+def sync_filter_terms(sender, instance, created, **kwargs):
+    """Keep the searchable terms of a filter in step with its criteria and action"""
+    if in_bulk_invalidation():
+        return
+    if created:
+        create_filter_terms([(instance.id, instance.criteria, instance.action)])
+    else:
+        replace_filter_terms(instance.id, instance.criteria, instance.action)
+
+
+@receiver(post_save, sender=ForwardingFilter)
+@receiver(post_delete, sender=ForwardingFilter)
+def refresh_rule_risk_score(sender, instance, **kwargs):
+    """Recompute the risk score of a filter's rule, also on a rule instance the filter holds"""
+    if in_bulk_invalidation():
+        return
+    scores = refresh_risk_scores([instance.forwarding_id])
+    if instance.forwarding_id in scores and ForwardingFilter.forwarding.is_cached(instance):
+        # Keep a later save of that instance from writing back the old score
+        instance.forwarding.risk_score = scores[instance.forwarding_id]
+
+
+@receiver(post_save, sender=AutoForwarding)
+@receiver(post_delete, sender=AutoForwarding)
+@receiver(post_save, sender=ForwardingFilter)
+@receiver(post_delete, sender=ForwardingFilter)
+def invalidate_cached_data(sender, instance, **kwargs):
+    """Invalidate cached results whenever a rule or filter changes"""
+    rule_id = instance.id if sender is AutoForwarding else instance.forwarding_id
+    bump_data_version([rule_id])
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    """Apply the SQLite concurrency pragmas to every new database connection"""
+    configure_sqlite_connection(connection)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    """Count the queries of every new database connection towards the current request"""
+    install_query_recorder(connection)
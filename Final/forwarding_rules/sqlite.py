@@ -0,0 +1,84 @@
+import functools
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection as default_connection, transaction
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before the first retry of a write that hit a lock; doubled on every retry
+LOCK_RETRY_DELAY = 0.05
+
+
+def sqlite_pragmas() -> list:
+    """
+    PRAGMA statements run on every new SQLite connection in concurrent mode
+
+    WAL journaling lets readers (report tasks) and a writer (analysts) work
+    at the same time; synchronous=NORMAL is safe with WAL and avoids an
+    fsync per commit. The busy timeout makes a connection wait for a lock
+    instead of failing at once.
+    """
+    return [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT * 1000)}",
+        f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}",
+        f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KB}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+
+
+def configure_sqlite_connection(connection):
+    """Apply the concurrency pragmas to a new SQLite connection, if concurrent mode is on"""
+    if connection.vendor != "sqlite" or not settings.SQLITE_CONCURRENT_MODE:
+        return
+    # Run on the raw connection so the pragmas are not counted as request queries
+    for pragma in sqlite_pragmas():
+        connection.connection.execute(pragma)
+
+
+def is_lock_error(error: Exception) -> bool:
+    """Check whether a database error was caused by SQLite lock contention"""
+    return isinstance(error, OperationalError) and "locked" in str(error)
+
+
+def retry_on_lock(func):
+    """
+    Retry a database write that failed because SQLite was locked
+
+    The busy timeout already makes most writes wait for the lock, but SQLite
+    fails at once when a read transaction cannot be upgraded to a write, so
+    the whole write is run again after a short, growing delay, up to
+    SQLITE_LOCK_RETRIES times. Each attempt runs in its own transaction, so
+    the statements of a failed attempt (including those of signal handlers)
+    are rolled back before they are run again. Calls made inside a
+    surrounding transaction are not retried: only the outermost transaction
+    can be re-run. Async code calls the decorated sync function through
+    sync_to_async, as an async body's queries cannot share a transaction.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if default_connection.in_atomic_block:
+            return func(*args, **kwargs)
+        for attempt in range(settings.SQLITE_LOCK_RETRIES + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_lock_error(e) or attempt == settings.SQLITE_LOCK_RETRIES:
+                    raise
+                delay = _retry_delay(func, attempt)
+            time.sleep(delay)
+    return wrapper
+
+
+def _retry_delay(func, attempt: int) -> float:
+    """Log a lock retry and return how long to wait before it"""
+    delay = LOCK_RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+    logger.info("Database locked in %s, retrying in %.2fs (attempt %d of %d)",
+                func.__qualname__, delay, attempt + 1, settings.SQLITE_LOCK_RETRIES)
+    return delay
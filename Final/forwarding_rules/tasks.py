@@ -1,13 +1,84 @@
 import os
 import json
+import itertools
 from datetime import datetime
-from celery import shared_task
+from celery import shared_task, chord
+from celery.signals import task_prerun
 from django.conf import settings
+from django.core.cache import cache
+from pypdf import PdfWriter
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from .repository import create_repositories
+from .cache import shared_cache
+from .repository import create_repositories, get_joined_filter
+from .replay import replay_mailbox
+from .routers import PRIMARY_DATABASE, read_database, reset_primary_pin
+
+
+# Number of rules read from the database at a time while building a report
+REPORT_CHUNK_SIZE = 500
+
+# Title of the complete report
+FULL_REPORT_TITLE = "Email Forwarding Rules Audit Report"
+
+
+def _default_report_name(title_text):
+    """Build a timestamped report file name from the report title"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{title_text.lower().replace(' ', '_')}_{timestamp}.pdf"
+
+
+def find_cached_report(report_type, report_name, fingerprint):
+    """
+    Find a report rendered earlier from the same data
+    
+    Args:
+        report_type: "full", "stats" or "rules_only"
+        report_name: Report name as requested (None for the default name)
+        fingerprint: Data fingerprint from the rule repository
+        
+    Returns:
+        str: Path to the existing report, or None if it must be rendered
+    """
+    if not shared_cache():
+        return None
+    report_path = cache.get(_report_cache_key(report_type, report_name, fingerprint))
+    if not report_path or not os.path.exists(report_path):
+        return None
+    # The file may since have been overwritten by another report type or a newer render
+    if cache.get(_report_file_key(report_path)) != (report_type, fingerprint):
+        return None
+    return report_path
+
+
+def _cache_report(report_type, report_name, fingerprint, report_path):
+    """
+    Remember the report rendered for a report type, name and data fingerprint
+    
+    Reports are only remembered with a shared cache, whose data version
+    sees the writes of every process, and not when rendered from the read
+    replica: the fingerprint carries the primary's data version, and a
+    replica that has not caught up with an update would have its report
+    reused as current until the next write.
+    """
+    if not shared_cache() or read_database() != PRIMARY_DATABASE:
+        return
+    cache.set_many({
+        _report_cache_key(report_type, report_name, fingerprint): report_path,
+        _report_file_key(report_path): (report_type, fingerprint),
+    }, settings.REPORT_CACHE_TIMEOUT)
+
+
+def _report_cache_key(report_type, report_name, fingerprint):
+    """Build the cache key of a rendered report"""
+    return f"forwarding_rules:report:{report_type}:{report_name or ''}:{fingerprint}"
+
+
+def _report_file_key(report_path):
+    """Build the cache key recording the report type and fingerprint a file was rendered from"""
+    return f"forwarding_rules:report_file:{report_path}"
 
 
 def _create_report_base(report_name, title_text):
@@ -23,12 +94,14 @@ def _create_report_base(report_name, title_text):
     """
     # Generate filename based on timestamp if not provided
     if not report_name:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        report_name = report_name or f"{title_text.lower().replace(' ', '_')}_{timestamp}.pdf"
+        report_name = _default_report_name(title_text)
     
     # Full path to the report file
     report_path = os.path.join(settings.REPORTS_DIR, report_name)
     
+    # The file is about to be overwritten, so no cached report may point to it until it is rendered
+    cache.delete(_report_file_key(report_path))
+    
     # Create the PDF document
     doc = SimpleDocTemplate(
         report_path,
@@ -99,16 +172,18 @@ def _add_statistics_section(elements, rule_repo, styles):
     elements.append(Spacer(1, 24))
 
 
-def _add_rules_section(elements, rules, filter_repo, styles, include_filters=True):
+def _rules_section_flowables(rules, styles, include_filters=True, include_heading=True):
     """
-    Add rules section to the report
+    Yield the flowables of the rules section one rule at a time
     
     Args:
-        elements: List of report elements
-        rules: List of rules
-        filter_repo: Repository for filters
+        rules: Iterable of rules loaded with their filters
         styles: Report styles
         include_filters: Whether to include filter information
+        include_heading: Whether to start with the section heading
+        
+    Yields:
+        Flowable: Report elements for the rules section
     """
     heading_style = styles['Heading2']
     
@@ -120,14 +195,15 @@ def _add_rules_section(elements, rules, filter_repo, styles, include_filters=Tru
     )
     
     # Add rules details
-    elements.append(Paragraph("Forwarding Rules", heading_style))
-    elements.append(Spacer(1, 12))
+    if include_heading:
+        yield Paragraph("Forwarding Rules", heading_style)
+        yield Spacer(1, 12)
     
     # Process each rule
     for rule in rules:
         # Rule header
         rule_title = f"Rule #{rule.id}: {rule.email}"
-        elements.append(Paragraph(rule_title, section_style))
+        yield Paragraph(rule_title, section_style)
         
         # Rule details table
         rule_data = [
@@ -152,47 +228,72 @@ def _add_rules_section(elements, rules, filter_repo, styles, include_filters=Tru
             ('GRID', (0, 0), (-1, -1), 1, colors.black),
         ]))
         
-        elements.append(rule_table)
-        elements.append(Spacer(1, 12))
+        yield rule_table
+        yield Spacer(1, 12)
         
-        # Add filter information if requested
-        if include_filters and rule.has_forwarding_filters:
-            # Get filters for this rule
-            filters = filter_repo.get_filters_for_rule(rule.id)
+        # Add filter information if requested (the filter is joined with the rule)
+        filter_obj = get_joined_filter(rule) if include_filters and rule.has_forwarding_filters else None
+        if filter_obj:
+            yield Paragraph("Filter Configuration:", styles['Heading3'])
             
-            if filters:
-                elements.append(Paragraph("Filter Configuration:", styles['Heading3']))
-                
-                for filter_obj in filters:
-                    # Format JSON for better presentation
-                    criteria_str = json.dumps(filter_obj.criteria, indent=2)
-                    action_str = json.dumps(filter_obj.action, indent=2)
-                    
-                    filter_data = [
-                        ["Attribute", "Value"],
-                        ["Filter ID", str(filter_obj.id)],
-                        ["Created At", filter_obj.created_at or "Unknown"],
-                        ["Criteria", criteria_str],
-                        ["Action", action_str]
-                    ]
-                    
-                    filter_table = Table(filter_data, colWidths=[150, 250])
-                    filter_table.setStyle(TableStyle([
-                        ('BACKGROUND', (0, 0), (1, 0), colors.lightblue),
-                        ('TEXTCOLOR', (0, 0), (1, 0), colors.black),
-                        ('ALIGN', (0, 0), (1, 0), 'CENTER'),
-                        ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
-                        ('FONTSIZE', (0, 0), (1, 0), 12),
-                        ('BOTTOMPADDING', (0, 0), (1, 0), 12),
-                        ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                    ]))
-                    
-                    elements.append(filter_table)
-                    elements.append(Spacer(1, 12))
+            # Format JSON for better presentation
+            criteria_str = json.dumps(filter_obj.criteria, indent=2)
+            action_str = json.dumps(filter_obj.action, indent=2)
+            
+            filter_data = [
+                ["Attribute", "Value"],
+                ["Filter ID", str(filter_obj.id)],
+                ["Created At", filter_obj.created_at or "Unknown"],
+                ["Criteria", criteria_str],
+                ["Action", action_str]
+            ]
+            
+            filter_table = Table(filter_data, colWidths=[150, 250])
+            filter_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (1, 0), colors.lightblue),
+                ('TEXTCOLOR', (0, 0), (1, 0), colors.black),
+                ('ALIGN', (0, 0), (1, 0), 'CENTER'),
+                ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (1, 0), 12),
+                ('BOTTOMPADDING', (0, 0), (1, 0), 12),
+                ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ]))
+            
+            yield filter_table
+            yield Spacer(1, 12)
         
         # Add separator between rules
-        elements.append(Spacer(1, 24))
+        yield Spacer(1, 24)
+
+
+class _StreamingStory(list):
+    """
+    Flowable list for doc.build that is refilled from an iterator as it is consumed
+    
+    ReportLab takes flowables off the front of the story list while laying out
+    pages and checks len() before each one. Topping the list up at that point
+    keeps only a small window of flowables in memory instead of the whole report.
+    """
+    
+    def __init__(self, elements, more_elements, buffer_size=200):
+        super().__init__(elements)
+        self._more = iter(more_elements)
+        self._buffer_size = buffer_size
+    
+    def __len__(self):
+        while self._more is not None and super().__len__() < self._buffer_size:
+            try:
+                self.append(next(self._more))
+            except StopIteration:
+                self._more = None
+        return super().__len__()
+
+
+@task_prerun.connect
+def reset_task_primary_pin(**kwargs):
+    """Start every task without a pin to the primary left by an earlier task in this worker"""
+    reset_primary_pin()
 
 
 @shared_task
@@ -209,28 +310,156 @@ def generate_rules_report(report_name=None):
     # Create repositories to access data
     rule_repo, filter_repo = create_repositories()
     
-    # Get all rules
-    rules = rule_repo.get_all_rules()
+    # Reuse the last report if nothing changed since it was rendered
+    fingerprint = rule_repo.get_data_fingerprint()
+    cached_path = find_cached_report("full", report_name, fingerprint)
+    if cached_path:
+        return cached_path
+    
+    # Iterate over all rules in chunks, with filters joined
+    rules = rule_repo.iter_rules_with_filters(chunk_size=REPORT_CHUNK_SIZE)
     
     # Create report base
     doc, elements, styles, report_path = _create_report_base(
         report_name, 
-        "Email Forwarding Rules Audit Report"
+        FULL_REPORT_TITLE
     )
     
     # Add statistics section
     _add_statistics_section(elements, rule_repo, styles)
     
-    # Add rules section with filters
-    _add_rules_section(elements, rules, filter_repo, styles, include_filters=True)
+    # Add rules section with filters, generated while the PDF is built
+    rules_section = _rules_section_flowables(rules, styles, include_filters=True)
     
     # Build the PDF
-    doc.build(elements)
+    doc.build(_StreamingStory(elements, rules_section))
+    _cache_report("full", report_name, fingerprint, report_path)
     
     # Return the path to the generated report
     return report_path
 
 
+@shared_task
+def generate_rules_report_sharded(report_name=None, shard_count=8):
+    """
+    Generate the complete report by rendering ID-range shards in parallel
+    
+    Each shard is rendered by its own render_rules_shard task, and a chord
+    runs merge_rules_report once all of them have finished to add the cover
+    and statistics and combine the parts into one PDF.
+    
+    Args:
+        report_name: Optional name for the report file
+        shard_count: Number of shards (and parallel tasks) to split the rules into
+        
+    Returns:
+        str: ID of the chord result that will hold the path to the report, or
+            the path of an existing report rendered from the same data
+    """
+    rule_repo, filter_repo = create_repositories()
+    
+    # Reuse the last report if nothing changed since it was rendered
+    fingerprint = rule_repo.get_data_fingerprint()
+    cached_path = find_cached_report("full", report_name, fingerprint)
+    if cached_path:
+        return cached_path
+    requested_name = report_name
+    report_name = report_name or _default_report_name(FULL_REPORT_TITLE)
+    
+    # Parts are written next to the final report, so all workers must share REPORTS_DIR
+    parts_dir = os.path.join(settings.REPORTS_DIR, "parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    
+    # Without rules a single unbounded shard renders the empty rules section,
+    # so the result is a chord result and the report is cached under the requested name either way
+    id_ranges = rule_repo.get_id_ranges(shard_count) or [(None, None)]
+    shards = [
+        render_rules_shard.s(
+            os.path.join(parts_dir, f"{report_name}.part{index:04d}"),
+            start_id,
+            end_id,
+            index == 0
+        )
+        for index, (start_id, end_id) in enumerate(id_ranges)
+    ]
+    
+    result = chord(shards)(merge_rules_report.s(report_name, requested_name, fingerprint))
+    return result.id
+
+
+@shared_task
+def render_rules_shard(part_path, start_id, end_id, include_heading=False):
+    """
+    Render the rules with IDs in [start_id, end_id) into a partial PDF
+    
+    Args:
+        part_path: Path of the partial PDF to write
+        start_id: First rule ID of the shard
+        end_id: ID after the last rule of the shard, or None for the last shard
+        include_heading: Whether this shard starts the rules section
+        
+    Returns:
+        str: Path to the partial PDF
+    """
+    rule_repo, filter_repo = create_repositories()
+    rules = rule_repo.iter_rules_with_filters(
+        chunk_size=REPORT_CHUNK_SIZE, start_id=start_id, end_id=end_id
+    )
+    
+    doc = SimpleDocTemplate(
+        part_path,
+        pagesize=letter,
+        rightMargin=72,
+        leftMargin=72,
+        topMargin=72,
+        bottomMargin=72
+    )
+    styles = getSampleStyleSheet()
+    rules_section = _rules_section_flowables(
+        rules, styles, include_filters=True, include_heading=include_heading
+    )
+    doc.build(_StreamingStory([], rules_section))
+    return part_path
+
+
+@shared_task
+def merge_rules_report(part_paths, report_name, requested_name=None, fingerprint=None):
+    """
+    Render the cover and statistics and merge them with the rendered shards
+    
+    Args:
+        part_paths: Paths of the partial PDFs, in shard order (chord results)
+        report_name: Name of the final report file
+        requested_name: Report name as originally requested, for the report cache
+        fingerprint: Data fingerprint taken before the shards were rendered
+        
+    Returns:
+        str: Path to the generated PDF report
+    """
+    rule_repo, filter_repo = create_repositories()
+    
+    # Cover page with title, timestamp and statistics
+    doc, elements, styles, report_path = _create_report_base(report_name, FULL_REPORT_TITLE)
+    _add_statistics_section(elements, rule_repo, styles)
+    cover_path = f"{report_path}.cover"
+    doc.filename = cover_path
+    doc.build(elements)
+    
+    writer = PdfWriter()
+    for path in [cover_path, *part_paths]:
+        writer.append(path)
+    with open(report_path, "wb") as report_file:
+        writer.write(report_file)
+    
+    for path in [cover_path, *part_paths]:
+        os.remove(path)
+    
+    if fingerprint:
+        _cache_report("full", requested_name, fingerprint, report_path)
+    
+    return report_path
+
+
 @shared_task
 def generate_stats_report(report_name=None):
     """
@@ -245,6 +474,13 @@ def generate_stats_report(report_name=None):
     # Create repositories to access data
     rule_repo, filter_repo = create_repositories()
     
+    # Reuse the last report if nothing changed since it was rendered
+    fingerprint = rule_repo.get_data_fingerprint()
+    cached_path = find_cached_report("stats", report_name, fingerprint)
+    if cached_path:
+        return cached_path
+    requested_name = report_name
+    
     # Create report base with appropriate name
     if not report_name:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -269,6 +505,7 @@ def generate_stats_report(report_name=None):
     
     # Build the PDF
     doc.build(elements)
+    _cache_report("stats", requested_name, fingerprint, report_path)
     
     # Return the path to the generated report
     return report_path
@@ -288,8 +525,15 @@ def generate_rules_only_report(report_name=None):
     # Create repositories to access data
     rule_repo, filter_repo = create_repositories()
     
-    # Get all rules
-    rules = rule_repo.get_all_rules()
+    # Reuse the last report if nothing changed since it was rendered
+    fingerprint = rule_repo.get_data_fingerprint()
+    cached_path = find_cached_report("rules_only", report_name, fingerprint)
+    if cached_path:
+        return cached_path
+    requested_name = report_name
+    
+    # Iterate over all rules in chunks
+    rules = rule_repo.iter_rules_with_filters(chunk_size=REPORT_CHUNK_SIZE)
     
     # Create report base with appropriate name
     if not report_name:
@@ -301,8 +545,8 @@ def generate_rules_only_report(report_name=None):
         "Email Forwarding Rules Only Report"
     )
     
-    # Add rules section without filters
-    _add_rules_section(elements, rules, filter_repo, styles, include_filters=False)
+    # Add rules section without filters, generated while the PDF is built
+    rules_section = _rules_section_flowables(rules, styles, include_filters=False)
     
     # Add note about filters being excluded
     normal_style = styles['Normal']
@@ -312,10 +556,42 @@ def generate_rules_only_report(report_name=None):
         "please generate a full report.",
         normal_style
     )
-    elements.append(note)
     
     # Build the PDF
-    doc.build(elements)
+    doc.build(_StreamingStory(elements, itertools.chain(rules_section, [note])))
+    _cache_report("rules_only", requested_name, fingerprint, report_path)
     
     # Return the path to the generated report
-    return report_path 
\ No newline at end of file
+    return report_path 
+
+
+@shared_task
+def simulate_mailbox_replay(mailbox_path, processes=None, result_name=None):
+    """
+    Replay a mailbox against every forwarding filter
+    
+    Counts the messages of an mbox file or .eml directory that the filters
+    would have forwarded, by rule and by destination, to estimate data
+    exposure. The counts are written as JSON to the reports directory.
+    
+    Args:
+        mailbox_path: mbox file or directory of .eml files
+        processes: Number of worker processes, cut down to one per CPU of the
+            worker (default: one per CPU)
+        result_name: Optional name for the result file
+        
+    Returns:
+        str: Path to the JSON result
+    """
+    _, filter_repo = create_repositories()
+    result = replay_mailbox(mailbox_path, list(filter_repo.iter_filter_rows()), processes)
+    result["mailbox"] = mailbox_path
+    
+    if not result_name:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        result_name = f"mailbox_replay_{timestamp}.json"
+    result_path = os.path.join(settings.REPORTS_DIR, result_name)
+    with open(result_path, "w") as f:
+        json.dump(result, f, indent=2)
+    
+    return result_path
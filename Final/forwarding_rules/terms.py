@@ -0,0 +1,57 @@
+import json
+from typing import Any, Iterable, List, Optional, Tuple
+
+from .models import FilterTerm
+
+
+def normalize_term_value(value: Any) -> Optional[str]:
+    """
+    Normalize a criteria or action value for storing and looking it up
+
+    Strings are trimmed and lower-cased, booleans become "true"/"false"
+    and numbers their JSON form. Returns None for empty strings and for
+    values that cannot be searched (null, objects).
+    """
+    if isinstance(value, str):
+        return value.strip().lower() or None
+    if isinstance(value, (bool, int, float)):
+        return json.dumps(value)
+    return None
+
+
+def filter_terms(criteria: Any, action: Any) -> List[Tuple[str, str, str]]:
+    """
+    Explode a filter's criteria and action into (kind, key, value) terms
+
+    A list value gives a term per item. Each term is listed once.
+    """
+    terms = []
+    for kind, data in ((FilterTerm.CRITERIA, criteria), (FilterTerm.ACTION, action)):
+        if not isinstance(data, dict):
+            continue
+        for key, value in data.items():
+            for item in value if isinstance(value, list) else [value]:
+                normalized = normalize_term_value(item)
+                if normalized is not None and len(key) <= 64:
+                    terms.append((kind, key, normalized))
+    return list(dict.fromkeys(terms))
+
+
+def create_filter_terms(filters: Iterable[Tuple[int, Any, Any]]):
+    """
+    Insert the terms of new filters
+
+    Args:
+        filters: (filter ID, criteria, action) of filters that have no terms yet
+    """
+    FilterTerm.objects.bulk_create([
+        FilterTerm(filter_id=filter_id, kind=kind, key=key, value=value)
+        for filter_id, criteria, action in filters
+        for kind, key, value in filter_terms(criteria, action)
+    ], batch_size=2000)
+
+
+def replace_filter_terms(filter_id: int, criteria: Any, action: Any):
+    """Replace the terms of an existing filter after its criteria or action changed"""
+    FilterTerm.objects.filter(filter_id=filter_id).delete()
+    create_filter_terms([(filter_id, criteria, action)])
@@ -1,17 +1,85 @@
-from django.test import TestCase
+from django.conf import settings
+from django.apps import apps
+from django.db import connection, OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
+from django.core.cache import cache
 from unittest.mock import patch, MagicMock
+from asgiref.sync import async_to_sync
+import base64
+import importlib
+import os
+import csv
+import io
 import json
+import re
+import tempfile
+import warnings
+import zlib
 
-from .models import AutoForwarding, ForwardingFilter
-from .tasks import generate_rules_report, generate_stats_report, generate_rules_only_report
+from .models import AutoForwarding, ForwardingFilter, ForwardingDestination, FilterTerm, InvestigationEvent
+from .repository import create_repositories, get_joined_filter
+from .api import db_to_api_rule
+from .sqlite import retry_on_lock
+from .terms import create_filter_terms
+from . import routers
+from .middleware import replica_pin_middleware
+from .matching import AhoCorasick, FilterMatcher, get_filter_matcher
+from .replay import iter_mailbox, replay_mailbox
+from .graph import ForwardingGraph, get_forwarding_graph
+from .risk import risk_score
+from .cache import get_changed_rules, get_data_version, versioned_key
+from .tasks import generate_rules_report, generate_stats_report, generate_rules_only_report, _StreamingStory
+from .tasks import generate_rules_report_sharded, simulate_mailbox_replay, find_cached_report
+from forwarding_audit.celery import app as celery_app
+from celery.signals import task_prerun
+from reportlab.platypus import SimpleDocTemplate
 
 
-class ForwardingRuleAPITests(TestCase):
+def server_timing_query_count(response) -> int:
+    """Read the query count from a response's Server-Timing header"""
+    match = re.search(r'db;dur=[\d.]+;desc="(\d+) queries"', response['Server-Timing'])
+    return int(match.group(1))
+
+
+class QueryBudgetMixin:
+    """Assertions on the number of queries an endpoint runs, as measured by the timing middleware"""
+
+    def assertQueryBudget(self, budget, method, url, **kwargs):
+        """Request `url` and fail if it ran more than `budget` queries"""
+        response = getattr(self.client, method)(url, **kwargs)
+        queries = server_timing_query_count(response)
+        self.assertLessEqual(
+            queries, budget,
+            f"{method.upper()} {url} ran {queries} queries, its budget is {budget}"
+        )
+        return response
+
+    def assertStreamQueryBudget(self, budget, method, url, **kwargs):
+        """Request a streaming `url`, read its content, and fail if it ran more than `budget` queries"""
+        with patch('forwarding_rules.middleware.log_over_budget') as log_over_budget:
+            response = getattr(self.client, method)(url, **kwargs)
+            self.assertNotIn('Server-Timing', response)
+            log_over_budget.assert_not_called()
+            content = b"".join(response.streaming_content)
+        log_over_budget.assert_called_once()
+        queries = log_over_budget.call_args.args[1].query_count
+        self.assertLessEqual(
+            queries, budget,
+            f"{method.upper()} {url} ran {queries} queries, its budget is {budget}"
+        )
+        return queries, content
+
+
+# The test process is the only user of its local-memory cache, so the cache is shared
+@override_settings(CACHE_SHARED=True)
+class ForwardingRuleAPITests(QueryBudgetMixin, TestCase):
     """Tests for the Forwarding Rules API endpoints"""
 
     def setUp(self):
         """Set up test data before each test"""
+        cache.clear()
+        
         # Create test forwarding rules
         self.rule1 = AutoForwarding.objects.create(
             email="user1@example.com",
@@ -103,6 +171,52 @@ class ForwardingRuleAPITests(TestCase):
         response = self.client.delete('/api/rules/999')
         self.assertEqual(response.status_code, 404)
 
+    def test_bulk_delete_rules(self):
+        """Test deleting many rules by ID and by search predicate"""
+        extra = [
+            AutoForwarding.objects.create(email=f"cleanup{i}@example.com", name=f"Cleanup {i}")
+            for i in range(5)
+        ]
+        ForwardingFilter.objects.create(
+            forwarding_id=extra[0].id,
+            criteria={"subject": "invoice"},
+            action={"forward": "attacker@evil.example"}
+        )
+
+        # Delete by ID, reporting IDs that do not exist
+        response = self.client.post(
+            '/api/rules/bulk-delete',
+            data=json.dumps({"ids": [self.rule1.id, extra[0].id, 999]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual(data['results'], [
+            {"id": self.rule1.id, "status": "deleted"},
+            {"id": extra[0].id, "status": "deleted"},
+            {"id": 999, "status": "not_found"},
+        ])
+        self.assertEqual(ForwardingFilter.objects.count(), 0)
+
+        # Delete by search predicate
+        response = self.client.post(
+            '/api/rules/bulk-delete',
+            data=json.dumps({"email": "cleanup"}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json()['deleted'], 4)
+        self.assertEqual(list(AutoForwarding.objects.values_list('id', flat=True)), [self.rule2.id])
+
+        # An empty request must not delete everything
+        response = self.client.post(
+            '/api/rules/bulk-delete',
+            data=json.dumps({}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(AutoForwarding.objects.count(), 1)
+
     def test_search_rules(self):
         """Test searching for rules with filters"""
         # Test search by email
@@ -126,6 +240,34 @@ class ForwardingRuleAPITests(TestCase):
         data = response.json()
         self.assertEqual(len(data), 0)
 
+    def test_search_rules_uses_email_index(self):
+        """Test that email search matches substrings case-insensitively through the index"""
+        AutoForwarding.objects.create(email="John.Doe@Contoso.com", name="John Doe")
+
+        # Infix, mixed-case matches
+        for query in ['doe@contoso', 'OHN.D', 'ser2@EX']:
+            response = self.client.get('/api/rules/search/', {'email': query})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()), 1, query)
+
+        # The index follows updates and deletes
+        self.rule2.email = "renamed@example.com"
+        self.rule2.save()
+        response = self.client.get('/api/rules/search/', {'email': 'ser2@'})
+        self.assertEqual(len(response.json()), 0)
+        response = self.client.get('/api/rules/search/', {'email': 'renamed'})
+        self.assertEqual(len(response.json()), 1)
+
+        self.rule2.delete()
+        response = self.client.get('/api/rules/search/', {'email': 'renamed'})
+        self.assertEqual(len(response.json()), 0)
+
+        # Queries shorter than a trigram and LIKE wildcards keep icontains semantics
+        response = self.client.get('/api/rules/search/', {'email': 'r1'})
+        self.assertEqual(len(response.json()), 1)
+        response = self.client.get('/api/rules/search/', {'email': 'user_'})
+        self.assertEqual(len(response.json()), 0)
+
     def test_get_statistics(self):
         """Test retrieving statistics about forwarding rules"""
         response = self.client.get('/api/stats/')
@@ -138,6 +280,54 @@ class ForwardingRuleAPITests(TestCase):
         self.assertEqual(data['total_rules'], 2)
         self.assertEqual(data['rules_with_filters'], 1)
 
+    def test_statistics_cached_until_data_changes(self):
+        """Test that statistics use one query and are recomputed after a write"""
+        expected = {
+            "total_rules": 2,
+            "active_forwarding": 2,
+            "rules_with_filters": 1,
+            "rules_with_errors": 0,
+            "total_filters": 1
+        }
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/stats/')
+        self.assertEqual(response.json(), expected)
+
+        # Served from the cache while nothing changes
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/stats/')
+        self.assertEqual(response.json(), expected)
+
+        # Any write to a rule invalidates the cached statistics
+        AutoForwarding.objects.create(email="user3@example.com", name="User Three", error="Permission denied")
+        response = self.client.get('/api/stats/')
+        self.assertEqual(response.json()['total_rules'], 3)
+        self.assertEqual(response.json()['rules_with_errors'], 1)
+
+        # Deleting a filter invalidates them as well
+        self.filter1.delete()
+        response = self.client.get('/api/stats/')
+        self.assertEqual(response.json()['total_filters'], 0)
+
+    @override_settings(CACHE_SHARED=False)
+    def test_per_process_cache_keeps_nothing_under_data_version(self):
+        """Test that without a shared cache no ETag is sent and statistics, matcher and graph are recomputed"""
+        for url in ('/api/rules/', '/api/stats/', f'/api/rules/{self.rule1.id}', '/api/graph/loops'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("ETag", response)
+
+        # A write by another process does not bump this process's data version (update() sends no signals)
+        AutoForwarding.objects.filter(id=self.rule2.id).update(error="Permission denied")
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/stats/')
+        self.assertEqual(response.json()["rules_with_errors"], 1)
+
+        _, filter_repo = create_repositories()
+        self.assertIsNot(get_filter_matcher(filter_repo), get_filter_matcher(filter_repo))
+        rule_repo = create_repositories()[0]
+        self.assertIsNot(get_forwarding_graph(rule_repo), get_forwarding_graph(rule_repo))
+
     def test_get_rule_filter(self):
         """Test retrieving the filter for a specific rule"""
         # Get filter for rule with filter
@@ -156,10 +346,1317 @@ class ForwardingRuleAPITests(TestCase):
         response = self.client.get('/api/rules/999/filter')
         self.assertEqual(response.status_code, 404)
 
+    def test_list_and_search_load_filters_in_one_query(self):
+        """Test that listing and searching rules does not query filters per rule"""
+        for i in range(3, 8):
+            rule = AutoForwarding.objects.create(
+                email=f"user{i}@example.com",
+                name=f"User {i}",
+                has_forwarding_filters=True
+            )
+            ForwardingFilter.objects.create(
+                forwarding_id=rule.id,
+                criteria={"subject": f"report {i}"},
+                action={"forward": f"archive{i}@example.com"}
+            )
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/rules/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0]['filter']['criteria']['from'], "newsletter@example.com")
+        self.assertIsNone(data[1]['filter'])
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/rules/search/', {'email': 'example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 7)
+
+
+    def test_rule_rows_match_schema_serialization(self):
+        """Test that the list fast path returns exactly what the ForwardingRule schema would"""
+        rule_repo, _ = create_repositories()
+        expected = [db_to_api_rule(rule).model_dump() for rule in rule_repo.get_rules_with_filters()]
+
+        response = self.client.get('/api/rules/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/json; charset=utf-8")
+        self.assertEqual(response.json(), expected)
+
+        response = self.client.get('/api/rules/search/', {'email': 'user'})
+        self.assertEqual(response.json(), expected)
+
+    def test_conditional_get_with_etag(self):
+        """Test that unchanged data is answered with 304 and changed data with a new ETag"""
+        urls = [
+            '/api/rules/',
+            f'/api/rules/{self.rule1.id}',
+            f'/api/rules/{self.rule1.id}/filter',
+            '/api/stats/',
+        ]
+        etags = {}
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etags[url] = response['ETag']
+            self.assertTrue(etags[url].startswith('"'))
+
+            # The 304 does not read or serialize any data
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etags[url])
+            self.assertEqual(response.content, b"")
+
+        # A rule and a filter ETag are different representations
+        self.assertNotEqual(etags[f'/api/rules/{self.rule1.id}'], etags[f'/api/rules/{self.rule1.id}/filter'])
+
+        # Any write invalidates the ETags
+        self.client.put(
+            f'/api/rules/{self.rule2.id}/investigation',
+            data=json.dumps({"investigation_note": "Changed"}),
+            content_type='application/json'
+        )
+        for url in urls:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etags[url])
+
+        # Missing rules are not given an ETag
+        response = self.client.get('/api/rules/9999')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_endpoint_query_budgets(self):
+        """Test that no endpoint runs more queries as the number of rules grows"""
+        for i in range(3, 23):
+            rule = AutoForwarding.objects.create(email=f"user{i}@example.com", name=f"User {i}",
+                                                 has_forwarding_filters=True)
+            ForwardingFilter.objects.create(forwarding_id=rule.id, criteria={"subject": f"report {i}"},
+                                            action={"forward": f"archive{i}@example.com"})
+
+        self.assertQueryBudget(1, 'get', '/api/rules/')
+        self.assertQueryBudget(1, 'get', '/api/rules/search/', data={'email': 'example.com'})
+        self.assertQueryBudget(1, 'get', f'/api/rules/{self.rule1.id}')
+        self.assertQueryBudget(1, 'get', f'/api/rules/{self.rule1.id}/filter')
+        self.assertQueryBudget(1, 'get', '/api/stats/')
+        self.assertQueryBudget(0, 'get', '/api/stats/')  # cached
+        # Rows are read while streaming, after the headers are sent
+        queries, content = self.assertStreamQueryBudget(1, 'get', '/api/export/rules')
+        self.assertEqual(queries, 1)
+        self.assertEqual(len(content.splitlines()), AutoForwarding.objects.count())
+        # Read, update and history insert, plus the transaction's savepoint and release
+        self.assertQueryBudget(
+            5, 'put', f'/api/rules/{self.rule1.id}/investigation',
+            data=json.dumps({"investigation_note": "Checked"}), content_type='application/json'
+        )
+
+    def test_over_budget_requests_are_logged(self):
+        """Test that the timing middleware reports every request and logs those over budget"""
+        response = self.client.get('/api/rules/')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="1 queries", total;dur=[\d.]+$')
+
+        with self.settings(REQUEST_QUERY_BUDGET=0):
+            with self.assertLogs('forwarding_rules.middleware', level='WARNING') as logs:
+                self.client.get('/api/rules/')
+        self.assertIn("GET /api/rules/ (get_all_rules) ran 1 queries", logs.output[0])
+
+        # Streaming responses are logged once their content has been sent
+        with self.settings(REQUEST_QUERY_BUDGET=0):
+            with self.assertLogs('forwarding_rules.middleware', level='WARNING') as logs:
+                response = self.client.get('/api/export/rules')
+                self.assertEqual(logs.output, [])
+                b"".join(response.streaming_content)
+        self.assertIn("GET /api/export/rules (export_rules) ran 1 queries", logs.output[0])
+
+    def test_cursor_pagination(self):
+        """Test walking all rules page by page with the next cursor"""
+        for i in range(3, 8):
+            AutoForwarding.objects.create(email=f"user{i}@example.com", name=f"User {i}")
+
+        emails = []
+        params = {'limit': 3}
+        while True:
+            response = self.client.get('/api/rules/', params)
+            self.assertEqual(response.status_code, 200)
+            emails.extend(rule['email'] for rule in response.json())
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+            params = {'limit': 3, 'after': cursor}
+
+        self.assertEqual(emails, [f"user{i}@example.com" for i in range(1, 8)])
+
+        # Search results can be paged the same way
+        response = self.client.get('/api/rules/search/', {'email': 'user', 'limit': 4})
+        self.assertEqual(len(response.json()), 4)
+        response = self.client.get(
+            '/api/rules/search/',
+            {'email': 'user', 'limit': 4, 'after': response.headers['X-Next-Cursor']}
+        )
+        self.assertEqual(len(response.json()), 3)
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+        # Malformed cursors are rejected
+        response = self.client.get('/api/rules/', {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+        # So are empty and negative pages, on every paged endpoint
+        for url in ['/api/rules/?', '/api/rules/?order=-risk&', '/api/rules/search/?', '/api/destinations/?domain=x&',
+                    '/api/filters/search?criteria.from=x&', '/api/history/?since=2024-01-01T00:00:00&',
+                    f'/api/rules/{self.rule1.id}/history?']:
+            for limit in (0, -1):
+                response = self.client.get(f'{url}limit={limit}')
+                self.assertEqual(response.status_code, 400, f"{url}limit={limit}")
+                self.assertIn("limit must be at least 1", response.json()["detail"])
+        self.assertEqual(self.client.get('/api/rules/', {'skip': -1}).status_code, 400)
+
+    def test_export_rules(self):
+        """Test streaming all rules as NDJSON and CSV"""
+        response = self.client.get('/api/export/rules')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row['email'] for row in rows], ["user1@example.com", "user2@example.com"])
+        self.assertEqual(rows[0]['filter']['action']['forward'], "archive@example.com")
+        self.assertIsNone(rows[1]['filter'])
+
+        response = self.client.get('/api/export/rules', {'format': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        reader = csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode()))
+        rows = list(reader)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(json.loads(rows[0]['filter_criteria'])['from'], "newsletter@example.com")
+        self.assertEqual(rows[1]['filter_id'], "")
+
+        # Unknown formats are rejected
+        response = self.client.get('/api/export/rules', {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_export_rules_under_asgi(self):
+        """Test that ASGI requests stream the export from an async iterator, one chunk at a time"""
+        with patch('forwarding_rules.export.ROWS_PER_CHUNK', 1), warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            response = await self.async_client.get('/api/export/rules')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_async)
+            chunks = [chunk async for chunk in response]
+        # Django warns when it has to read a synchronous iterator to the end before sending it
+        self.assertEqual([str(warning.message) for warning in caught], [])
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual([json.loads(chunk)['email'] for chunk in chunks], ["user1@example.com", "user2@example.com"])
+
+
+class BulkImportRepositoryTests(TestCase):
+    """Tests for the bulk upsert repository methods used by the import script"""
+
+    def setUp(self):
+        """Set up an existing rule with a filter"""
+        cache.clear()
+        self.rule_repo, self.filter_repo = create_repositories()
+        self.existing = AutoForwarding.objects.create(
+            email="user1@example.com",
+            name="Old Name",
+            has_forwarding_filters=True
+        )
+        ForwardingFilter.objects.create(
+            forwarding_id=self.existing.id,
+            criteria={"from": "old@example.com"},
+            action={"forward": "old-target@example.com"}
+        )
+
+    def test_bulk_upsert_rules(self):
+        """Test that rules are inserted or updated by email"""
+        rule_ids = self.rule_repo.bulk_upsert_rules([
+            {"email": "user1@example.com", "name": "New Name", "forwarding_email": "f1@example.com"},
+            {"email": "user2@example.com", "name": "User Two"},
+        ])
+
+        self.assertEqual(rule_ids["user1@example.com"], self.existing.id)
+        self.assertEqual(AutoForwarding.objects.count(), 2)
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.name, "New Name")
+        self.assertEqual(self.existing.forwarding_email, "f1@example.com")
+        self.assertEqual(AutoForwarding.objects.get(id=rule_ids["user2@example.com"]).name, "User Two")
+
+        # Upserted rules are visible to search and statistics immediately
+        self.assertEqual(len(self.rule_repo.search_rules(email="user2@")), 1)
+        self.assertEqual(self.rule_repo.get_statistics()["total_rules"], 2)
+
+    def test_replace_filters_for_rules(self):
+        """Test that filters are replaced and has_forwarding_filters kept in sync"""
+        other = AutoForwarding.objects.create(email="user2@example.com", name="User Two")
+        self.rule_repo.get_statistics()
+
+        created = self.filter_repo.replace_filters_for_rules({
+            self.existing.id: None,
+            other.id: {"criteria": {"subject": "invoice"}, "action": {"forward": "x@example.com"}},
+        })
+
+        self.assertEqual(created, 1)
+        self.assertFalse(ForwardingFilter.objects.filter(forwarding_id=self.existing.id).exists())
+        self.assertEqual(ForwardingFilter.objects.get(forwarding_id=other.id).criteria, {"subject": "invoice"})
+        self.existing.refresh_from_db()
+        other.refresh_from_db()
+        self.assertFalse(self.existing.has_forwarding_filters)
+        self.assertTrue(other.has_forwarding_filters)
+        self.assertEqual(self.rule_repo.get_statistics()["rules_with_filters"], 1)
+
+
+class AsyncRepositoryTests(TestCase):
+    """Tests for the async repository methods used by the async API endpoints"""
+
+    def setUp(self):
+        """Set up a rule with a filter and a rule without one"""
+        cache.clear()
+        self.rule_repo, self.filter_repo = create_repositories()
+        self.rule1 = AutoForwarding.objects.create(email="user1@example.com", name="User One",
+                                                   has_forwarding_filters=True)
+        self.rule2 = AutoForwarding.objects.create(email="user2@example.com", name="User Two")
+        self.filter1 = ForwardingFilter.objects.create(
+            forwarding_id=self.rule1.id,
+            criteria={"from": "test@example.com"},
+            action={"forward": "target@example.com"}
+        )
+
+    async def test_async_reads(self):
+        """Test that the async reads match the sync ones"""
+        rules = await self.rule_repo.aget_rules_with_filters()
+        self.assertEqual([rule.id for rule in rules], [self.rule1.id, self.rule2.id])
+        self.assertEqual(get_joined_filter(rules[0]).id, self.filter1.id)
+
+        rule = await self.rule_repo.aget_rule_by_id(self.rule1.id)
+        self.assertEqual(get_joined_filter(rule).id, self.filter1.id)
+        self.assertIsNone(await self.rule_repo.aget_rule_by_id(9999))
+
+        rules = await self.rule_repo.asearch_rules_with_filters(email="user2")
+        self.assertEqual([rule.id for rule in rules], [self.rule2.id])
+
+        stats = await self.rule_repo.aget_statistics()
+        self.assertEqual(stats["total_rules"], 2)
+
+        filters = await self.filter_repo.aget_filters_for_rule(self.rule1.id)
+        self.assertEqual([filter_obj.id for filter_obj in filters], [self.filter1.id])
+
+    async def test_async_writes(self):
+        """Test that the async writes change the data and invalidate cached statistics"""
+        await self.rule_repo.aget_statistics()
+
+        rule = await self.rule_repo.aupdate_rule(self.rule2.id, {"investigation_note": "Checked"})
+        self.assertEqual(rule.investigation_note, "Checked")
+
+        self.assertTrue(await self.filter_repo.adelete_filters_for_rule(self.rule1.id))
+        self.assertTrue(await self.rule_repo.adelete_rule(self.rule1.id))
+        self.assertFalse(await self.rule_repo.adelete_rule(self.rule1.id))
+
+        stats = await self.rule_repo.aget_statistics()
+        self.assertEqual(stats["total_rules"], 1)
+        self.assertEqual(stats["total_filters"], 0)
+
+
+class SqliteConcurrencyTests(SimpleTestCase):
+    """Tests for the SQLite concurrency mode"""
+
+    databases = {'default'}
+
+    def test_connection_pragmas(self):
+        """Test that new connections get the busy timeout and relaxed syncing"""
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], int(settings.SQLITE_BUSY_TIMEOUT * 1000))
+
+    def test_writes_retried_on_lock(self):
+        """Test that a write failing with "database is locked" is run again"""
+        attempts = []
+
+        @retry_on_lock
+        def write():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OperationalError("database is locked")
+            return "written"
+
+        with patch('forwarding_rules.sqlite.time.sleep') as sleep, \
+                self.assertLogs('forwarding_rules.sqlite', level='INFO') as logs:
+            self.assertEqual(write(), "written")
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertIn("Database locked", logs.output[0])
+
+    def test_retried_write_starts_from_a_clean_slate(self):
+        """Test that a write whose later statement hit a lock is rolled back before it is run again"""
+        rule = AutoForwarding.objects.create(email="locked@example.com", name="Locked")
+        self.addCleanup(AutoForwarding.objects.filter(id=rule.id).delete)
+        _, filter_repo = create_repositories()
+
+        # The filter row is written, then its term rows (a post_save signal) hit the lock once
+        def create_terms(filters):
+            if terms.call_count == 1:
+                raise OperationalError("database is locked")
+            return create_filter_terms(filters)
+
+        with patch('forwarding_rules.signals.create_filter_terms', side_effect=create_terms) as terms, \
+                patch('forwarding_rules.sqlite.time.sleep'), self.assertLogs('forwarding_rules.sqlite', level='INFO'):
+            filter_repo.create_filter({"forwarding_id": rule.id, "criteria": {"subject": "invoice"}, "action": {}})
+        self.assertEqual(terms.call_count, 2)
+        self.assertEqual(ForwardingFilter.objects.filter(forwarding_id=rule.id).count(), 1)
+
+    def test_import_batch_retried_as_a_whole(self):
+        """Test that an import batch whose filter replacement hit a lock is rolled back and imported again"""
+        sample_data_import = importlib.import_module('sample_data_import')
+        users = [
+            {"email": f"import{i}@example.com", "name": f"Import {i}",
+             "filter": {"criteria": {"subject": "invoice"}, "action": {"forward": "drop@evil.example"}} if i % 2 else None}
+            for i in range(3)
+        ]
+        self.addCleanup(AutoForwarding.objects.filter(email__startswith="import").delete)
+        rule_repo, filter_repo = create_repositories()
+        replace_filters = filter_repo.replace_filters_for_rules
+
+        # The rules of the first batch are written, then replacing their filters hits the lock once
+        def locked_once(filters_by_rule):
+            if replace.call_count == 1:
+                raise OperationalError("database is locked")
+            return replace_filters(filters_by_rule)
+
+        with patch.object(filter_repo, 'replace_filters_for_rules', side_effect=locked_once) as replace, \
+                patch('forwarding_rules.sqlite.time.sleep'), \
+                self.assertLogs('forwarding_rules.sqlite', level='INFO') as logs:
+            imported = sample_data_import.store_autoforwarding_data(rule_repo, filter_repo, users, batch_size=2)
+        self.assertEqual(imported, 3)
+        self.assertEqual(replace.call_count, 3)
+        self.assertIn("_store_batch", logs.output[0])
+        self.assertEqual(AutoForwarding.objects.filter(email__startswith="import").count(), 3)
+        self.assertEqual(ForwardingFilter.objects.filter(forwarding__email="import1@example.com").count(), 1)
+        self.assertEqual(ForwardingFilter.objects.filter(forwarding__email__startswith="import").count(), 1)
+
+    def test_lock_retries_are_limited(self):
+        """Test that other errors are not retried and lock errors only up to SQLITE_LOCK_RETRIES times"""
+        @retry_on_lock
+        def write(error):
+            write.calls += 1
+            raise error
+
+        write.calls = 0
+        with self.assertRaises(OperationalError):
+            write(OperationalError("no such table: autoforwarding"))
+        self.assertEqual(write.calls, 1)
+
+        write.calls = 0
+        with self.settings(SQLITE_LOCK_RETRIES=2), patch('forwarding_rules.sqlite.time.sleep'), \
+                self.assertLogs('forwarding_rules.sqlite', level='INFO'):
+            with self.assertRaises(OperationalError):
+                write(OperationalError("database is locked"))
+        self.assertEqual(write.calls, 3)
+
+
+# The test process is the only user of its local-memory cache, so the cache is shared
+@override_settings(CACHE_SHARED=True)
+class ReadReplicaRoutingTests(TestCase):
+    """Tests for routing read-only repository paths to the read replica"""
+
+    def setUp(self):
+        """Start without a recent write pinning reads to the primary"""
+        cache.clear()
+        self.rule_repo, self.filter_repo = create_repositories()
+        token = routers._pinned_until.set(0.0)
+        self.addCleanup(routers._pinned_until.reset, token)
+
+    def test_reads_pinned_to_primary_after_write(self):
+        """Test that reads use the replica until something is written"""
+        with patch('forwarding_rules.routers.replica_configured', return_value=True):
+            self.assertEqual(routers.read_database(), "replica")
+
+            AutoForwarding.objects.create(email="user1@example.com", name="User One")
+            self.assertEqual(routers.read_database(), "default")
+
+            with self.settings(REPLICA_PIN_SECONDS=0):
+                AutoForwarding.objects.create(email="user2@example.com", name="User Two")
+                self.assertEqual(routers.read_database(), "replica")
+
+        # Without a replica everything reads from the primary
+        routers._pinned_until.set(0.0)
+        self.assertEqual(routers.read_database(), "default")
+
+    def test_router_sends_writes_and_migrations_to_primary(self):
+        """Test that rows read from the replica are written to the primary"""
+        router = routers.PrimaryReplicaRouter()
+        rule = AutoForwarding(email="user1@example.com", name="User One")
+        rule._state.db = "replica"
+        self.assertEqual(router.db_for_write(AutoForwarding, instance=rule), "default")
+        self.assertEqual(router.db_for_read(AutoForwarding), "default")
+        self.assertTrue(router.allow_migrate("default", "forwarding_rules"))
+        self.assertFalse(router.allow_migrate("replica", "forwarding_rules"))
+
+    def test_read_only_paths_use_read_database(self):
+        """Test that listing, searching, statistics, report and export reads ask for the read database"""
+        AutoForwarding.objects.create(email="user1@example.com", name="User One")
+        with patch('forwarding_rules.repository.read_database', return_value="default") as read_database:
+            self.rule_repo.get_all_rules()
+            self.rule_repo.search_rules(email="user")
+            self.rule_repo.get_rule_rows()
+            self.rule_repo.get_rule_rows_by_risk()
+            self.rule_repo.search_rule_rows(email="user")
+            async_to_sync(self.rule_repo.aget_rule_rows)()
+            async_to_sync(self.rule_repo.asearch_rule_rows)(email="user")
+            self.rule_repo.get_id_ranges(2)
+            list(self.rule_repo.iter_rules_with_filters())
+            self.rule_repo.get_statistics()
+            self.rule_repo.get_destination_domain_counts()
+            self.rule_repo.get_data_fingerprint()
+        self.assertEqual(read_database.call_count, 12)
+
+        # Lookups sent with data-version ETags read from the primary; bulk deletes read where they write
+        with patch('forwarding_rules.repository.read_database') as read_database, \
+                patch('forwarding_rules.repository.versioned_read_database', return_value="default") as versioned:
+            self.rule_repo.bulk_delete_rules(email="nobody")
+            self.rule_repo.get_rules_forwarding_to(domain="example.com")
+            self.rule_repo.get_rule_history(1)
+            self.filter_repo.search_filters([("action", "addLabels", "TRASH")])
+        read_database.assert_not_called()
+        self.assertEqual(versioned.call_count, 3)
+
+    def test_replica_reads_not_cached_under_data_version(self):
+        """Test that results read from the replica are neither cached nor sent with ETags, and pins end with their request"""
+        rule = AutoForwarding.objects.create(email="user1@example.com", name="User One")
+        # Reads go to a database other than the primary (the single test database stands in for the replica)
+        replica = [patch(f'forwarding_rules.{module}.PRIMARY_DATABASE', "primary")
+                   for module in ("repository", "tasks", "api")]
+        for patcher in replica:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.assertEqual(self.rule_repo.get_statistics()["total_rules"], 1)
+        self.assertEqual(self.rule_repo.get_destination_domain_counts(), [(None, 1)])
+        self.assertIsNone(cache.get(versioned_key("statistics")))
+        self.assertIsNone(cache.get(versioned_key("destination_domains")))
+
+        for url in ('/api/rules/', '/api/stats/', '/api/stats/destinations'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("ETag", response)
+        self.assertIn("ETag", self.client.get(f'/api/rules/{rule.id}/history'))
+
+        # Reports render from the replica, with statistics from the same snapshot, and are not reused
+        with tempfile.TemporaryDirectory() as reports_dir, override_settings(REPORTS_DIR=reports_dir):
+            path = generate_rules_only_report("rules.pdf")
+            self.assertIsNone(find_cached_report("rules_only", "rules.pdf", self.rule_repo.get_data_fingerprint()))
+            self.assertTrue(os.path.exists(path))
+
+    def test_pins_end_with_their_request_or_task(self):
+        """Test that a write pins the rest of its request, but not the next request or task"""
+        with patch('forwarding_rules.routers.replica_configured', return_value=True):
+            routers.pin_to_primary()
+            self.assertEqual(routers.read_database(), "default")
+            serve = replica_pin_middleware(lambda request: routers.read_database())
+            self.assertEqual(serve(None), "replica")
+            routers.pin_to_primary()
+            task_prerun.send(sender=None)
+            self.assertEqual(routers.read_database(), "replica")
+
+
+# The test process is the only user of its local-memory cache, so the cache is shared
+@override_settings(CACHE_SHARED=True)
+class FilterMatchTests(TestCase):
+    """Tests for the filter match engine and POST /api/filters/match"""
+
+    def setUp(self):
+        """Set up rules whose filters use each kind of criterion"""
+        cache.clear()
+        filters = [
+            ("user1@example.com", {"from": "hacky@hackyhackers.com", "subject": "invoice"}, {"forward": "drop@evil.example"}),
+            ("user2@example.com", {"from": "@company.com"}, {"forward": ["archive@example.com", "drop@evil.example"]}),
+            ("user3@example.com", {"subject": "timesheet OR payroll"}, {"addLabels": "HR"}),
+            ("user4@example.com", {"hasAttachment": True, "size": ">1M"}, {"forward": "big@example.com"}),
+            ("user5@example.com", {"query": "has:drive"}, {"forward": "never@example.com"}),
+        ]
+        self.rules = []
+        for email, criteria, action in filters:
+            rule = AutoForwarding.objects.create(email=email, name=email, has_forwarding_filters=True)
+            ForwardingFilter.objects.create(forwarding_id=rule.id, criteria=criteria, action=action)
+            self.rules.append(rule)
+
+    def match(self, **message):
+        response = self.client.post('/api/filters/match', data=json.dumps(message), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_match_phishing_message(self):
+        """Test that all criteria of a filter must match, ignoring case"""
+        data = self.match(**{"from": "Hacky <HACKY@hackyhackers.com>", "subject": "Your Invoice #42"})
+        self.assertEqual(data["matched"], 1)
+        self.assertEqual(data["matches"][0]["rule_id"], self.rules[0].id)
+        self.assertEqual(data["matches"][0]["email"], "user1@example.com")
+        self.assertEqual(data["forward_targets"], ["drop@evil.example"])
+
+        # The same sender with another subject does not fire the filter
+        self.assertEqual(self.match(**{"from": "hacky@hackyhackers.com", "subject": "Hello"})["matched"], 0)
+
+    def test_match_domains_alternatives_and_size(self):
+        """Test domain, OR alternatives, attachment and size criteria"""
+        data = self.match(**{"from": "boss@mail.company.com", "subject": "Payroll update",
+                             "has_attachment": True, "size": 5 * 1024 * 1024})
+        self.assertEqual([match["rule_id"] for match in data["matches"]],
+                         [self.rules[1].id, self.rules[2].id, self.rules[3].id])
+        # Forward targets are listed once each
+        self.assertEqual(data["forward_targets"], ["archive@example.com", "drop@evil.example", "big@example.com"])
+
+        # Small messages and messages without attachments do not fire the size filter
+        data = self.match(**{"from": "someone@other.org", "has_attachment": True, "size": 1024})
+        self.assertEqual(data["matched"], 0)
+
+    def test_matcher_rebuilt_after_filter_change(self):
+        """Test that the compiled matcher follows filter writes and skips unsupported criteria"""
+        rule_repo, filter_repo = create_repositories()
+        matcher = get_filter_matcher(filter_repo)
+        self.assertIs(get_filter_matcher(filter_repo), matcher)
+        self.assertEqual(len(matcher), 4)
+        self.assertEqual(matcher.unsupported, 1)
+
+        filter_repo.delete_filters_for_rule(self.rules[0].id)
+        self.assertEqual(self.match(**{"from": "hacky@hackyhackers.com", "subject": "invoice"})["matched"], 0)
+        self.assertEqual(len(get_filter_matcher(filter_repo)), 3)
+
+    def test_dotted_terms_and_empty_criteria(self):
+        """Test that dotted names match addresses, and that filters without criteria never fire"""
+        rows = [
+            {"id": 1, "forwarding_id": 1, "forwarding__email": "a@example.com",
+             "criteria": {"from": "jane.doe"}, "action": {}},
+            {"id": 2, "forwarding_id": 2, "forwarding__email": "b@example.com",
+             "criteria": {"from": "corp.com"}, "action": {}},
+            {"id": 3, "forwarding_id": 3, "forwarding__email": "c@example.com", "criteria": {}, "action": {}},
+            {"id": 4, "forwarding_id": 4, "forwarding__email": "d@example.com", "criteria": None, "action": {}},
+        ]
+        matcher = FilterMatcher.from_rows(rows)
+        self.assertEqual(matcher.unsupported, 2)
+
+        def matched(sender):
+            return [match.filter_id for match in matcher.match(sender=sender)]
+
+        self.assertEqual(matched("Jane <Jane.Doe@corp.com>"), [1, 2])
+        self.assertEqual(matched("john@mail.corp.com"), [2])
+        self.assertEqual(matched("john@notcorp.com"), [])
+        self.assertEqual(matched("someone@other.org"), [])
+
+    def test_aho_corasick_finds_overlapping_terms(self):
+        """Test that the automaton reports every term, including overlapping ones"""
+        automaton = AhoCorasick()
+        for value, term in enumerate(["he", "she", "his", "hers"]):
+            automaton.add(term, value)
+        automaton.build()
+        self.assertEqual(automaton.find("ushers"), {0, 1, 3})
+        self.assertEqual(automaton.find("nothing"), set())
+
+
+class MailboxReplayTests(TestCase):
+    """Tests for the mailbox replay simulation"""
+
+    MBOX = (
+        b"From hacky@hackyhackers.com Mon Jan 15 10:00:00 2024\n"
+        b"From: Hacky <hacky@hackyhackers.com>\n"
+        b"To: user1@example.com\n"
+        b"Subject: =?utf-8?q?Invoice_=E2=84=96_42?=\n"
+        b"\n"
+        b"Please pay.\n"
+        b"\n"
+        b"From boss@company.com Mon Jan 15 11:00:00 2024\n"
+        b"From: boss@company.com\n"
+        b"To: user2@example.com\n"
+        b"Cc: user3@example.com\n"
+        b"Subject: Quarterly numbers\n"
+        b"\n"
+        b"Body mentioning From the start of a line\n"
+        b"\n"
+        b"From friend@other.org Mon Jan 15 12:00:00 2024\n"
+        b"From: friend@other.org\n"
+        b"To: user1@example.com\n"
+        b"Subject: Lunch?\n"
+        b"\n"
+        b"See you.\n"
+    )
+
+    def setUp(self):
+        """Create two forwarding filters and a mailbox directory with an mbox file"""
+        cache.clear()
+        filters = [
+            ("user1@example.com", {"from": "hacky@hackyhackers.com", "subject": "invoice"}, {"forward": "drop@evil.example"}),
+            ("user2@example.com", {"from": "@company.com"}, {"forward": ["archive@example.com", "drop@evil.example"]}),
+        ]
+        self.rules = []
+        for email, criteria, action in filters:
+            rule = AutoForwarding.objects.create(email=email, name=email, has_forwarding_filters=True)
+            ForwardingFilter.objects.create(forwarding_id=rule.id, criteria=criteria, action=action)
+            self.rules.append(rule)
+
+        self.mailbox_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.mailbox_dir.cleanup)
+        self.mbox_path = os.path.join(self.mailbox_dir.name, "incident.mbox")
+        with open(self.mbox_path, "wb") as f:
+            f.write(self.MBOX)
+
+    def filter_rows(self):
+        _, filter_repo = create_repositories()
+        return list(filter_repo.iter_filter_rows())
+
+    def test_iter_mailbox_reads_mbox_and_eml_directory(self):
+        """Test that both mailbox formats are split into messages and headers decoded"""
+        messages = list(iter_mailbox(self.mbox_path))
+        self.assertEqual(len(messages), 3)
+        sender, recipients, subject, has_attachment, size = messages[0]
+        self.assertEqual(sender, "Hacky <hacky@hackyhackers.com>")
+        self.assertEqual(subject, "Invoice \u2116 42")
+        self.assertFalse(has_attachment)
+        self.assertEqual(messages[1][1], ["user2@example.com", "user3@example.com"])
+
+        eml_dir = os.path.join(self.mailbox_dir.name, "eml", "inbox")
+        os.makedirs(eml_dir)
+        with open(os.path.join(eml_dir, "1.eml"), "wb") as f:
+            f.write(b"From: boss@company.com\nSubject: Scan\nContent-Disposition: attachment; filename=a.pdf\n\n...")
+        with open(os.path.join(eml_dir, "notes.txt"), "wb") as f:
+            f.write(b"not a message")
+        messages = list(iter_mailbox(os.path.join(self.mailbox_dir.name, "eml")))
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0][3])
+
+    def test_replay_counts_by_rule_and_destination(self):
+        """Test the forwarded message counts, serially and across a process pool"""
+        serial = replay_mailbox(self.mbox_path, self.filter_rows(), processes=1)
+        self.assertEqual(serial["messages"], 3)
+        self.assertEqual(serial["forwarded_messages"], 2)
+        self.assertEqual(serial["by_destination"], [
+            {"destination": "drop@evil.example", "forwarded": 2},
+            {"destination": "archive@example.com", "forwarded": 1},
+        ])
+        self.assertEqual(sorted((item["rule_id"], item["forwarded"]) for item in serial["by_rule"]),
+                         [(self.rules[0].id, 1), (self.rules[1].id, 1)])
+        self.assertEqual(len(serial["by_rule_destination"]), 3)
+
+        with patch('forwarding_rules.replay.os.cpu_count', return_value=2):
+            pooled = replay_mailbox(self.mbox_path, self.filter_rows(), processes=2, batch_size=1)
+            for processes in (0, -1):
+                with self.assertRaises(ValueError):
+                    replay_mailbox(self.mbox_path, self.filter_rows(), processes=processes)
+            # More processes than CPUs are cut down to one per CPU
+            with self.assertLogs('forwarding_rules.replay', level='WARNING'):
+                capped = replay_mailbox(self.mbox_path, self.filter_rows(), processes=3)
+        self.assertEqual(pooled["processes"], 2)
+        self.assertEqual(capped["processes"], 2)
+        for key in ("messages", "forwarded_messages", "by_destination", "by_rule_destination"):
+            self.assertEqual(pooled[key], serial[key])
+
+    def test_replay_task_writes_json_result(self):
+        """Test that the Celery task writes the counts to the reports directory"""
+        with tempfile.TemporaryDirectory() as reports_dir, override_settings(REPORTS_DIR=reports_dir):
+            path = simulate_mailbox_replay(self.mbox_path, 1, "replay.json")
+            self.assertEqual(path, os.path.join(reports_dir, "replay.json"))
+            with open(path) as f:
+                result = json.load(f)
+        self.assertEqual(result["mailbox"], self.mbox_path)
+        self.assertEqual(result["forwarded_messages"], 2)
+
+    @patch('forwarding_rules.tasks.simulate_mailbox_replay.delay')
+    def test_replay_endpoint(self, mock_task):
+        """Test that the endpoint starts the task only for mailboxes inside MAILBOX_DIR"""
+        mock_task.return_value = MagicMock(id="replay-task-id")
+        with override_settings(MAILBOX_DIR=self.mailbox_dir.name), \
+                patch('forwarding_rules.replay.os.cpu_count', return_value=1):
+            # The worker, not the API host, holds the pool to its CPU count
+            response = self.client.post('/api/simulations/replay?mailbox=incident.mbox&processes=4')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("replay-task-id", response.json()["message"])
+            mock_task.assert_called_once_with(os.path.realpath(self.mbox_path), 4)
+
+            for mailbox in ("missing.mbox", "../etc/passwd", "/etc/passwd"):
+                response = self.client.post(f'/api/simulations/replay?mailbox={mailbox}')
+                self.assertEqual(response.status_code, 400)
+
+            for processes in (0, -2):
+                response = self.client.post(f'/api/simulations/replay?mailbox=incident.mbox&processes={processes}')
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()["detail"], "processes must be at least 1")
+        self.assertEqual(mock_task.call_count, 1)
+
+    def test_replay_task_routed_to_solo_worker_queue(self):
+        """Test that replays go to the queue of the worker that may start a process pool"""
+        self.assertEqual(celery_app.amqp.router.route({}, simulate_mailbox_replay.name)["queue"].name, "replay")
+
+
+# The test process is the only user of its local-memory cache, so the cache is shared
+@override_settings(CACHE_SHARED=True)
+class ForwardingGraphTests(TestCase):
+    """Tests for the forwarding graph and the /api/graph/ endpoints"""
+
+    def setUp(self):
+        """
+        Set up a chain leaving the company through two mailboxes, a loop and a self-forward:
+        head -> alice -> bob -> drop@evil.example, alice <-> carol, dan -> dan
+        """
+        cache.clear()
+        rules = [
+            ("head@example.com", "alice@example.com", None),
+            ("alice@example.com", None, {"forward": "bob@example.com"}),
+            ("bob@example.com", "drop@evil.example", None),
+            ("carol@example.com", "alice@example.com", None),
+            ("dan@example.com", "dan@example.com", None),
+        ]
+        self.rules = {}
+        for email, forwarding_email, action in rules:
+            rule = AutoForwarding.objects.create(email=email, name=email, forwarding_email=forwarding_email,
+                                                 has_forwarding_filters=action is not None)
+            if action:
+                ForwardingFilter.objects.create(forwarding_id=rule.id, criteria={}, action=action)
+            self.rules[email] = rule
+        # alice also forwards to carol, closing the loop
+        ForwardingFilter.objects.filter(forwarding_id=self.rules["alice@example.com"].id).update(
+            action={"forward": ["bob@example.com", "carol@example.com"]})
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_graph_endpoints(self):
+        """Test chains, loops, external reach and inbound counts"""
+        chains = self.get('/api/graph/chains')
+        self.assertEqual(chains, [{
+            "addresses": ["head@example.com", "alice@example.com", "bob@example.com", "drop@evil.example"],
+            "hops": 3,
+            "external": True,
+        }, {
+            # Ends where carol would forward back to alice
+            "addresses": ["head@example.com", "alice@example.com", "carol@example.com"],
+            "hops": 2,
+            "external": False,
+        }])
+        self.assertEqual(len(self.get('/api/graph/chains?min_hops=3')), 1)
+
+        loops = self.get('/api/graph/loops')
+        self.assertEqual([loop["addresses"] for loop in loops],
+                         [["alice@example.com", "carol@example.com"], ["dan@example.com"]])
+
+        reach = self.get('/api/graph/external-reach?min_hops=2')
+        self.assertEqual([(item["mailbox"], item["hops"]) for item in reach],
+                         [("carol@example.com", 3), ("head@example.com", 3), ("alice@example.com", 2)])
+        self.assertEqual(reach[0]["external_domains"], ["evil.example"])
+        self.assertEqual(len(self.get('/api/graph/external-reach')), 4)
+
+        top = self.get('/api/graph/top-inbound?limit=1')
+        self.assertEqual(top, [{"address": "alice@example.com", "inbound": 2, "internal": True}])
+
+    def test_graph_refreshed_incrementally(self):
+        """Test that writes update the graph in place, re-reading only the changed rules"""
+        rule_repo, filter_repo = create_repositories()
+        graph = get_forwarding_graph(rule_repo)
+        self.assertEqual(graph.edge_count, 6)
+
+        version = get_data_version()
+        rule_repo.update_rule(self.rules["bob@example.com"].id, {"forwarding_email": "bob.home@gmail.com"})
+        self.assertEqual(get_changed_rules(version, get_data_version()), {self.rules["bob@example.com"].id})
+
+        with patch.object(ForwardingGraph, 'from_rows') as from_rows, self.assertNumQueries(1):
+            self.assertIs(get_forwarding_graph(rule_repo), graph)
+        from_rows.assert_not_called()
+        self.assertEqual(graph.chains()[0]["addresses"][-1], "bob.home@gmail.com")
+
+        rule_repo.bulk_delete_rules(rule_ids=[self.rules["bob@example.com"].id, self.rules["dan@example.com"].id])
+        filter_repo.delete_filters_for_rule(self.rules["alice@example.com"].id)
+        with patch.object(ForwardingGraph, 'from_rows') as from_rows:
+            self.assertIs(get_forwarding_graph(rule_repo), graph)
+        from_rows.assert_not_called()
+        self.assertEqual(graph.loops(), [])
+        self.assertEqual(graph.external_reach(), [])
+        self.assertEqual(graph.edge_count, 2)
+
+        # Without a change log the graph is rebuilt
+        cache.clear()
+        rebuilt = get_forwarding_graph(rule_repo)
+        self.assertIsNot(rebuilt, graph)
+        self.assertEqual(rebuilt.edge_count, 2)
+
+
+# The test process is the only user of its local-memory cache, so the cache is shared
+@override_settings(CACHE_SHARED=True)
+class DestinationDomainTests(TestCase):
+    """Tests for the indexed destination domain and the internal/external destination queries"""
+
+    def setUp(self):
+        """Create rules forwarding inside, outside and nowhere, through different write paths"""
+        cache.clear()
+        self.rule_repo, _ = create_repositories()
+        self.internal = self.rule_repo.create_rule(
+            {"email": "user1@example.com", "name": "User 1", "forwarding_email": "archive@Mail.Example.com"})
+        self.external = self.rule_repo.create_rule(
+            {"email": "user2@example.com", "name": "User 2", "forwarding_email": "me@gmail.com"})
+        self.rule_repo.create_rule({"email": "user3@example.com", "name": "User 3"})
+        ids = self.rule_repo.bulk_upsert_rules([
+            {"email": "user4@example.com", "name": "User 4", "forwarding_email": "drop@Evil.example"},
+            {"email": "user5@example.com", "name": "User 5", "forwarding_email": "other@gmail.com"},
+        ])
+        self.upserted = ids["user4@example.com"]
+
+    def test_destination_domain_kept_on_write(self):
+        """Test that every write path sets the lower-case destination domain"""
+        domains = dict(AutoForwarding.objects.values_list('email', 'destination_domain'))
+        self.assertEqual(domains, {
+            "user1@example.com": "mail.example.com",
+            "user2@example.com": "gmail.com",
+            "user3@example.com": None,
+            "user4@example.com": "evil.example",
+            "user5@example.com": "gmail.com",
+        })
+
+        self.rule_repo.update_rule(self.external.id, {"forwarding_email": None})
+        self.rule_repo.bulk_upsert_rules([{"email": "user4@example.com", "name": "User 4",
+                                           "forwarding_email": "team@example.com"}])
+        self.assertIsNone(AutoForwarding.objects.get(id=self.external.id).destination_domain)
+        self.assertEqual(AutoForwarding.objects.get(id=self.upserted).destination_domain, "example.com")
+
+    def test_backfill_migration(self):
+        """Test that the migration fills in the destination domain of existing rules"""
+        AutoForwarding.objects.update(destination_domain=None)
+        migration = importlib.import_module('forwarding_rules.migrations.0004_autoforwarding_destination_domain')
+        with patch.object(migration, 'BACKFILL_BATCH_SIZE', 2):
+            migration.backfill_destination_domain(apps, MagicMock(connection=connection))
+        self.assertEqual(AutoForwarding.objects.filter(destination_domain__isnull=False).count(), 4)
+        self.assertEqual(AutoForwarding.objects.get(id=self.upserted).destination_domain, "evil.example")
+
+    def test_search_by_destination(self):
+        """Test the destination_domain and external search filters"""
+        def emails(query):
+            response = self.client.get(f'/api/rules/search/?{query}')
+            self.assertEqual(response.status_code, 200)
+            return [rule["email"] for rule in response.json()]
+
+        self.assertEqual(emails("external=true"), ["user2@example.com", "user4@example.com", "user5@example.com"])
+        self.assertEqual(emails("external=false"), ["user1@example.com"])
+        self.assertEqual(emails("destination_domain=GMAIL.com"), ["user2@example.com", "user5@example.com"])
+        self.assertEqual(emails("destination_domain=gmail.com&email=user5"), ["user5@example.com"])
+
+        rules = self.client.get('/api/rules/search/?external=true&limit=1').json()
+        self.assertEqual(rules[0]["destination_domain"], "gmail.com")
+
+        # A new internal subdomain is internal at once, not only after the domain counts are refreshed
+        self.rule_repo.get_destination_domain_counts()
+        AutoForwarding.objects.create(email="user6@example.com", name="User 6",
+                                      forwarding_email="ops@eu.mail.example.com",
+                                      destination_domain="eu.mail.example.com")
+        self.assertEqual(emails("external=false"), ["user1@example.com", "user6@example.com"])
+        self.assertNotIn("user6@example.com", emails("external=true"))
+        # A look-alike domain is not a subdomain
+        self.rule_repo.create_rule({"email": "user7@example.com", "name": "User 7",
+                                    "forwarding_email": "me@notexample.com"})
+        self.assertIn("user7@example.com", emails("external=true"))
+
+    def test_destination_statistics(self):
+        """Test the grouped internal and external counts, cached until rules change"""
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/stats/destinations')
+        data = response.json()
+        self.assertEqual((data["internal"], data["external"], data["no_forwarding"]), (1, 3, 1))
+        self.assertEqual(data["domains"][0], {"domain": "gmail.com", "rules": 2, "internal": False})
+
+        with self.assertNumQueries(0):
+            self.client.get('/api/stats/destinations')
+
+        self.rule_repo.update_rule(self.external.id, {"forwarding_email": "me@example.com"})
+        data = self.client.get('/api/stats/destinations?limit=1').json()
+        self.assertEqual((data["internal"], data["external"]), (2, 2))
+        self.assertEqual(len(data["domains"]), 1)
+
+
+class ForwardingDestinationTests(TestCase):
+    """Tests for the reverse "who forwards to X" lookup table and endpoint"""
+
+    def setUp(self):
+        """Create rules forwarding by address and by filter action, through different write paths"""
+        cache.clear()
+        self.rule_repo, self.filter_repo = create_repositories()
+        self.alice = self.rule_repo.create_rule(
+            {"email": "alice@example.com", "name": "Alice", "forwarding_email": "Drop@Evil.example"})
+        self.bob = self.rule_repo.create_rule({"email": "bob@example.com", "name": "Bob"})
+        self.filter_repo.create_filter({"forwarding_id": self.bob.id, "criteria": {"subject": "invoice"},
+                                        "action": {"forward": ["drop@evil.example", "Team@example.com"]}})
+        ids = self.rule_repo.bulk_upsert_rules([
+            {"email": "carol@example.com", "name": "Carol", "forwarding_email": "me@gmail.com"},
+            {"email": "dave@example.com", "name": "Dave", "forwarding_email": "other@evil.example"},
+        ])
+        self.carol, self.dave = ids["carol@example.com"], ids["dave@example.com"]
+        self.filter_repo.replace_filters_for_rules({
+            self.carol: {"criteria": {}, "action": {"forward": "drop@evil.example"}},
+        })
+
+    def destinations(self):
+        return sorted(ForwardingDestination.objects.values_list('forwarding__email', 'address', 'source'))
+
+    def test_destinations_kept_on_write(self):
+        """Test that every write path keeps one lower-case row per rule, target and source"""
+        self.assertEqual(self.destinations(), [
+            ("alice@example.com", "drop@evil.example", "rule"),
+            ("bob@example.com", "drop@evil.example", "filter"),
+            ("bob@example.com", "team@example.com", "filter"),
+            ("carol@example.com", "drop@evil.example", "filter"),
+            ("carol@example.com", "me@gmail.com", "rule"),
+            ("dave@example.com", "other@evil.example", "rule"),
+        ])
+
+        self.rule_repo.update_rule(self.alice.id, {"forwarding_email": None})
+        self.filter_repo.delete_filters_for_rule(self.bob.id)
+        self.filter_repo.replace_filters_for_rules({self.carol: None})
+        self.rule_repo.bulk_upsert_rules([{"email": "dave@example.com", "name": "Dave",
+                                           "forwarding_email": "dave@example.com"}])
+        self.rule_repo.delete_rule(self.carol)
+        self.assertEqual(self.destinations(), [("dave@example.com", "dave@example.com", "rule")])
+
+    def test_unchanged_forwarding_email_skips_resync(self):
+        """Test that saving a rule without changing its forwarding address leaves its rows alone"""
+        # Only the rule's SELECT and UPDATE and the history INSERT, in a savepoint
+        with self.assertNumQueries(5):
+            self.rule_repo.update_rule(self.alice.id, {"investigation_note": "checked"})
+
+    def test_backfill_migration(self):
+        """Test that the migration creates the rows of existing rules and filters"""
+        expected = self.destinations()
+        ForwardingDestination.objects.all().delete()
+        migration = importlib.import_module('forwarding_rules.migrations.0005_forwardingdestination')
+        with patch.object(migration, 'BACKFILL_BATCH_SIZE', 2):
+            migration.backfill_destinations(apps, MagicMock(connection=connection))
+        self.assertEqual(self.destinations(), expected)
+
+    def test_lookup_endpoint(self):
+        """Test the lookup by address and by domain, with cursor paging"""
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/destinations/?address=DROP@evil.example')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(match["email"], match["source"]) for match in response.json()],
+            [("alice@example.com", "rule"), ("bob@example.com", "filter"), ("carol@example.com", "filter")],
+        )
+        self.assertEqual(response.json()[0]["rule_id"], self.alice.id)
+
+        first = self.client.get('/api/destinations/?domain=evil.example&limit=3')
+        second = self.client.get(f'/api/destinations/?domain=evil.example&limit=3&after={first["X-Next-Cursor"]}')
+        self.assertNotIn('X-Next-Cursor', second)
+        matches = first.json() + second.json()
+        self.assertEqual([match["id"] for match in matches], sorted(match["id"] for match in matches))
+        self.assertEqual(sorted((match["email"], match["address"]) for match in matches), [
+            ("alice@example.com", "drop@evil.example"),
+            ("bob@example.com", "drop@evil.example"),
+            ("carol@example.com", "drop@evil.example"),
+            ("dave@example.com", "other@evil.example"),
+        ])
+
+        self.assertEqual(self.client.get('/api/destinations/').status_code, 400)
+        self.assertEqual(self.client.get('/api/destinations/?address=a@b.c&domain=b.c').status_code, 400)
+        self.assertEqual(self.client.get('/api/destinations/?domain=b.c&after=bad').status_code, 400)
+
+
+class RiskScoreTests(TestCase):
+    """Tests for the risk score kept on every rule and the highest-risk-first listing"""
+
+    def setUp(self):
+        """Create rules with different risk signals, through different write paths"""
+        cache.clear()
+        self.rule_repo, self.filter_repo = create_repositories()
+        self.phish = self.rule_repo.create_rule(
+            {"email": "alice@example.com", "name": "Alice", "forwarding_email": "drop@evil.example"})
+        self.filter_repo.create_filter({"forwarding_id": self.phish.id, "criteria": {"subject": "Invoice"},
+                                        "action": {"addLabels": ["TRASH"]}})
+        self.internal = self.rule_repo.create_rule(
+            {"email": "bob@example.com", "name": "Bob", "forwarding_email": "team@example.com"})
+        ids = self.rule_repo.bulk_upsert_rules([
+            {"email": "carol@example.com", "name": "Carol", "forwarding_email": "me@gmail.com"},
+            {"email": "dave@example.com", "name": "Dave", "error": "Mailbox not found"},
+        ])
+        self.carol, self.dave = ids["carol@example.com"], ids["dave@example.com"]
+
+    def scores(self):
+        return dict(AutoForwarding.objects.values_list('email', 'risk_score'))
+
+    def test_risk_score(self):
+        """Test the points of each signal"""
+        self.assertEqual(risk_score(None, None), 0)
+        self.assertEqual(risk_score("example.com", None), 0)
+        self.assertEqual(risk_score("gmail.com", None), 40)
+        self.assertEqual(risk_score(None, None, action={"forward": "x@gmail.com"}), 40)
+        self.assertEqual(risk_score(None, None, {"subject": ["Wire transfer"]}, {"addLabels": "trash"}), 45)
+        self.assertEqual(risk_score("gmail.com", "error", {"subject": "invoice"}, {"addLabels": ["TRASH"]}), 100)
+
+    def test_score_kept_on_write(self):
+        """Test that every write path recomputes the score of the rules it changes"""
+        self.assertEqual(self.scores(), {
+            "alice@example.com": 85,
+            "bob@example.com": 0,
+            "carol@example.com": 40,
+            "dave@example.com": 15,
+        })
+
+        self.rule_repo.update_rule(self.phish.id, {"error": "Quota exceeded"})
+        self.rule_repo.update_rule(self.internal.id, {"forwarding_email": "me@gmail.com"})
+        self.filter_repo.replace_filters_for_rules({
+            self.carol: {"criteria": {"from": "payments@bank.example"}, "action": {}},
+        })
+        self.rule_repo.bulk_upsert_rules([{"email": "dave@example.com", "name": "Dave", "error": None}])
+        self.assertEqual(self.scores(), {
+            "alice@example.com": 100,
+            "bob@example.com": 40,
+            "carol@example.com": 60,
+            "dave@example.com": 0,
+        })
+
+        self.filter_repo.delete_filters_for_rule(self.phish.id)
+        self.rule_repo.bulk_upsert_rules([{"email": "carol@example.com", "name": "Carol", "forwarding_email": None}])
+        self.assertEqual(self.scores()["alice@example.com"], 55)
+        self.assertEqual(self.scores()["carol@example.com"], 20)
+
+    def test_unrelated_update_keeps_score(self):
+        """Test that saving a rule without changing its risk inputs does not read its filter"""
+        rule = AutoForwarding.objects.get(id=self.phish.id)
+        rule.investigation_note = "checked"
+        with self.assertNumQueries(1):
+            rule.save()
+        self.assertEqual(AutoForwarding.objects.get(id=self.phish.id).risk_score, 85)
+
+    def test_backfill_migration(self):
+        """Test that the migration scores existing rules"""
+        expected = self.scores()
+        AutoForwarding.objects.update(risk_score=None)
+        migration = importlib.import_module('forwarding_rules.migrations.0006_autoforwarding_risk_score')
+        with patch.object(migration, 'BACKFILL_BATCH_SIZE', 3):
+            migration.backfill_risk_score(apps, MagicMock(connection=connection))
+        self.assertEqual(self.scores(), expected)
+
+    def test_rules_ordered_by_risk(self):
+        """Test the highest-risk-first listing with its (risk_score, id) cursor"""
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/rules/?order=-risk&limit=2')
+        self.assertEqual([(rule["email"], rule["risk_score"]) for rule in response.json()],
+                         [("alice@example.com", 85), ("carol@example.com", 40)])
+
+        response = self.client.get(f'/api/rules/?order=-risk&limit=2&after={response["X-Next-Cursor"]}')
+        self.assertEqual([rule["email"] for rule in response.json()], ["dave@example.com", "bob@example.com"])
+        self.assertNotIn('X-Next-Cursor', response)
+
+        self.assertEqual(self.client.get('/api/rules/?order=risk').status_code, 400)
+        cursor = self.client.get('/api/rules/?limit=1')['X-Next-Cursor']
+        self.assertEqual(self.client.get(f'/api/rules/?order=-risk&after={cursor}').status_code, 400)
+
+
+class FilterSearchTests(TestCase):
+    """Tests for the criteria and action term index and GET /filters/search"""
+
+    def setUp(self):
+        """Create filters through the single-filter and the bulk write paths"""
+        cache.clear()
+        self.rule_repo, self.filter_repo = create_repositories()
+        alice = self.rule_repo.create_rule({"email": "alice@example.com", "name": "Alice"})
+        self.phish = self.filter_repo.create_filter({
+            "forwarding_id": alice.id,
+            "criteria": {"from": "CEO@Example.com", "subject": "invoice", "hasAttachment": True},
+            "action": {"addLabels": ["TRASH", "Archived"], "forward": "drop@evil.example"},
+        })
+        ids = self.rule_repo.bulk_upsert_rules([
+            {"email": "bob@example.com", "name": "Bob"},
+            {"email": "carol@example.com", "name": "Carol"},
+        ])
+        self.bob, self.carol = ids["bob@example.com"], ids["carol@example.com"]
+        self.filter_repo.replace_filters_for_rules({
+            self.bob: {"criteria": {"from": "ceo@example.com"}, "action": {"addLabels": "IMPORTANT"}},
+            self.carol: {"criteria": {"subject": "Invoice"}, "action": {"addLabels": ["TRASH"]}},
+        })
+
+    def terms(self, rule_id):
+        return sorted(FilterTerm.objects.filter(filter__forwarding_id=rule_id).values_list('kind', 'key', 'value'))
+
+    def search(self, query):
+        response = self.client.get(f'/api/filters/search?{query}')
+        self.assertEqual(response.status_code, 200)
+        return [filter_row["forwarding_id"] for filter_row in response.json()]
+
+    def test_terms_kept_on_write(self):
+        """Test that every write path keeps one normalized term per criteria and action value"""
+        self.assertEqual(self.terms(self.phish.forwarding_id), [
+            ("action", "addLabels", "archived"),
+            ("action", "addLabels", "trash"),
+            ("action", "forward", "drop@evil.example"),
+            ("criteria", "from", "ceo@example.com"),
+            ("criteria", "hasAttachment", "true"),
+            ("criteria", "subject", "invoice"),
+        ])
+        self.assertEqual(self.terms(self.bob), [("action", "addLabels", "important"), ("criteria", "from", "ceo@example.com")])
+
+        self.phish.action = {"addLabels": "INBOX"}
+        self.phish.save()
+        self.filter_repo.replace_filters_for_rules({self.bob: {"criteria": {"size": 1000}, "action": {}}})
+        self.filter_repo.delete_filters_for_rule(self.carol)
+        self.assertIn(("action", "addLabels", "inbox"), self.terms(self.phish.forwarding_id))
+        self.assertNotIn(("action", "addLabels", "trash"), self.terms(self.phish.forwarding_id))
+        self.assertEqual(self.terms(self.bob), [("criteria", "size", "1000")])
+        self.assertEqual(self.terms(self.carol), [])
+
+    def test_backfill_migration(self):
+        """Test that the migration creates the terms of existing filters"""
+        expected = sorted(FilterTerm.objects.values_list('filter_id', 'kind', 'key', 'value'))
+        FilterTerm.objects.all().delete()
+        migration = importlib.import_module('forwarding_rules.migrations.0007_filterterm')
+        with patch.object(migration, 'BACKFILL_BATCH_SIZE', 2):
+            migration.backfill_filter_terms(apps, MagicMock(connection=connection))
+        self.assertEqual(sorted(FilterTerm.objects.values_list('filter_id', 'kind', 'key', 'value')), expected)
+
+    def test_search_endpoint(self):
+        """Test criteria and action searches, combined terms and cursor paging"""
+        alice = self.phish.forwarding_id
+        self.assertEqual(self.search("criteria.from=ceo@example.com"), [alice, self.bob])
+        self.assertEqual(self.search("action.addLabels=trash"), [alice, self.carol])
+        self.assertEqual(self.search("criteria.subject=INVOICE&action.addLabels=TRASH&action.addLabels=archived"), [alice])
+        self.assertEqual(self.search("criteria.hasAttachment=true"), [alice])
+        self.assertEqual(self.search("criteria.from=nobody@example.com"), [])
+
+        with self.assertNumQueries(1):
+            first = self.client.get('/api/filters/search?action.addLabels=trash&limit=1')
+        self.assertEqual(first.json()[0]["action"]["forward"], "drop@evil.example")
+        second = self.client.get(f'/api/filters/search?action.addLabels=trash&limit=1&after={first["X-Next-Cursor"]}')
+        self.assertEqual([filter_row["forwarding_id"] for filter_row in second.json()], [self.carol])
+
+        self.assertEqual(self.client.get('/api/filters/search').status_code, 400)
+        self.assertEqual(self.client.get('/api/filters/search?subject=invoice').status_code, 400)
+        self.assertEqual(self.client.get('/api/filters/search?criteria.from=x&after=bad').status_code, 400)
+
+
+class InvestigationHistoryTests(TestCase):
+    """Tests for the append-only investigation history and its endpoints"""
+
+    def setUp(self):
+        """Create two rules and record a few investigation changes"""
+        cache.clear()
+        self.rule_repo, _ = create_repositories()
+        self.alice = self.rule_repo.create_rule({"email": "alice@example.com", "name": "Alice"})
+        self.bob = self.rule_repo.create_rule({"email": "bob@example.com", "name": "Bob"})
+
+    def put(self, rule_id, body):
+        return self.client.put(f'/api/rules/{rule_id}/investigation', data=json.dumps(body),
+                               content_type='application/json')
+
+    def history(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_changes_are_recorded(self):
+        """Test that note and disposition changes are appended, and unchanged values are not"""
+        self.assertEqual(self.put(self.alice.id, {"investigation_note": "Checked"}).status_code, 200)
+        response = self.put(self.alice.id, {"investigation_note": "Checked", "disposition": "benign"})
+        self.assertEqual(response.json()["disposition"], "benign")
+        self.put(self.alice.id, {"investigation_note": "Reopened"})
+
+        events = list(InvestigationEvent.objects.order_by('id').values_list('field', 'old_value', 'new_value', 'email'))
+        self.assertEqual(events, [
+            ("investigation_note", None, "Checked", "alice@example.com"),
+            ("disposition", None, "benign", "alice@example.com"),
+            ("investigation_note", "Checked", "Reopened", "alice@example.com"),
+        ])
+        self.assertEqual(self.put(9999, {"investigation_note": "x"}).status_code, 404)
+
+    def test_history_is_append_only(self):
+        """Test that events cannot be changed or deleted, and outlive their rule"""
+        self.rule_repo.update_rule(self.alice.id, {"investigation_note": "Checked"})
+        event = InvestigationEvent.objects.get()
+        event.new_value = "Rewritten"
+        with self.assertRaises(ValueError):
+            event.save()
+        with self.assertRaises(ValueError):
+            event.delete()
+
+        self.rule_repo.delete_rule(self.alice.id)
+        rows = self.history(f'/api/rules/{self.alice.id}/history').json()
+        self.assertEqual([row["new_value"] for row in rows], ["Checked"])
+
+    def test_bulk_upsert_records_changes(self):
+        """Test that the bulk import records note changes and keeps fields it was not given"""
+        self.rule_repo.update_rule(self.alice.id, {"investigation_note": "Checked", "disposition": "benign"})
+        self.rule_repo.bulk_upsert_rules([
+            {"email": "alice@example.com", "name": "Alice", "investigation_note": "Imported"},
+            {"email": "bob@example.com", "name": "Robert"},
+            {"email": "carol@example.com", "name": "Carol", "investigation_note": "New"},
+        ])
+
+        self.alice.refresh_from_db()
+        self.assertEqual((self.alice.investigation_note, self.alice.disposition), ("Imported", "benign"))
+        self.assertEqual(AutoForwarding.objects.get(id=self.bob.id).name, "Robert")
+        events = list(InvestigationEvent.objects.order_by('id').values_list('forwarding_id', 'field', 'old_value', 'new_value'))
+        self.assertEqual(events[2:], [(self.alice.id, "investigation_note", "Checked", "Imported")])
+
+    def test_failed_history_write_rolls_back_the_change(self):
+        """Test that a rule change is not kept when its event cannot be recorded"""
+        with patch.object(InvestigationEvent.objects, 'bulk_create', side_effect=OperationalError("disk full")):
+            with self.assertRaises(OperationalError):
+                self.rule_repo.update_rule(self.alice.id, {"investigation_note": "Checked"})
+        self.alice.refresh_from_db()
+        self.assertIsNone(self.alice.investigation_note)
+
+    def test_rule_timeline_paging(self):
+        """Test that a rule's timeline lists only its events, oldest first, a page at a time"""
+        for note in ("one", "two", "three"):
+            self.rule_repo.update_rule(self.alice.id, {"investigation_note": note})
+        self.rule_repo.update_rule(self.bob.id, {"investigation_note": "other"})
+
+        with self.assertNumQueries(1):
+            first = self.history(f'/api/rules/{self.alice.id}/history?limit=2')
+        self.assertEqual([row["new_value"] for row in first.json()], ["one", "two"])
+        self.assertEqual(first.json()[0]["rule_id"], self.alice.id)
+        second = self.history(f'/api/rules/{self.alice.id}/history?limit=2&after={first["X-Next-Cursor"]}')
+        self.assertEqual([row["new_value"] for row in second.json()], ["three"])
+        self.assertFalse(second.has_header('X-Next-Cursor'))
+        self.assertEqual(self.client.get(f'/api/rules/{self.alice.id}/history?after=bad').status_code, 400)
+
+    def test_changes_since(self):
+        """Test that changes are listed from `since` up to `until` across rules, a page at a time"""
+        self.rule_repo.update_rule(self.alice.id, {"investigation_note": "old"})
+        InvestigationEvent.objects.update(created_at="2024-01-01T00:00:00Z")
+        self.rule_repo.update_rule(self.alice.id, {"investigation_note": "new"})
+        self.rule_repo.update_rule(self.bob.id, {"disposition": "escalated"})
+
+        with self.assertNumQueries(1):
+            first = self.history('/api/history/?since=2024-06-01T00:00:00&limit=1')
+        self.assertEqual([row["new_value"] for row in first.json()], ["new"])
+        second = self.history(f'/api/history/?since=2024-06-01T00:00:00&limit=1&after={first["X-Next-Cursor"]}')
+        self.assertEqual([(row["rule_id"], row["field"]) for row in second.json()], [(self.bob.id, "disposition")])
+
+        rows = self.history('/api/history/?since=2023-01-01T00:00:00%2B00:00&until=2024-06-01T00:00:00Z').json()
+        self.assertEqual([row["new_value"] for row in rows], ["old"])
+
+        self.assertEqual(self.client.get('/api/history/').status_code, 422)
+        self.assertEqual(self.client.get('/api/history/?since=yesterday').status_code, 422)
+        self.assertEqual(self.client.get('/api/history/?since=2024-01-01T00:00:00&after=bad').status_code, 400)
+
+    def test_changes_since_pages_in_commit_order(self):
+        """Test that a change committed after a page was read comes on the next page, even stamped earlier"""
+        self.rule_repo.update_rule(self.alice.id, {"investigation_note": "first"})
+        self.rule_repo.update_rule(self.bob.id, {"investigation_note": "second"})
+        InvestigationEvent.objects.update(created_at="2024-06-02T00:00:00Z")
+        first = self.history('/api/history/?since=2024-06-01T00:00:00&limit=1')
+        self.assertEqual([row["new_value"] for row in first.json()], ["first"])
+
+        # Stamped before the events already paged, as when its time was taken before a slower commit
+        self.rule_repo.update_rule(self.alice.id, {"investigation_note": "late"})
+        InvestigationEvent.objects.filter(new_value="late").update(created_at="2024-06-01T12:00:00Z")
+
+        second = self.history(f'/api/history/?since=2024-06-01T00:00:00&after={first["X-Next-Cursor"]}')
+        self.assertEqual([row["new_value"] for row in second.json()], ["second", "late"])
+
 
 class ReportAPITests(TestCase):
     """Tests for the report generation API endpoints"""
 
+    def setUp(self):
+        """Start each test without remembered reports"""
+        cache.clear()
+
     @patch('forwarding_rules.tasks.generate_rules_report.delay')
     def test_generate_full_report(self, mock_task):
         """Test generating a full report"""
@@ -179,6 +1676,15 @@ class ReportAPITests(TestCase):
         self.assertEqual(response.status_code, 200)
         mock_task.assert_called_once_with("custom_report.pdf")
 
+    @patch('forwarding_rules.tasks.generate_rules_report_sharded.delay')
+    def test_generate_sharded_report(self, mock_task):
+        """Test starting a report rendered in parallel shards"""
+        mock_task.return_value = MagicMock(id='fake-task-id')
+
+        response = self.client.post('/api/reports/generate?shards=8')
+        self.assertEqual(response.status_code, 200)
+        mock_task.assert_called_once_with(None, 8)
+
     @patch('forwarding_rules.tasks.generate_stats_report.delay')
     def test_generate_stats_report(self, mock_task):
         """Test generating a statistics-only report"""
@@ -215,4 +1721,152 @@ class ReportAPITests(TestCase):
         # Test with custom report name as query parameter
         response = self.client.post('/api/reports/rules-only?report_name=rules_only_report.pdf')
         self.assertEqual(response.status_code, 200)
-        mock_task.assert_called_once_with("rules_only_report.pdf") 
\ No newline at end of file
+        mock_task.assert_called_once_with("rules_only_report.pdf") 
+
+
+def pdf_text(path):
+    """Return the decompressed content streams of a generated PDF report"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    streams = re.findall(rb'stream\r?\n(.*?)\s*endstream', data, re.S)
+    text = []
+    for stream in streams:
+        # ReportLab encodes compressed page streams with ASCII85 and Flate
+        try:
+            text.append(zlib.decompress(base64.a85decode(stream.strip(), adobe=True)))
+        except (ValueError, zlib.error):
+            text.append(stream)
+    return b"".join(text).decode('latin-1')
+
+
+# The test process is the only user of its local-memory cache, so the cache is shared
+@override_settings(CACHE_SHARED=True)
+class ReportTaskTests(TestCase):
+    """Tests for the report generation Celery tasks, run synchronously"""
+
+    def setUp(self):
+        """Create more rules than fit on one API page, half with filters"""
+        cache.clear()
+        self.reports_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.reports_dir.cleanup)
+        for i in range(150):
+            rule = AutoForwarding.objects.create(
+                email=f"user{i}@example.com",
+                name=f"User {i}",
+                has_forwarding_filters=i % 2 == 0
+            )
+            if i % 2 == 0:
+                ForwardingFilter.objects.create(
+                    forwarding_id=rule.id,
+                    criteria={"subject": f"invoice-{i}"},
+                    action={"forward": f"archive{i}@example.com"}
+                )
+        self.last_rule = rule
+
+    def test_reports_cover_all_rules(self):
+        """Test that report tasks include every rule, not just the first page"""
+        with override_settings(REPORTS_DIR=self.reports_dir.name):
+            with self.assertNumQueries(3):
+                # The data fingerprint, the statistics, and the rules with their filters
+                path = generate_rules_report("full.pdf")
+            rules_only_path = generate_rules_only_report("rules_only.pdf")
+
+        text = pdf_text(path)
+        self.assertIn(f"Rule #{self.last_rule.id}: user149@example.com", text)
+        self.assertIn("invoice-148", text)
+
+        text = pdf_text(rules_only_path)
+        self.assertIn(f"Rule #{self.last_rule.id}: user149@example.com", text)
+        self.assertNotIn("invoice-148", text)
+
+    def test_sharded_report_matches_single_task_report(self):
+        """Test that a report rendered in shards contains the cover, statistics and every rule"""
+        # Run the chord of shard tasks in process
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+        with override_settings(REPORTS_DIR=self.reports_dir.name):
+            result_id = generate_rules_report_sharded("sharded.pdf", shard_count=3)
+
+        self.assertTrue(result_id)
+        path = f"{self.reports_dir.name}/sharded.pdf"
+        text = pdf_text(path)
+        self.assertIn("Email Forwarding Rules Audit Report", text)
+        self.assertIn("Statistics", text)
+        for i in [0, 49, 50, 99, 100, 149]:
+            self.assertIn(f": user{i}@example.com", text)
+
+        # Rules appear in ID order across shard boundaries
+        self.assertLess(text.index(": user49@example.com"), text.index(": user50@example.com"))
+        self.assertLess(text.index(": user99@example.com"), text.index(": user100@example.com"))
+
+        # Partial files are removed after merging
+        self.assertEqual(os.listdir(f"{self.reports_dir.name}/parts"), [])
+
+    def test_sharded_report_without_rules(self):
+        """Test that a sharded report of no rules goes through the chord and is cached under the requested name"""
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+        AutoForwarding.objects.all().delete()
+        with override_settings(REPORTS_DIR=self.reports_dir.name):
+            result_id = generate_rules_report_sharded("empty.pdf", shard_count=3)
+            path = f"{self.reports_dir.name}/empty.pdf"
+            self.assertEqual(find_cached_report("full", "empty.pdf", create_repositories()[0].get_data_fingerprint()), path)
+
+        self.assertTrue(result_id)
+        text = pdf_text(path)
+        self.assertIn("Email Forwarding Rules Audit Report", text)
+        self.assertIn("Statistics", text)
+        self.assertEqual(os.listdir(f"{self.reports_dir.name}/parts"), [])
+
+    def test_unchanged_data_reuses_report(self):
+        """Test that identical report requests reuse the rendered file until data changes"""
+        with override_settings(REPORTS_DIR=self.reports_dir.name), \
+                patch.object(SimpleDocTemplate, 'build', autospec=True, side_effect=SimpleDocTemplate.build) as build:
+            first_path = generate_stats_report("stats.pdf")
+            self.assertEqual(generate_stats_report("stats.pdf"), first_path)
+            self.assertEqual(build.call_count, 1)
+
+            # The API returns the existing report without starting a task
+            with patch('forwarding_rules.tasks.generate_stats_report.delay') as mock_task:
+                response = self.client.post('/api/reports/stats?report_name=stats.pdf')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(first_path, response.json()['message'])
+            mock_task.assert_not_called()
+
+            # A different report type is rendered separately
+            generate_rules_only_report("stats.pdf")
+            self.assertEqual(build.call_count, 2)
+
+            # Any change to the data renders the report again
+            self.last_rule.investigation_note = "Reviewed"
+            self.last_rule.save()
+            generate_stats_report("stats.pdf")
+            self.assertEqual(build.call_count, 3)
+
+    def test_report_types_sharing_a_name(self):
+        """Test that a report overwritten by another report type is not reused"""
+        with override_settings(REPORTS_DIR=self.reports_dir.name), \
+                patch.object(SimpleDocTemplate, 'build', autospec=True, side_effect=SimpleDocTemplate.build) as build:
+            stats_path = generate_stats_report("report.pdf")
+            rules_path = generate_rules_only_report("report.pdf")
+            self.assertEqual(rules_path, stats_path)
+            self.assertEqual(build.call_count, 2)
+
+            # The file now holds the rules-only report, so the statistics are rendered again
+            fingerprint = create_repositories()[0].get_data_fingerprint()
+            self.assertIsNone(find_cached_report("stats", "report.pdf", fingerprint))
+            self.assertEqual(find_cached_report("rules_only", "report.pdf", fingerprint), rules_path)
+            generate_stats_report("report.pdf")
+            self.assertEqual(build.call_count, 3)
+            self.assertIsNone(find_cached_report("rules_only", "report.pdf", fingerprint))
+            self.assertIn("Email Forwarding Rules Statistics Report", pdf_text(stats_path))
+
+    def test_streaming_story_refills_as_consumed(self):
+        """Test that the story list only buffers a window of flowables"""
+        story = _StreamingStory(["title"], iter(range(1000)), buffer_size=10)
+        consumed = []
+        while len(story):
+            self.assertLessEqual(list.__len__(story), 10)
+            consumed.append(story[0])
+            del story[0]
+        self.assertEqual(consumed, ["title"] + list(range(1000)))
@@ -2,14 +2,18 @@
 """
 Sample data import script for Email Forwarding Rules Audit API.
 
-This script imports sample data into the Django database.
+This script imports sample data, or a JSON file of user records in the same
+format, into the Django database.
 
 Usage:
     python sample_data_import.py  # Imports sample data into Django database
+    python sample_data_import.py --file users.json --batch-size 5000
 """
 
 import argparse
+import json
 import os
+import time
 import django
 
 # Set up Django environment
@@ -17,6 +21,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'forwarding_audit.settings')
 django.setup()
 
 from forwarding_rules.repository import create_repositories
+from forwarding_rules.sqlite import retry_on_lock
+
+# Number of users written per transaction
+DEFAULT_BATCH_SIZE = 5000
 
 # Sample data representing forwarding rules
 SAMPLE_DATA = [
@@ -88,70 +96,75 @@ SAMPLE_DATA = [
     }
 ]
 
-def store_autoforwarding_data(rule_repo, filter_repo, user_data):
+def store_autoforwarding_data(rule_repo, filter_repo, user_data, batch_size=DEFAULT_BATCH_SIZE):
     """
     Import data into repositories
     
+    Rules are upserted on their unique email and their filters replaced in
+    batches, each batch in one transaction, instead of several queries per user.
+    
     Args:
         rule_repo: Repository for auto-forwarding rules
         filter_repo: Repository for forwarding filters
-        user_data: List of user data dictionaries
+        user_data: Iterable of user data dictionaries
+        batch_size: Number of users written per transaction
+        
+    Returns:
+        int: Number of users imported
     """
+    imported = 0
+    batch = []
     for user in user_data:
-        email = user["email"]
-        name = user["name"]
-        forwarding_email = user.get("forwarding_email")
-        disposition = user.get("disposition")
-        has_filters = user.get("has_forwarding_filters", False)
-        error = user.get("error")
-        investigation_note = user.get("investigation_note")
+        batch.append(user)
+        if len(batch) >= batch_size:
+            imported += _store_batch(rule_repo, filter_repo, batch)
+            batch = []
+    if batch:
+        imported += _store_batch(rule_repo, filter_repo, batch)
+    return imported
 
-        # Create a rule
-        rule_data = {
+@retry_on_lock
+def _store_batch(rule_repo, filter_repo, users):
+    """
+    Upsert one batch of users and replace their filters in a single transaction
+    
+    retry_on_lock opens the transaction around the whole batch, so when
+    SQLite was locked by another process the batch is rolled back and run
+    again from the start. The repository calls inside it run in that
+    transaction and leave retrying to it.
+    
+    Args:
+        rule_repo: Repository for auto-forwarding rules
+        filter_repo: Repository for forwarding filters
+        users: List of user data dictionaries
+        
+    Returns:
+        int: Number of users in the batch
+    """
+    # The same email may appear more than once; the last occurrence wins
+    users_by_email = {user["email"]: user for user in users}
+    
+    rules_data = [
+        {
             "email": email,
-            "name": name,
-            "forwarding_email": forwarding_email,
-            "disposition": disposition,
-            "has_forwarding_filters": has_filters,
-            "error": error,
-            "investigation_note": investigation_note
+            "name": user["name"],
+            "forwarding_email": user.get("forwarding_email"),
+            "disposition": user.get("disposition"),
+            # A rule has filters exactly when a filter is imported for it
+            "has_forwarding_filters": bool(user.get("filter")),
+            "error": user.get("error"),
+            "investigation_note": user.get("investigation_note")
         }
-        
-        # Check if rule already exists by searching for email
-        existing_rules = rule_repo.search_rules(email=email)
-        existing_rule = next(iter(existing_rules), None)
-        
-        if existing_rule:
-            # Update existing rule
-            rule_id = existing_rule.id
-            rule = rule_repo.update_rule(rule_id, rule_data)
-        else:
-            # Create new rule
-            rule = rule_repo.create_rule(rule_data)
-            rule_id = rule.id
-            
-        # Delete existing filter
-        filter_repo.delete_filters_for_rule(rule_id)
-        
-        # Create filter if it exists
-        filter_data = user.get("filter")
-        if filter_data:
-            criteria = filter_data.get("criteria", {})
-            action = filter_data.get("action", {})
-            created_at = filter_data.get("created_at")
-            
-            filter_data = {
-                "forwarding_id": rule_id,
-                "criteria": criteria,
-                "action": action,
-                "created_at": created_at
-            }
-            
-            filter_repo.create_filter(filter_data)
-            
-            # Ensure rule is marked as having filters
-            if not rule.has_forwarding_filters:
-                rule_repo.update_rule(rule_id, {"has_forwarding_filters": True})
+        for email, user in users_by_email.items()
+    ]
+    
+    rule_ids = rule_repo.bulk_upsert_rules(rules_data)
+    filter_repo.replace_filters_for_rules({
+        rule_ids[email]: user.get("filter")
+        for email, user in users_by_email.items()
+    })
+    
+    return len(users_by_email)
 
 def print_repository_results(rule_repo, filter_repo):
     """
@@ -184,24 +197,47 @@ def print_repository_results(rule_repo, filter_repo):
     for key, value in stats.items():
         print(f"{key}: {value}")
 
-def import_data():
+def import_data(user_data=None, batch_size=DEFAULT_BATCH_SIZE):
     """
     Import data into the Django database
+    
+    Args:
+        user_data: List of user data dictionaries; the sample data when omitted
+        batch_size: Number of users written per transaction
     """
     # Create repositories
     rule_repo, filter_repo = create_repositories()
     
     # Store data in repository
-    store_autoforwarding_data(rule_repo, filter_repo, SAMPLE_DATA)
+    started = time.perf_counter()
+    imported = store_autoforwarding_data(
+        rule_repo, filter_repo, SAMPLE_DATA if user_data is None else user_data, batch_size
+    )
+    elapsed = time.perf_counter() - started
+    rate = imported / elapsed if elapsed > 0 else float("inf")
+    print(f"Imported {imported} users in {elapsed:.2f}s ({rate:,.0f} rows/s)")
     
-    # Print results
-    print_repository_results(rule_repo, filter_repo)
+    # Print results for the small sample data set only
+    if user_data is None:
+        print_repository_results(rule_repo, filter_repo)
 
 def main():
     """Main entry point"""
-    print("Importing sample data into Django database...")
-    import_data()
-    print("\nSample data import complete.")
+    parser = argparse.ArgumentParser(description="Import forwarding rules into the Django database")
+    parser.add_argument("--file", help="JSON file containing a list of user records (defaults to the sample data)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Users written per transaction (default: {DEFAULT_BATCH_SIZE})")
+    args = parser.parse_args()
+    
+    user_data = None
+    if args.file:
+        with open(args.file) as f:
+            user_data = json.load(f)
+    
+    print("Importing sample data into Django database..." if user_data is None
+          else f"Importing {len(user_data)} users from {args.file} into Django database...")
+    import_data(user_data, args.batch_size)
+    print("\nSample data import complete." if user_data is None else "\nImport complete.")
 
 if __name__ == "__main__":
     main()